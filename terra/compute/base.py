@@ -1,13 +1,23 @@
 import os
 import time
 import atexit
+import asyncio
+import functools
+import contextvars
 from logging import StreamHandler
 from logging.handlers import SocketHandler
 import threading
 import warnings
+from tempfile import TemporaryDirectory
+from concurrent.futures import Future
 
 from terra import settings
 import terra.compute.utils
+import terra.compute.resources
+import terra.compute.checkpoint
+import terra.compute.batch
+import terra.compute.volumes
+from terra.compute.timing import service_timings, phase
 from terra.executor import Executor
 from terra.logger import (
   getLogger, LogRecordSocketReceiver, SkipStdErrAddFilter
@@ -15,10 +25,25 @@ from terra.logger import (
 logger = getLogger(__name__)
 
 
+_service_executor_lock = threading.Lock()
+_pool_lock = threading.Lock()
+_admission_lock = threading.Lock()
+_staging_lock = threading.Lock()
+
+
 class ServiceRunFailed(Exception):
   ''' Exception thrown when a service runner returns non-zero
+
+  Parameters
+  ----------
+  returncode : int, optional
+      The return code of the runner, when there is one
   '''
 
+  def __init__(self, *args, returncode=None):
+    super().__init__(*args)
+    self.returncode = returncode
+
 
 class BaseService:
   '''
@@ -36,6 +61,15 @@ class BaseService:
     self.env = os.environ.copy()
     self.volumes = []
     ''' A copy of the processes environment variables local to a service '''
+    self.resources = {}
+    '''dict: The ``cpus``, ``memory`` and ``cpuset`` the service requests, see
+    :mod:`terra.compute.resources`'''
+    self.retry = {}
+    '''dict: The retry policy of the service, see
+    :mod:`terra.compute.checkpoint`'''
+    self.inputs = []
+    '''list: The files and directories the service reads, that decide whether
+    it needs to run again, see :option:`compute.skip_completed`'''
 
   def _validate_volume(self, local, remote,
                        check_remote=True,
@@ -72,6 +106,29 @@ class BaseService:
     self._validate_volume(local, remote, local_must_exist=local_must_exist)
     self.volumes.append((local, remote))
 
+  def add_volumes(self, volumes, flags=None, prefix=None,
+                  local_must_exist=False):
+    '''
+    Add many volumes to the service, the same as :meth:`add_volume` does,
+    except that the ``local`` files/folders are checked to exist all at once,
+    in parallel
+
+    Parameters
+    ----------
+    volumes : list
+        The ``(local, remote)`` of each volume
+    '''
+
+    volumes = list(volumes)
+    if local_must_exist:
+      missing = terra.compute.volumes.missing_paths(
+          local for local, _ in volumes if local)
+      if missing:
+        raise ValueError('local file/folder does not exist {}'
+                         .format(', '.join(missing)))
+    for local, remote in volumes:
+      self.add_volume(local, remote, flags=flags, prefix=prefix)
+
   def pre_run(self):
     '''
     A function that runs before the run service
@@ -86,7 +143,8 @@ class BaseService:
     # information is available. For example if using docker and celery, then
     # docker config need to be run to get the container volumes, and that has
     # to be run on the host machine. So this is calculated here.
-    settings.executor.volume_map = Executor.configuration_map(self)
+    with phase('executor_configuration_map'):
+      settings.executor.volume_map = Executor.configuration_map(self)
     logger.debug4("Executor Volume map: %s", settings.executor.volume_map)
 
   def post_run(self):
@@ -137,24 +195,22 @@ class BaseCompute:
                            f'implementation "{implementation}"') from None
 
     def defaultCommand(self, service_class, *args, **kwargs):
-
-      service_info = terra.compute.utils.load_service(service_class)
-
-      # Check and call pre_ call
-      pre_call = getattr(service_info, 'pre_' + name, None)
-      if pre_call:
-        pre_call(*args, **kwargs)
-
-      # Call command implementation
-      rv = self.__getattribute__(implementation)(
-          service_info, *args, **kwargs)
-
-      # Check and call post_ call
-      post_call = getattr(service_info, 'post_' + name, None)
-      if post_call:
-        post_call(*args, **kwargs)
-
-      return rv
+      with service_timings.time(name) as timer:
+        service_info = self._load_service(service_class, timer)
+        skip, service_hash = self._check_completed(name, service_info, args,
+                                                   kwargs)
+        if skip:
+          return None
+        self._call_hook('pre_' + name, service_info, args, kwargs)
+
+        # Call command implementation. Running services wait for the
+        # resources they request, and are retried when they fail
+        resources, policy = self._command_policy(name, service_info)
+        rv = self._call_implementation(name, service_info, resources, policy,
+                                       args, kwargs)
+
+        self._finish_command(name, service_info, service_hash, args, kwargs)
+        return rv
 
     defaultCommand.__doc__ = f'''The {name} command for {__class__.__qualname__}
 
@@ -168,6 +224,475 @@ class BaseCompute:
     # bind function and return it
     return defaultCommand.__get__(self, type(self))
 
+  # The steps shared by every command, the default commands (e.g. ``run``),
+  # ``arun`` and ``run_batch``
+
+  @staticmethod
+  def _load_service(service_class, timer):
+    with phase('load_service'):
+      service_info = terra.compute.utils.load_service(service_class)
+    if timer:
+      timer.service = type(service_info).__qualname__
+    return service_info
+
+  def _check_completed(self, name, service_info, args, kwargs):
+    '''
+    Services that already completed with the same inputs are skipped
+
+    Returns
+    -------
+    tuple
+        Whether to skip the service, and its
+        :func:`terra.compute.checkpoint.service_hash` (``None`` when it is not
+        checked)
+    '''
+
+    if name != 'run' or self.completed is None:
+      return False, None
+    service_hash = terra.compute.checkpoint.service_hash(
+        service_info, args, kwargs)
+    if service_hash in self.completed:
+      logger.info(f'Skipping {type(service_info).__qualname__}, it already '
+                  'completed')
+      return True, service_hash
+    return False, service_hash
+
+  @staticmethod
+  def _call_hook(hook_name, service_info, args, kwargs):
+    # Calls the service's pre_{command} or post_{command}, if it has one
+    hook = getattr(service_info, hook_name, None)
+    if hook:
+      with phase(hook_name):
+        hook(*args, **kwargs)
+
+  @staticmethod
+  def _command_policy(name, service_info):
+    # The resources a command waits for, and its retry policy. Only running
+    # the service has either
+    if name != 'run':
+      return {}, None
+    return (terra.compute.resources.service_resources(service_info),
+            terra.compute.checkpoint.RetryPolicy.from_settings(service_info))
+
+  @staticmethod
+  def _retry_delay(policy, service_info, error, attempt):
+    # The seconds to wait before the next attempt, raises error when there is
+    # none
+    if policy is None:
+      raise error
+    return policy.retry_delay(type(service_info).__qualname__, error, attempt)
+
+  def _call_implementation(self, name, service_info, resources, policy, args,
+                           kwargs):
+    # Calls {name}_service once the resources are admitted, and again for as
+    # long as the retry policy allows
+    implementation = self.__getattribute__(name + '_service')
+    attempt = 1
+    while True:
+      try:
+        with self.admission.admit(resources), phase(name):
+          return implementation(service_info, *args, **kwargs)
+      except Exception as e:
+        delay = self._retry_delay(policy, service_info, e, attempt)
+      time.sleep(delay)
+      attempt += 1
+
+  def _finish_command(self, name, service_info, service_hash, args, kwargs):
+    self._call_hook('post_' + name, service_info, args, kwargs)
+    if service_hash is not None:
+      self.completed.add(service_hash, service_info)
+
+  def run_async(self, service_class, *args, **kwargs):
+    '''
+    Non-blocking version of ``run``
+
+    The service is run, including its ``pre_run`` and ``post_run``, in a
+    thread of a :class:`terra.executor.thread.ThreadPoolExecutor`. Each
+    thread has its own copy of the settings, and each run is done in a
+    settings context, so that concurrent services do not see each other's
+    changes to the settings. The number of services run at once is limited by
+    :option:`compute.max_concurrent`.
+
+    Returns
+    -------
+    :class:`concurrent.futures.Future`
+        Resolves to the return value of ``run``, or raises its exception, e.g.
+        :class:`ServiceRunFailed`
+    '''
+
+    return self._get_service_executor().submit(
+        self._run_in_context, service_class, *args, **kwargs)
+
+  def run_batch(self, service_class, inputs, *args, **kwargs):
+    '''
+    Run a service over many inputs, launching its runner once
+
+    The inputs are passed to the runner in the settings file, and the runner
+    module's ``main()`` is called once per input, see
+    :mod:`terra.compute.batch`. The service's ``pre_run`` and ``post_run``
+    are called once for the whole batch. A failed input does not stop the
+    others.
+
+    Parameters
+    ----------
+    service_class : :term:`class` or str
+        The service
+    inputs : list
+        The inputs, each one a :class:`dict` of settings, or a path that is
+        set as ``input_path``
+
+    Returns
+    -------
+    list
+        A :class:`terra.compute.batch.BatchResult` per input, in the same
+        order
+    '''
+
+    inputs = list(inputs)
+    with service_timings.time('run_batch') as timer:
+      service_info = self._load_service(service_class, timer)
+      # The service may be the caller's instance, which can be run again
+      command = service_info.command
+      service_info.command, runner = terra.compute.batch.batch_command(
+          command)
+      try:
+        with settings:
+          settings.batch = terra.compute.batch.batch_settings(runner, inputs)
+
+          self._call_hook('pre_run', service_info, args, kwargs)
+
+          # Services that run in the controller, and have no settings file,
+          # write their results to a file of the controller's
+          results_dir = None
+          settings_file = getattr(service_info, 'settings_file', None)
+          if settings_file:
+            filename = terra.compute.batch.results_filename(
+                settings_file, settings.batch.id)
+          else:
+            results_dir = TemporaryDirectory(prefix='terra_batch_')
+            filename = os.path.join(results_dir.name, 'results.jsonl')
+            settings.batch.results_file = filename
+
+          # Failed inputs are in the results, the batch is not retried, which
+          # would run the inputs that succeeded again
+          error = None
+          resources, _ = self._command_policy('run', service_info)
+          try:
+            self._call_implementation('run', service_info, resources, None,
+                                      args, kwargs)
+          except ServiceRunFailed as e:
+            error = str(e) or 'The runner failed'
+          results = terra.compute.batch.read_results(filename, inputs, error)
+          if results_dir is not None:
+            results_dir.cleanup()
+          elif os.path.exists(filename):
+            # Pooled services share their settings directory
+            os.remove(filename)
+
+          self._finish_command('run', service_info, None, args, kwargs)
+      finally:
+        service_info.command = command
+
+    failed = [result for result in results if not result.ok]
+    if failed:
+      logger.warning(f'{len(failed)} of {len(results)} inputs of '
+                     f'{type(service_info).__qualname__} failed')
+    return results
+
+  def prepare(self, services, max_workers=None):
+    '''
+    Get services ready to run, before the workflow runs them, e.g. pull or
+    build the images of container services
+
+    Each service says what it needs done with :meth:`prepare_tasks`. Tasks
+    shared by services, e.g. pulling the same image, are only done once, and
+    all the tasks are done in parallel, in a
+    :class:`terra.executor.thread.ThreadPoolExecutor`. A failed task is logged
+    as a warning, and the service fails the usual way when it is run.
+
+    Parameters
+    ----------
+    services : list
+        The services, as service classes, names or instances
+    max_workers : int, optional
+        The most tasks done at the same time
+
+    Returns
+    -------
+    dict
+        The exception of every task, ``None`` for those that succeeded
+    '''
+
+    with service_timings.time('prepare'):
+      tasks = {}
+      with phase('prepare_tasks'):
+        for service_class in services:
+          service_info = terra.compute.utils.load_service(service_class)
+          for key, task in self.prepare_tasks(service_info).items():
+            tasks.setdefault(key, task)
+      if not tasks:
+        return {}
+
+      from terra.executor.thread import ThreadPoolExecutor
+      logger.info(f'Preparing {", ".join(tasks)}')
+      with ThreadPoolExecutor(max_workers=max_workers,
+                              thread_name_prefix='terra_prepare') as executor:
+        futures = {key: executor.submit(task) for key, task in tasks.items()}
+
+    results = {}
+    for key, future in futures.items():
+      results[key] = future.exception()
+      if results[key] is not None:
+        logger.warning(f'Unable to prepare {key}: {results[key]}')
+    return results
+
+  def prepare_tasks(self, service_info):
+    '''
+    What needs to be done to get a service ready to run, for :meth:`prepare`.
+    Nothing, by default
+
+    Returns
+    -------
+    dict
+        A :term:`function` per task, by what it prepares, e.g. the image. The
+        same key is only done once
+    '''
+    return {}
+
+  async def arun(self, service_class, *args, **kwargs):
+    '''
+    Coroutine version of ``run``, for asyncio workflows
+
+    The service's ``pre_run`` and ``post_run`` are called the same as by
+    ``run``, in the event loop, and the service runner is run by
+    :meth:`arun_service`. Computes that implement it with
+    :func:`asyncio.create_subprocess_exec` (docker, singularity and
+    virtualenv) wait for the runner without a thread, so that hundreds of
+    services can run at once.
+
+    Returns
+    -------
+    object
+        What :meth:`arun_service` returned
+    '''
+
+    with service_timings.time('run') as timer:
+      service_info = self._load_service(service_class, timer)
+      skip, service_hash = self._check_completed('run', service_info, args,
+                                                 kwargs)
+      if skip:
+        return None
+      self._call_hook('pre_run', service_info, args, kwargs)
+
+      resources, policy = self._command_policy('run', service_info)
+      attempt = 1
+      while True:
+        try:
+          async with self.admission.async_admit(resources):
+            with phase('run'):
+              rv = await self.arun_service(service_info, *args, **kwargs)
+          break
+        except Exception as e:
+          delay = self._retry_delay(policy, service_info, e, attempt)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+      self._finish_command('run', service_info, service_hash, args, kwargs)
+      return rv
+
+  async def arun_service(self, service_info, *args, **kwargs):
+    '''
+    Run the service runner, for :meth:`arun`. By default, ``run_service`` is
+    run in a thread
+    '''
+
+    loop = asyncio.get_running_loop()
+    # In the same context, so phases are still timed
+    return await loop.run_in_executor(
+        None, functools.partial(contextvars.copy_context().run,
+                                self.run_service, service_info, *args,
+                                **kwargs))
+
+  def _run_in_context(self, service_class, *args, **kwargs):
+    with settings:
+      return self.run(service_class, *args, **kwargs)
+
+  def _get_service_executor(self):
+    with _service_executor_lock:
+      try:
+        return self._service_executor
+      except AttributeError:
+        from terra.executor.thread import ThreadPoolExecutor
+        max_workers = None
+        if settings.configured:
+          max_workers = settings.compute.get('max_concurrent', None)
+        self._service_executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='terra_service')
+        return self._service_executor
+
+  @property
+  def config_cache(self):
+    '''
+    :class:`terra.compute.utils.ConfigCache`: Cache of the compose ``config``
+    results, shared by all the services run by this compute
+    '''
+    # Created on first use, so that the settings are loaded by then
+    try:
+      return self._config_cache
+    except AttributeError:
+      self._config_cache = terra.compute.utils.ConfigCache.from_settings()
+      return self._config_cache
+
+  @property
+  def completed(self):
+    '''
+    :class:`terra.compute.checkpoint.CompletedServices`: The services that
+    completed, or ``None`` unless :option:`compute.skip_completed`
+    '''
+    try:
+      return self._completed
+    except AttributeError:
+      self._completed = \
+          terra.compute.checkpoint.CompletedServices.from_settings()
+      return self._completed
+
+  @property
+  def admission(self):
+    '''
+    :class:`terra.compute.resources.AdmissionController`: Limits the
+    resources of the services run at the same time by this compute
+    '''
+    # Locked, so that concurrent services share one controller
+    with _admission_lock:
+      try:
+        return self._admission
+      except AttributeError:
+        self._admission = \
+            terra.compute.resources.AdmissionController.from_settings()
+        return self._admission
+
+  @property
+  def pooled(self):
+    '''
+    bool: Whether services are run in long-lived containers, reused from run
+    to run. Only computes that support :option:`compute.pool` return ``True``
+    '''
+    return False
+
+  @property
+  def staging(self):
+    '''
+    bool: Whether services write their settings files to the
+    :attr:`staging_dir`, see :option:`compute.staging`
+    '''
+    return bool(settings.compute.get('staging', False))
+
+  @property
+  def staging_dir(self):
+    '''
+    str: A directory that lives as long as the compute, for the settings
+    files of staged and pooled services. On ``/dev/shm``, when there is one,
+    or where :option:`compute.staging` says. Mounted as ``/tmp_settings`` in
+    the containers of those services
+    '''
+    with _staging_lock:
+      try:
+        return self._staging_dir.name
+      except AttributeError:
+        parent = settings.compute.get('staging', None)
+        if not isinstance(parent, str):
+          parent = '/dev/shm'
+        if not (os.path.isdir(parent) and os.access(parent, os.W_OK)):
+          parent = None
+        self._staging_dir = TemporaryDirectory(prefix='terra_staging_',
+                                               dir=parent)
+        if os.environ.get('TERRA_KEEP_TEMP_DIR', None) == "1":
+          self._staging_dir._finalizer.detach()
+        return self._staging_dir.name
+
+  @property
+  def pool_dir(self):
+    '''
+    str: The :attr:`staging_dir`, where pooled services write their settings
+    files, and computes write the files they share between services
+    '''
+    return self.staging_dir
+
+  def get_pooled(self, key, start):
+    '''
+    Get a pooled container, starting it the first time it is asked for
+
+    Parameters
+    ----------
+    key : str
+        Identifies the container, e.g. by the configuration it is started with
+    start : :term:`function`
+        Called to start the container, and returns its name, or any other
+        handle to it
+
+    Returns
+    -------
+    object
+        What ``start`` returned
+    '''
+
+    # Only finding the container is locked, so that starting one container
+    # does not hold up the runs of others
+    with _pool_lock:
+      try:
+        pool = self._pool
+      except AttributeError:
+        pool = self._pool = {}
+        atexit.register(self.close)
+
+      future = pool.get(key, None)
+      starting = future is None
+      if starting:
+        future = pool[key] = Future()
+
+    if starting:
+      try:
+        future.set_result(start())
+      except BaseException as e:
+        # Let the next run try again
+        with _pool_lock:
+          if pool.get(key, None) is future:
+            del pool[key]
+        future.set_exception(e)
+        raise
+      logger.debug1(f'Started pooled container {future.result()}')
+    return future.result()
+
+  def stop_pooled(self, names):
+    '''
+    Stop and remove pooled containers, given what :meth:`get_pooled`'s
+    ``start`` returned for them. Implemented by computes that support
+    :option:`compute.pool`
+    '''
+    pass
+
+  def close(self):
+    '''
+    Stop the pooled containers, at the end of the workflow
+    '''
+
+    with _pool_lock:
+      try:
+        futures = list(self._pool.values())
+      except AttributeError:
+        return
+      self._pool.clear()
+
+    names = []
+    for future in futures:
+      # Containers that failed to start have nothing to stop
+      if future.exception() is None:
+        names.append(future.result())
+
+    if names:
+      logger.debug1(f'Stopping pooled containers {names}')
+      self.stop_pooled(names)
+
   def get_volume_map(self, config, service_info):
     return []
 
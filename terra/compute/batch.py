@@ -0,0 +1,189 @@
+'''
+Run a service over many inputs, with one launch of its runner
+
+:meth:`terra.compute.base.BaseCompute.run_batch` puts the inputs in the
+``batch`` setting, in the same settings file as the rest of the settings, and
+runs this module in place of the service's runner. It imports the runner
+module, and calls its ``main()`` once per input, each time in a settings
+context updated with the settings of that input:
+
+* an input that is a :class:`dict` is the settings of that input, e.g.
+  ``{'image_file': '/data/image1.tif'}``
+* any other input is set as ``input_path``
+
+Like any other settings, the paths of settings ending in ``_file``, ``_dir``,
+``_path``, etc. are translated for the container. ``batch.index`` is the index
+of the current input.
+
+The result of each input is written as a json line to a file next to the
+settings file (or to ``batch.results_file``), so that a failed input does not
+stop the others, and is reported back as a :class:`BatchResult`.
+
+The service's command must run its runner as a python module, e.g. ``python -m
+my.runner``. Command line arguments after the module are not passed to
+``main()``.
+'''
+
+import importlib
+import json
+import os
+import time
+import traceback
+from uuid import uuid4
+
+from terra import settings
+from terra.logger import getLogger
+logger = getLogger(__name__)
+
+__all__ = ['BatchResult', 'batch_command', 'results_filename']
+
+
+class BatchResult:
+  '''
+  The result of running a service on one input of a batch
+
+  Parameters
+  ----------
+  input : object
+      The input
+  returncode : int, optional
+      ``0`` if the input succeeded
+  error : str, optional
+      Why it failed
+  value : object, optional
+      What the runner's ``main()`` returned, as json
+  duration : float, optional
+      The seconds it took
+  '''
+
+  def __init__(self, input, returncode=None, error=None, value=None,
+               duration=None):
+    self.input = input
+    self.returncode = returncode
+    self.error = error
+    self.value = value
+    self.duration = duration
+
+  @property
+  def ok(self):
+    '''
+    bool: Whether the input succeeded
+    '''
+    return self.returncode == 0
+
+  def __repr__(self):
+    status = 'ok' if self.ok else f'failed: {self.error}'
+    return f'<BatchResult {self.input!r} {status}>'
+
+
+def batch_command(command):
+  '''
+  Get the command that runs the batch driver, from the command of a service
+
+  Returns
+  -------
+  tuple
+      The new command, and the name of the runner module
+
+  Raises
+  ------
+  ValueError
+      If ``command`` does not run a python module
+  '''
+
+  try:
+    index = command.index('-m')
+    module = command[index + 1]
+  except (ValueError, IndexError):
+    raise ValueError(f'Command {command} does not run a python module, '
+                     'which batches need') from None
+  return list(command[:index]) + ['-m', __name__], module
+
+
+def results_filename(settings_file, batch_id):
+  '''
+  str: The file the results of a batch are written to, next to its settings
+  file. Named after the batch, since settings files can be shared, see
+  :option:`compute.staging`
+  '''
+  return os.path.join(os.path.dirname(settings_file),
+                      f'batch_{batch_id}.results.jsonl')
+
+
+def batch_settings(runner, inputs):
+  '''
+  dict: The ``batch`` setting for a runner module and its inputs
+  '''
+  return {'runner': runner, 'id': uuid4().hex,
+          'inputs': [item if isinstance(item, dict) else {'input_path': item}
+                     for item in inputs]}
+
+
+def read_results(filename, inputs, error=None):
+  '''
+  Read the results of a batch
+
+  Parameters
+  ----------
+  filename : str
+      The results file
+  inputs : list
+      The inputs of the batch
+  error : str, optional
+      Why inputs without a result failed, e.g. the runner crashed
+
+  Returns
+  -------
+  list
+      A :class:`BatchResult` per input, in the same order
+  '''
+
+  results = [BatchResult(item, returncode=None,
+                         error=error or 'Not run') for item in inputs]
+  try:
+    with open(filename, 'r') as fid:
+      for line in fid:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # Cut short
+          continue
+        index = record.pop('index')
+        results[index] = BatchResult(inputs[index], **record)
+  except FileNotFoundError:
+    pass
+  return results
+
+
+def main(args=None):
+  batch = settings.batch
+  module = importlib.import_module(batch.runner)
+
+  filename = batch.get('results_file', None) or \
+      results_filename(os.environ['TERRA_SETTINGS_FILE'], batch.id)
+  with open(filename, 'w') as fid:
+    for index, item in enumerate(batch.inputs):
+      start = time.time()
+      record = {'index': index, 'returncode': 0}
+      try:
+        with settings:
+          settings.update(item)
+          settings.batch.index = index
+          record['value'] = module.main()
+      except SystemExit as e:
+        if e.code not in (None, 0):
+          record['returncode'] = e.code if isinstance(e.code, int) else 1
+          record['error'] = f'exited with {e.code}'
+      except Exception as e:
+        logger.error(f'Input {index} failed:\n{traceback.format_exc()}')
+        record['returncode'] = 1
+        record['error'] = repr(e)
+      record['duration'] = time.time() - start
+      fid.write(json.dumps(record, default=str) + '\n')
+      fid.flush()
+
+
+if __name__ == '__main__':  # pragma: no cover
+  from terra.utils.cli import ArgumentParser
+  ArgumentParser().parse_args()
+  main()
@@ -0,0 +1,317 @@
+'''
+Retries of failed services, and skipping services that already completed
+
+Retries
+-------
+
+A service run that fails with :class:`terra.compute.base.ServiceRunFailed` is
+retried according to its retry policy. The policy is
+:option:`compute.retry`, updated with the service's ``retry`` attribute, and
+then with the entry for the service in :option:`compute.service_retry`:
+
+* ``max_attempts``: how many times the service is run, at most. Default: ``1``
+* ``backoff``: the seconds to wait before the first retry. Default: ``0``
+* ``backoff_factor``: what the wait is multiplied by after every retry.
+  Default: ``2``
+* ``max_backoff``: the longest wait, in seconds. Default: no limit
+* ``exit_codes``: the return codes of the runner that are worth a retry.
+  Default: ``None``, any failure is retried
+
+Only the service runner is run again, the ``pre_run`` and ``post_run`` of the
+service are called once.
+
+Completed services
+------------------
+
+When :option:`compute.skip_completed` is ``True``, every service that runs
+successfully is recorded in ``completed_services.json`` in the
+:option:`processing_dir`, with a hash of its inputs. Running the workflow again
+skips the services whose hash is in there, so that a workflow resumes after
+the last service that completed. The hash covers:
+
+* the name of the service, and the arguments it is run with
+* the settings, except the ones that change from run to run (e.g.
+  ``terra.uuid`` and ``logging``)
+* the content of the files and directories listed in the service's ``inputs``
+  attribute
+
+A service whose output depends on anything else, e.g. files it does not list
+in its ``inputs``, is skipped when it should not be, so this is opt in.
+'''
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from terra import settings
+from terra.core.settings import TerraJSONEncoder
+from terra.logger import getLogger
+logger = getLogger(__name__)
+
+__all__ = ['RetryPolicy', 'CompletedServices', 'hash_path', 'service_hash']
+
+
+def _service_names(service_info):
+  cls = type(service_info)
+  return [f'{cls.__module__}.{cls.__qualname__}', cls.__qualname__]
+
+
+class RetryPolicy:
+  '''
+  When and how often a failed service is run again
+
+  Parameters
+  ----------
+  max_attempts : int, optional
+      The most times the service is run
+  backoff : float, optional
+      The seconds to wait before the first retry
+  backoff_factor : float, optional
+      What the wait is multiplied by after every retry
+  max_backoff : float, optional
+      The longest wait, in seconds
+  exit_codes : list, optional
+      The return codes worth a retry. ``None`` retries any failure
+  '''
+
+  def __init__(self, max_attempts=1, backoff=0, backoff_factor=2,
+               max_backoff=None, exit_codes=None):
+    self.max_attempts = max(int(max_attempts), 1)
+    self.backoff = backoff
+    self.backoff_factor = backoff_factor
+    self.max_backoff = max_backoff
+    self.exit_codes = None if exit_codes is None else set(exit_codes)
+
+  @classmethod
+  def from_settings(cls, service_info):
+    '''
+    Create the :class:`RetryPolicy` of a service, from
+    :option:`compute.retry`, the service's ``retry`` attribute and
+    :option:`compute.service_retry`
+    '''
+
+    policy = {}
+    service_retry = {}
+    if settings.configured:
+      policy.update(settings.compute.get('retry', None) or {})
+      service_retry = settings.compute.get('service_retry', None) or {}
+    policy.update(getattr(service_info, 'retry', None) or {})
+    for name in _service_names(service_info):
+      if name in service_retry:
+        policy.update(service_retry[name])
+        break
+    return cls(**policy)
+
+  def retryable(self, exception):
+    '''
+    bool: Whether a failure is worth a retry. Only
+    :class:`terra.compute.base.ServiceRunFailed` is; with ``exit_codes``, only
+    when its ``returncode`` is one of them
+    '''
+
+    from terra.compute.base import ServiceRunFailed
+    if not isinstance(exception, ServiceRunFailed):
+      return False
+    return self.exit_codes is None or \
+        getattr(exception, 'returncode', None) in self.exit_codes
+
+  def delay(self, attempt):
+    '''
+    float: The seconds to wait after the failure of ``attempt`` (starting at
+    ``1``)
+    '''
+
+    delay = self.backoff * self.backoff_factor ** (attempt - 1)
+    if self.max_backoff is not None:
+      delay = min(delay, self.max_backoff)
+    return delay
+
+  def retry_delay(self, name, exception, attempt):
+    '''
+    Decide what to do after a failed attempt
+
+    Returns
+    -------
+    float
+        The seconds to wait before the next attempt
+
+    Raises
+    ------
+    Exception
+        ``exception``, when the service should not be run again
+    '''
+
+    if attempt >= self.max_attempts or not self.retryable(exception):
+      raise exception
+    delay = self.delay(attempt)
+    logger.warning(f'{name} failed (attempt {attempt} of '
+                   f'{self.max_attempts}), retrying in {delay}s: {exception}')
+    return delay
+
+
+_hash_cache = {}
+_hash_lock = threading.Lock()
+
+
+def _hash_file(filename):
+  stat = os.stat(filename)
+  key = (filename, stat.st_size, stat.st_mtime_ns)
+  with _hash_lock:
+    if key in _hash_cache:
+      return _hash_cache[key]
+
+  digest = hashlib.sha256()
+  with open(filename, 'rb') as fid:
+    for chunk in iter(lambda: fid.read(1024 * 1024), b''):
+      digest.update(chunk)
+  digest = digest.hexdigest()
+
+  with _hash_lock:
+    _hash_cache[key] = digest
+  return digest
+
+
+def hash_path(path):
+  '''
+  Hash the content of a file, or of all the files in a directory (and their
+  names). Files are only read again once their size or modification time
+  changes
+
+  Returns
+  -------
+  str
+      The hex digest, or ``None`` if ``path`` does not exist
+  '''
+
+  if os.path.isfile(path):
+    return _hash_file(path)
+  if not os.path.isdir(path):
+    return None
+
+  digest = hashlib.sha256()
+  for root, dirs, files in os.walk(path):
+    dirs.sort()
+    for name in sorted(files):
+      filename = os.path.join(root, name)
+      digest.update(os.path.relpath(filename, path).encode())
+      digest.update(str(hash_path(filename)).encode())
+  return digest.hexdigest()
+
+
+_volatile_settings = ('terra', 'logging', 'status_file', 'resume',
+                      'service_start', 'service_end')
+
+
+def service_hash(service_info, args=(), kwargs={}):
+  '''
+  Hash what a service's result depends on: its name, the arguments it is run
+  with, the settings and its ``inputs``
+
+  Returns
+  -------
+  str
+      The hex digest
+  '''
+
+  state = dict(TerraJSONEncoder.serializableSettings(settings))
+  for key in _volatile_settings:
+    state.pop(key, None)
+  # Set by the pre_run of the last service, and so not known yet for this one
+  for section in ('executor', 'compute'):
+    state[section] = {key: value
+                      for key, value in state.get(section, {}).items()
+                      if key != 'volume_map'}
+
+  digest = hashlib.sha256()
+  digest.update(json.dumps(
+      {'service': _service_names(service_info)[0],
+       'args': repr(args), 'kwargs': repr(sorted(kwargs.items())),
+       'settings': state,
+       'inputs': {str(path): hash_path(os.fspath(path))
+                  for path in getattr(service_info, 'inputs', None) or []}},
+      sort_keys=True, default=str).encode())
+  return digest.hexdigest()
+
+
+class CompletedServices:
+  '''
+  The record of the services that completed, in ``completed_services.json``
+
+  Parameters
+  ----------
+  filename : str
+      The json file
+  '''
+
+  basename = 'completed_services.json'
+
+  def __init__(self, filename):
+    self.filename = filename
+    self._lock = threading.Lock()
+    self._completed = None
+
+  @classmethod
+  def from_settings(cls):
+    '''
+    Create a :class:`CompletedServices`, if :option:`compute.skip_completed`
+    is ``True``
+
+    Returns
+    -------
+    :class:`CompletedServices`
+        Or ``None``, if services are not skipped
+    '''
+
+    if not settings.configured or \
+       not settings.compute.get('skip_completed', False):
+      return None
+    return cls(os.path.join(settings.processing_dir, cls.basename))
+
+  def _load(self):
+    # Must be called with the lock held
+    if self._completed is None:
+      try:
+        with open(self.filename, 'r') as fid:
+          self._completed = json.load(fid)
+      except FileNotFoundError:
+        self._completed = {}
+      except (OSError, ValueError) as e:
+        logger.warning(f'Unable to read {self.filename}, no services will be '
+                       f'skipped: {e}')
+        self._completed = {}
+    return self._completed
+
+  def __contains__(self, service_hash):
+    with self._lock:
+      return service_hash in self._load()
+
+  def add(self, service_hash, service_info):
+    '''
+    Record that a service completed
+    '''
+
+    with self._lock:
+      completed = self._load()
+      completed[service_hash] = {'service': _service_names(service_info)[0],
+                                 'completed': time.time()}
+      # Written whole and then renamed, so an interrupted write does not lose
+      # the record
+      os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+      temp_filename = f'{self.filename}.{os.getpid()}.tmp'
+      with open(temp_filename, 'w') as fid:
+        json.dump(completed, fid, indent=2)
+      os.replace(temp_filename, self.filename)
+
+  def clear(self):
+    '''
+    Forget all the completed services, so they all run again
+    '''
+
+    with self._lock:
+      self._completed = {}
+      try:
+        os.remove(self.filename)
+      except FileNotFoundError:
+        pass
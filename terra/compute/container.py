@@ -3,18 +3,25 @@ import posixpath
 import ntpath
 import re
 import pathlib
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkstemp
 import json
 
 from terra import settings
 from terra.core.settings import TerraJSONEncoder
 from terra.compute import compute
-from terra.compute.utils import translate_settings_paths
+from terra.compute.utils import (
+  translate_settings_paths, write_hashed_file, run_in_background
+)
 from terra.compute.base import BaseService
+from terra.compute.volumes import VolumeSet, VolumeSlots
+from terra.compute.timing import phase
 from terra.logger import getLogger
 logger = getLogger(__name__)
 
 
+_duplicate_slashes = re.compile('//+')
+
+
 class ContainerService(BaseService):
   '''
   Base container service class
@@ -28,50 +35,69 @@ class ContainerService(BaseService):
     self.extra_compose_files = []
 
   def pre_run(self):
-    # Need to run Base's pre_run first, so it has a chance to update settings
-    # for special executors, etc...
-    super().pre_run()
-
-    self.temp_dir = TemporaryDirectory(suffix=f"_{type(self).__name__}")
-    if self.env.get('TERRA_KEEP_TEMP_DIR', None) == "1":
-      self.temp_dir._finalizer.detach()
-    temp_dir = pathlib.Path(self.temp_dir.name)
+    self.pooled = compute.pooled
+    self.staged = compute.staging
+    if self.staged:
+      # The settings file is named after its content, once it is known
+      temp_dir = pathlib.Path(compute.staging_dir)
+    elif self.pooled:
+      # Pooled containers are started once, with the same /tmp_settings for
+      # every run, so each run gets a settings file of its own in there
+      temp_dir = pathlib.Path(compute.pool_dir)
+      fid, self.settings_file = mkstemp(prefix=f'{type(self).__name__}_',
+                                        suffix='.json', dir=temp_dir)
+      os.close(fid)
+    else:
+      self.temp_dir = TemporaryDirectory(suffix=f"_{type(self).__name__}")
+      if self.env.get('TERRA_KEEP_TEMP_DIR', None) == "1":
+        self.temp_dir._finalizer.detach()
+      temp_dir = pathlib.Path(self.temp_dir.name)
+      self.settings_file = str(temp_dir / 'config.json')
 
-    # Check to see if and are already defined, this will play nicely with
-    # external influences
-    env_volume_index = 1
-    while f'{self.env["JUST_PROJECT_PREFIX"]}_VOLUME_{env_volume_index}' in \
-        self.env:
-      env_volume_index += 1
+    # Volume variables that are already defined are skipped, this will play
+    # nicely with external influences
+    slots = VolumeSlots(self.env, self.env["JUST_PROJECT_PREFIX"])
 
     # Setup volumes for container
-    self.env[f'{self.env["JUST_PROJECT_PREFIX"]}_'
-             f'VOLUME_{env_volume_index}'] = \
-        f'{str(temp_dir)}:/tmp_settings:rw'
-    env_volume_index += 1
-
-    # Copy self.volumes to the environment variables
-    for _, ((volume_host, volume_container), volume_flags) in \
-        enumerate(zip(self.volumes, self.volumes_flags)):
+    slots.assign(f'{str(temp_dir)}:/tmp_settings:rw')
+
+    # Copy self.volumes to the environment variables, without duplicates, or
+    # the volumes their parent volumes already mount
+    volumes = VolumeSet(
+        ((volume_host, volume_container, volume_flags)
+         for (volume_host, volume_container), volume_flags in
+         zip(self.volumes, self.volumes_flags)),
+        remote_path=ntpath if self.container_platform == "windows"
+        else posixpath)
+    for volume_host, volume_container, volume_flags in volumes.mounts():
       volume_str = f'{volume_host}:{volume_container}'
       if volume_flags:
         volume_str += f':{volume_flags}'
-      self.env[f'{self.env["JUST_PROJECT_PREFIX"]}_'
-               f'VOLUME_{env_volume_index}'] = \
-          volume_str
-      env_volume_index += 1
+      slots.assign(volume_str)
 
-    settings.compute.volume_map = compute.configuration_map(self)
-    logger.debug4("Compute Volume map: %s", settings.compute.volume_map)
+    # Setup config file for container. Set before the configuration_map, so
+    # the compose config is cached with the same environment the service is
+    # run with
+    self.env['TERRA_SETTINGS_FILE'] = '/tmp_settings/config.json'
 
-    # Setup config file for container
+    # The compute volume map (a compose config) is calculated in the
+    # background, while Base's pre_run calculates the executor volume map
+    # (another compose config, for special executors, etc...), and updates
+    # the settings
+    compute_volume_map = run_in_background(compute.configuration_map, self)
+    super().pre_run()
+    settings.compute.volume_map = compute_volume_map.result()
+    logger.debug4("Compute Volume map: %s", settings.compute.volume_map)
 
-    self.env['TERRA_SETTINGS_FILE'] = '/tmp_settings/config.json'
+    # Environment variables set by each exec into a pooled container (or
+    # each run of a staged service), instead of when the container is started
+    self.run_env = {}
 
-    container_config = translate_settings_paths(
-        TerraJSONEncoder.serializableSettings(settings),
-        settings.compute.volume_map,
-        self.container_platform)
+    with phase('serialize_settings'):
+      container_config = translate_settings_paths(
+          TerraJSONEncoder.serializableSettings(settings),
+          settings.compute.volume_map,
+          self.container_platform)
 
     if os.name == "nt":  # pragma: no linux cover
       # logger.warning("Windows volume mapping is experimental.")
@@ -82,14 +108,30 @@ class ContainerService(BaseService):
 
     # Dump the settings
     container_config['terra']['zone'] = 'runner'
-    with open(temp_dir / 'config.json', 'w') as fid:
-      json.dump(container_config, fid)
+    if self.staged:
+      # Services with the same settings share the same file
+      with phase('write_settings'):
+        self.settings_file = write_hashed_file(
+            temp_dir, 'settings_',
+            json.dumps(container_config, sort_keys=True), '.json')
+    else:
+      with phase('write_settings'), open(self.settings_file, 'w') as fid:
+        json.dump(container_config, fid)
+    if self.pooled or self.staged:
+      self.run_env['TERRA_SETTINGS_FILE'] = \
+          '/tmp_settings/' + os.path.basename(self.settings_file)
 
   def post_run(self):
     super().post_run()
     # Delete temp_dir
     if self.env.get('TERRA_KEEP_TEMP_DIR', None) != "1":
-      self.temp_dir.cleanup()
+      if self.staged:
+        # Shared with other services, removed with the staging directory
+        pass
+      elif self.pooled:
+        os.remove(self.settings_file)
+      else:
+        self.temp_dir.cleanup()
     # self.temp_dir = None # Causes a warning, hopefully there wasn't a reason
     # I did it this way.
 
@@ -122,7 +164,7 @@ class ContainerService(BaseService):
         # Convert to posix slashed
         remote = remote.replace('\\', '/')
         # Remove duplicates
-        remote = re.sub('//+', '/', remote)
+        remote = _duplicate_slashes.sub('/', remote)
         # Split drive letter off
         drive, remote = ntpath.splitdrive(remote)
         if drive:
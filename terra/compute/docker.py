@@ -1,13 +1,22 @@
 import os
+import asyncio
 from subprocess import PIPE
+from itertools import count
+import shlex
+import json
 import re
 
 import yaml
 
+from terra import settings
 from terra.utils.cli import extra_arguments
 from terra.compute.base import BaseCompute, ServiceRunFailed
 from terra.compute.container import ContainerService
-from terra.compute.utils import just
+from terra.compute.utils import (
+  just, ajust, ServiceOutput, write_hashed_file
+)
+from terra.compute.timing import phase
+from terra.compute.resources import service_resources, format_cpuset
 from terra.logger import getLogger
 logger = getLogger(__name__)
 
@@ -28,11 +37,27 @@ RE Groups
 '''
 
 
+_pool_names = count()
+
+
 class Compute(BaseCompute):
   '''
   Docker compute model, specifically ``docker-compose``
+
+  When :option:`compute.pool` is enabled, a service is run in a long-lived
+  container, started the first time the service is run, and every run execs
+  the service's command in it. The containers are removed by
+  :meth:`close<terra.compute.base.BaseCompute.close>`, at the end of the
+  workflow.
   '''
 
+  idle_command = ['tail', '-f', '/dev/null']
+  '''list: The entrypoint and arguments pooled containers are started with'''
+
+  @property
+  def pooled(self):
+    return bool(settings.compute.get('pool', False))
+
   def run_service(self, service_info):
     '''
     Use the service class information to run the service runner in a docker
@@ -44,19 +69,228 @@ class Compute(BaseCompute):
             -f {service_info.compose_files} ... \\
             run -T {service_info.compose_service_name} \\
             {service_info.command}
+
+    or when pooled, using
+
+    .. code-block:: bash
+
+        just --wrap docker exec -e {service_info.run_env} ... \\
+            {pooled container} {entrypoint} {service_info.command}
     '''
-    optional_args = {}
-    optional_args['justfile'] = getattr(service_info, 'justfile', None)
+    if getattr(service_info, 'pooled', False):
+      return self.run_pooled(service_info)
+
+    args, kwargs = self.run_command(service_info)
+    output = ServiceOutput.from_settings(service_info)
+    with phase('spawn'):
+      pid = just(*args, **kwargs, **output.popen_kwargs)
+    output.wait(pid)
+
+  def run_pooled(self, service_info):
+    '''
+    Run the service runner in a pooled container, starting one if there is
+    none for the service yet
+    '''
+
+    args, kwargs = self.pooled_command(service_info)
+    output = ServiceOutput.from_settings(service_info)
+    with phase('spawn'):
+      pid = just(*args, **kwargs, **output.popen_kwargs)
+    output.wait(pid)
+
+  async def arun_service(self, service_info):
+    '''
+    Same as :meth:`run_service`, using :func:`terra.compute.utils.ajust`
+    '''
+
+    if getattr(service_info, 'pooled', False):
+      # Starting the container is done in a thread, the first time
+      loop = asyncio.get_running_loop()
+      args, kwargs = await loop.run_in_executor(None, self.pooled_command,
+                                                service_info)
+    else:
+      args, kwargs = self.run_command(service_info)
+    output = ServiceOutput.from_settings(service_info)
+    with phase('spawn'):
+      process = await ajust(*args, **kwargs, **output.popen_kwargs)
+    await output.async_wait(process)
+
+  def run_command(self, service_info):
+    '''
+    The :func:`terra.compute.utils.just` arguments and keyword arguments that
+    run the service runner
+    '''
+
+    compose_files = self.run_compose_files(service_info)
+    # Per-run variables, like a staged TERRA_SETTINGS_FILE
+    env_args = sum([['-e', f'{key}={value}'] for key, value in
+                    getattr(service_info, 'run_env', {}).items()], [])
+    args = ("--wrap", "Just-docker-compose",
+            *sum([['-f', cf] for cf in compose_files], []),
+            'run', '-T', *env_args, service_info.compose_service_name,
+            *service_info.command + extra_arguments)
+    kwargs = {'justfile': getattr(service_info, 'justfile', None),
+              'env': service_info.env}
+    return args, kwargs
+
+  def pooled_command(self, service_info):
+    '''
+    The :func:`terra.compute.utils.just` arguments and keyword arguments that
+    run the service runner in its pooled container
+    '''
+
+    container, service_config = self.pool_container(service_info)
+
+    # The container was started with an idle entrypoint, so the service's
+    # entrypoint is run by the exec instead
+    entrypoint = service_config.get('entrypoint', None) or []
+    if isinstance(entrypoint, str):
+      entrypoint = shlex.split(entrypoint)
+
+    env_args = sum([['-e', f'{key}={value}'] for key, value in
+                    getattr(service_info, 'run_env', {}).items()], [])
+
+    args = ("--wrap", "docker", "exec", *env_args, container,
+            *entrypoint, *service_info.command + extra_arguments)
+    kwargs = {'justfile': getattr(service_info, 'justfile', None),
+              'env': service_info.env}
+    return args, kwargs
 
-    pid = just("--wrap", "Just-docker-compose",
-               *sum([['-f', cf] for cf in service_info.compose_files], []),
-               'run', '-T', service_info.compose_service_name,
-               *service_info.command + extra_arguments,
-               **optional_args,
-               env=service_info.env)
+  def pool_container(self, service_info):
+    '''
+    Get the pooled container for a service, starting it if needed
+
+    Containers are pooled by their compose configuration, so services that
+    differ in volumes or environment get their own container. They are started
+    with ``docker-compose run -d``, rather than ``up -d``, so that containers
+    of the same compose service with different configurations can run side by
+    side, sharing the project's networks and named volumes.
+
+    Returns
+    -------
+    str
+        The name of the container
+    dict
+        The service's section of the compose configuration
+    '''
+
+    config = self.config(service_info)
+    service_config = (config.get('services') or {}).get(
+        service_info.compose_service_name) or {}
+    compose_files = self.run_compose_files(service_info)
+    key = json.dumps([compose_files,
+                      getattr(service_info, 'justfile', None),
+                      service_info.compose_service_name,
+                      service_config], sort_keys=True, default=str)
+
+    def start():
+      container = f'terra_pool_{os.getpid()}_{next(_pool_names)}_' + \
+          service_info.compose_service_name
+      optional_args = {}
+      optional_args['justfile'] = getattr(service_info, 'justfile', None)
+      pid = just("--wrap", "Just-docker-compose",
+                 *sum([['-f', cf] for cf in compose_files], []),
+                 'run', '-d', '--name', container,
+                 '--entrypoint', self.idle_command[0],
+                 service_info.compose_service_name, *self.idle_command[1:],
+                 stdout=PIPE,
+                 **optional_args,
+                 env=service_info.env)
+      pid.communicate()
+      if pid.returncode != 0:
+        raise ServiceRunFailed(returncode=pid.returncode)
+      return container
+
+    return self.get_pooled(key, start), service_config
+
+  def run_compose_files(self, service_info):
+    '''
+    The compose files a service is run with: its ``compose_files``, plus an
+    override file that sets the ``cpus``, ``mem_limit`` and ``cpuset`` of the
+    service, if it requests resources (see :mod:`terra.compute.resources`)
+
+    The override file is named after its content, so services with the same
+    requests share it (and pooled containers).
+    '''
+
+    resources = service_resources(service_info)
+    if not resources:
+      return list(service_info.compose_files)
 
-    if pid.wait() != 0:
-      raise ServiceRunFailed()
+    limits = {}
+    if 'cpus' in resources:
+      limits['cpus'] = resources['cpus']
+    if 'memory' in resources:
+      limits['mem_limit'] = resources['memory']
+    if 'cpuset' in resources:
+      limits['cpuset'] = format_cpuset(resources['cpuset'])
+    override = {'services': {service_info.compose_service_name: limits}}
+    # Compose refuses to merge files of different versions
+    version = self.config(service_info).get('version')
+    if version:
+      override['version'] = str(version)
+
+    filename = write_hashed_file(
+        self.pool_dir, 'resources_',
+        yaml.dump(override, default_flow_style=False), '.yml')
+
+    return list(service_info.compose_files) + [filename]
+
+  def stop_pooled(self, names):
+    '''
+    Remove the pooled containers
+    '''
+    just("--wrap", "docker", "rm", "-f", *names, stdout=PIPE).communicate()
+
+  def prepare_tasks(self, service_info):
+    '''
+    Pull the image of a service, or build it when the service has a
+    ``build`` section, unless the image is already there
+
+    Keyed on the image, so services using the same image share the task
+    '''
+
+    config = self.config(service_info)
+    name = service_info.compose_service_name
+    service_config = (config.get('services') or {}).get(name) or {}
+    image = service_config.get('image')
+    justfile = getattr(service_info, 'justfile', None)
+
+    def image_exists():
+      pid = just("--wrap", "docker", "image", "inspect", image,
+                 stdout=PIPE, stderr=PIPE)
+      pid.communicate()
+      return pid.returncode == 0
+
+    def build():
+      if image and image_exists():
+        return
+      pid = just("--wrap", "Just-docker-compose",
+                 *sum([['-f', cf] for cf in service_info.compose_files], []),
+                 'build', name,
+                 stdout=PIPE,
+                 justfile=justfile,
+                 env=service_info.env)
+      pid.communicate()
+      if pid.returncode != 0:
+        raise ServiceRunFailed(f'Building {name} failed',
+                               returncode=pid.returncode)
+
+    def pull():
+      if image_exists():
+        return
+      pid = just("--wrap", "docker", "pull", image, stdout=PIPE)
+      pid.communicate()
+      if pid.returncode != 0:
+        raise ServiceRunFailed(f'Pulling {image} failed',
+                               returncode=pid.returncode)
+
+    if service_config.get('build'):
+      key = image or f'{name} ({", ".join(service_info.compose_files)})'
+      return {key: build}
+    if image:
+      return {image: pull}
+    return {}
 
   def config_service(self, service_info):
     '''
@@ -70,10 +304,18 @@ class Compute(BaseCompute):
         sum([['-f', cf] for cf in service_info.compose_files], []) + \
         ['config']
 
-    pid = just(*args, stdout=PIPE,
-               **optional_args,
-               env=service_info.env)
-    return yaml.load(pid.communicate()[0], Loader=yaml.Loader)
+    def config():
+      pid = just(*args, stdout=PIPE,
+                 **optional_args,
+                 env=service_info.env)
+      data = pid.communicate()[0]
+      # Raised, so that the failure is not cached
+      if pid.returncode != 0:
+        raise ServiceRunFailed('docker-compose config failed',
+                               returncode=pid.returncode)
+      return yaml.load(data, Loader=yaml.Loader)
+
+    return self.config_cache.get(args, service_info, config)
 
   def get_volume_map(self, config, service_info):
     # TODO: Make an OrderedDict
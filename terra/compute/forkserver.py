@@ -0,0 +1,191 @@
+'''
+A fork server, that keeps a warm python interpreter for the virtualenv compute
+
+The server is started with the python interpreter of a virtualenv, imports
+the modules it is told to preload, and then waits for run requests on a unix
+socket. Every request is run in a child process forked from the server, with
+the request's arguments, environment and working directory, the same as a new
+``python`` process started with those, minus the start up and import time. The
+exit code of the child is sent back when it exits.
+
+This file only uses the standard library, and is run as a script, so that it
+works in a virtualenv whether terra is installed in it or not.
+
+Protocol, one json object per line:
+
+* request: ``{"argv": [...], "env": {...}, "cwd": "..."}``, where ``argv`` is
+  the arguments to ``python``: ``-m module ...``, ``-c code ...`` or
+  ``script ...``. Optionally, ``"cpuset": [...]`` pins the child to CPUs and
+  ``"memory": bytes`` limits its address space
+* responses: ``{"pid": pid}`` once the child is started, then
+  ``{"returncode": code}`` when it exits. The code is negative if the child
+  was killed by a signal, the same as :attr:`subprocess.Popen.returncode`
+* ``{"shutdown": true}`` stops the server, after its children exit
+'''
+
+import argparse
+import importlib
+import json
+import os
+import runpy
+import selectors
+import signal
+import socket
+import sys
+import time
+import traceback
+
+
+def send(sock, message):
+  sock.sendall(json.dumps(message).encode() + b'\n')
+
+
+def recv(sock_file):
+  line = sock_file.readline()
+  if not line:
+    return None
+  return json.loads(line)
+
+
+def returncode(status):
+  '''
+  Convert a :func:`os.waitpid` status to a :class:`subprocess.Popen` style
+  return code
+  '''
+
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+  return os.WEXITSTATUS(status)
+
+
+def run_child(request):
+  '''
+  Run a request, in the forked child. Never returns
+  '''
+
+  code = 1
+  try:
+    if request.get('cpuset'):
+      os.sched_setaffinity(0, request['cpuset'])
+    if request.get('memory'):
+      import resource
+      resource.setrlimit(resource.RLIMIT_AS,
+                         (request['memory'], request['memory']))
+
+    os.environ.clear()
+    os.environ.update(request['env'])
+    os.chdir(request['cwd'])
+    argv = request['argv']
+
+    if argv[0] == '-m':
+      sys.argv = argv[1:]
+      sys.path[0] = os.getcwd()
+      runpy.run_module(argv[1], run_name='__main__', alter_sys=True)
+    elif argv[0] == '-c':
+      sys.argv = ['-c'] + argv[2:]
+      sys.path[0] = ''
+      exec(compile(argv[1], '<string>', 'exec'), {'__name__': '__main__'})
+    else:
+      sys.argv = argv
+      sys.path[0] = os.path.dirname(os.path.abspath(argv[0]))
+      runpy.run_path(argv[0], run_name='__main__')
+    code = 0
+  except SystemExit as e:
+    if e.code is None:
+      code = 0
+    elif isinstance(e.code, int):
+      code = e.code
+    else:
+      print(e.code, file=sys.stderr)
+      code = 1
+  except BaseException:
+    traceback.print_exc()
+  finally:
+    try:
+      sys.stdout.flush()
+      sys.stderr.flush()
+    finally:
+      os._exit(code)
+
+
+def serve(listener):
+  '''
+  Serve run requests on a listening unix socket, until a shutdown request
+  '''
+
+  selector = selectors.DefaultSelector()
+  selector.register(listener, selectors.EVENT_READ)
+  children = {}
+  shutdown = False
+  parent = os.getppid()
+
+  while not shutdown or children:
+    if not shutdown and selector.select(timeout=0.05):
+      conn, _ = listener.accept()
+      with conn.makefile('rb') as conn_file:
+        request = recv(conn_file)
+      if request is None:
+        conn.close()
+      elif request.get('shutdown'):
+        shutdown = True
+        conn.close()
+      else:
+        pid = os.fork()
+        if pid == 0:
+          selector.close()
+          listener.close()
+          for other in children.values():
+            other.close()
+          conn.close()
+          signal.signal(signal.SIGINT, signal.default_int_handler)
+          run_child(request)
+        children[pid] = conn
+        send(conn, {'pid': pid})
+    elif shutdown:
+      time.sleep(0.05)
+
+    # Reap the children that exited
+    while children:
+      pid, status = os.waitpid(-1, os.WNOHANG)
+      if pid == 0:
+        break
+      conn = children.pop(pid, None)
+      if conn is not None:
+        try:
+          send(conn, {'returncode': returncode(status)})
+        except OSError:
+          pass
+        conn.close()
+
+    # Don't outlive the compute that started the server
+    if os.getppid() != parent:
+      shutdown = True
+
+  selector.close()
+  listener.close()
+
+
+def main(args=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+  parser.add_argument('--fd', type=int, required=True,
+                      help='File descriptor of the listening unix socket')
+  parser.add_argument('preload', nargs='*', help='Modules to import')
+  args = parser.parse_args(args)
+
+  # Like "python -m", instead of the directory of this script
+  sys.path[0] = os.getcwd()
+
+  listener = socket.socket(fileno=args.fd)
+
+  for module in args.preload:
+    try:
+      importlib.import_module(module)
+    except Exception:
+      print(f'Unable to preload {module}:', file=sys.stderr)
+      traceback.print_exc()
+
+  serve(listener)
+
+
+if __name__ == '__main__':  # pragma: no cover
+  main()
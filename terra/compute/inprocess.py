@@ -0,0 +1,72 @@
+import importlib
+
+from terra import settings
+from terra.compute.base import BaseService, BaseCompute, ServiceRunFailed
+from terra.logger import getLogger
+logger = getLogger(__name__)
+
+
+class Compute(BaseCompute):
+  '''
+  In process computing model, that runs the service runners in the controller
+  itself, instead of starting a process for them
+
+  The runner module named by the service's ``command``, e.g. ``python -m
+  terra.tests.demo.runners.demo2``, is imported, and its ``main()`` is called
+  in a settings context set to the ``runner`` zone. There is no process to
+  start, no settings file to write, and the runner logs straight to the
+  controller's logger. Meant for development and testing on small inputs; the
+  runner shares the controller's python, modules and working directory, and
+  command line arguments are not passed to ``main()``.
+  '''
+
+  @staticmethod
+  def runner_module(command):
+    '''
+    Get the name of the module a ``python -m module`` command runs
+
+    Raises
+    ------
+    ValueError
+        If ``command`` does not run a module
+    '''
+
+    try:
+      return command[command.index('-m') + 1]
+    except (ValueError, IndexError):
+      raise ValueError(f'Command {command} does not run a python module, '
+                       'which the inprocess compute needs') from None
+
+  def run_service(self, service_info):
+    '''
+    Import the service's runner module, and call its ``main()``
+    '''
+
+    module_name = self.runner_module(service_info.command)
+    logger.debug(f'Running in process: {module_name}')
+
+    with settings:
+      settings.terra.zone = 'runner'
+      try:
+        module = importlib.import_module(module_name)
+        module.main()
+      except SystemExit as e:
+        if e.code not in (None, 0):
+          raise ServiceRunFailed(
+              f'{module_name} exited with {e.code}',
+              returncode=e.code if isinstance(e.code, int) else 1) from e
+      except Exception as e:
+        raise ServiceRunFailed(f'{module_name} failed: {e!r}') from e
+
+  @staticmethod
+  def reconfigure_logger(sender, **kwargs):
+    # The runners use the controller's logger, so there is no socket handler
+    # to reconnect
+    if settings.terra.zone != 'runner':
+      BaseCompute.reconfigure_logger(sender, **kwargs)
+
+
+class Service(BaseService):
+  '''
+  In process service class
+  '''
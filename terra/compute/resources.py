@@ -0,0 +1,319 @@
+'''
+Resource requests of services, and the admission of concurrent services
+
+A service requests resources with its ``resources`` attribute, on top of the
+defaults in :option:`compute.resources`:
+
+* ``cpus``: the number of CPUs the service may use, e.g. ``1.5``
+* ``memory``: the most memory the service may use, in bytes, or as a string
+  with a ``k``, ``m``, ``g`` or ``t`` suffix, e.g. ``'4g'``
+* ``cpuset``: the CPUs the service is pinned to, as a list, or a string like
+  ``'0-3,6'``
+
+Each compute enforces the requests in its own way, and the
+:class:`AdmissionController` of the compute holds back services that would
+oversubscribe the host while other services are running.
+'''
+
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import os
+import threading
+
+from terra import settings
+from terra.compute.timing import phase
+from terra.logger import getLogger
+logger = getLogger(__name__)
+
+__all__ = ['parse_memory', 'parse_cpuset', 'format_cpuset',
+           'service_resources', 'limit_process', 'AdmissionController']
+
+
+_memory_units = {'b': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3,
+                 't': 1024**4}
+
+
+def parse_memory(value):
+  '''
+  Parse a memory size, e.g. ``'512m'`` or ``'4G'``, to a number of bytes
+
+  Raises
+  ------
+  ValueError
+      If the size can't be parsed
+  '''
+
+  if isinstance(value, (int, float)):
+    return int(value)
+
+  text = value.strip().lower()
+  if text.endswith('b') and len(text) > 1 and text[-2] in _memory_units:
+    # 4gb
+    text = text[:-1]
+  unit = 1
+  if text and text[-1] in _memory_units:
+    unit = _memory_units[text[-1]]
+    text = text[:-1]
+  try:
+    return int(float(text) * unit)
+  except ValueError:
+    raise ValueError(f'Invalid memory size {value!r}') from None
+
+
+def parse_cpuset(value):
+  '''
+  Parse a set of CPUs, e.g. ``'0-3,6'`` or ``[0, 1, 2]``
+
+  Returns
+  -------
+  list
+      The sorted CPU numbers
+  '''
+
+  if isinstance(value, int):
+    return [value]
+  if not isinstance(value, str):
+    return sorted(set(int(cpu) for cpu in value))
+
+  cpus = set()
+  for part in value.split(','):
+    part = part.strip()
+    if not part:
+      continue
+    try:
+      if '-' in part:
+        first, last = part.split('-')
+        cpus.update(range(int(first), int(last) + 1))
+      else:
+        cpus.add(int(part))
+    except ValueError:
+      raise ValueError(f'Invalid cpuset {value!r}') from None
+  return sorted(cpus)
+
+
+def format_cpuset(cpus):
+  '''
+  Format a list of CPUs the way docker and cgroups expect them, e.g. ``0,1,2``
+  '''
+
+  return ','.join(str(cpu) for cpu in cpus)
+
+
+def service_resources(service_info):
+  '''
+  Get the resources requested by a service
+
+  The service's ``resources`` are applied on top of
+  :option:`compute.resources`.
+
+  Returns
+  -------
+  dict
+      The normalized request, with any of the ``cpus`` (float), ``memory``
+      (int, in bytes) and ``cpuset`` (list of int) keys. Empty if nothing is
+      requested
+  '''
+
+  requested = {}
+  if settings.configured:
+    requested.update(settings.compute.get('resources', None) or {})
+  requested.update(getattr(service_info, 'resources', None) or {})
+
+  resources = {}
+  if requested.get('cpus') is not None:
+    resources['cpus'] = float(requested['cpus'])
+  if requested.get('memory') is not None:
+    resources['memory'] = parse_memory(requested['memory'])
+  if requested.get('cpuset') is not None:
+    resources['cpuset'] = parse_cpuset(requested['cpuset'])
+  return resources
+
+
+def limit_process(pid, resources):
+  '''
+  Apply resource requests to a running process, where the platform supports
+  it: ``cpuset`` with :func:`os.sched_setaffinity`, and ``memory`` with an
+  ``RLIMIT_AS`` limit. ``cpus`` can't be enforced on a single process, and is
+  only used for admission.
+
+  Processes started by ``pid`` before the limits are applied do not get them,
+  so this should be called right after the process is started.
+  '''
+
+  try:
+    if 'cpuset' in resources and hasattr(os, 'sched_setaffinity'):
+      os.sched_setaffinity(pid, resources['cpuset'])
+    if 'memory' in resources:
+      try:
+        import resource
+        resource.prlimit(pid, resource.RLIMIT_AS,
+                         (resources['memory'], resources['memory']))
+      except (ImportError, AttributeError):  # pragma: no cover
+        logger.debug1('Memory limits are not supported on this platform')
+  except ProcessLookupError:
+    # Already done
+    pass
+
+
+def host_memory():
+  '''
+  int: The physical memory of the host, in bytes, or ``None`` if unknown
+  '''
+
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  except (AttributeError, ValueError, OSError):  # pragma: no cover
+    return None
+
+
+class AdmissionController:
+  '''
+  Keeps services that run at the same time within the resources of the host
+
+  A service is admitted when its ``cpus`` and ``memory`` fit in what the
+  running services leave, and none of its ``cpuset`` CPUs are pinned by a
+  running service. Otherwise it waits for running services to finish. A
+  service that requests more than the host has is admitted once nothing else
+  is running, rather than never. Services that request nothing are always
+  admitted.
+
+  Parameters
+  ----------
+  cpus : float, optional
+      The CPUs available. Default: the number of CPUs of the host
+  memory : int, optional
+      The memory available, in bytes. Default: the memory of the host
+  '''
+
+  def __init__(self, cpus=None, memory=None):
+    self.cpus = cpus or os.cpu_count() or 1
+    self.memory = memory or host_memory()
+    self.used_cpus = 0
+    self.used_memory = 0
+    self.pinned = set()
+    self.running = 0
+    self._condition = threading.Condition()
+
+  @classmethod
+  def from_settings(cls):
+    '''
+    Create an :class:`AdmissionController` limited to
+    :option:`compute.max_cpus` and :option:`compute.max_memory`
+    '''
+
+    cpus = None
+    memory = None
+    if settings.configured:
+      cpus = settings.compute.get('max_cpus', None)
+      memory = settings.compute.get('max_memory', None)
+    if memory is not None:
+      memory = parse_memory(memory)
+    return cls(cpus, memory)
+
+  @staticmethod
+  def _needs(resources):
+    cpuset = set(resources.get('cpuset', ()))
+    cpus = resources.get('cpus', len(cpuset))
+    return cpus, resources.get('memory', 0), cpuset
+
+  def _fits(self, cpus, memory, cpuset):
+    if self.running == 0:
+      return True
+    if self.used_cpus + cpus > self.cpus:
+      return False
+    if self.memory is not None and self.used_memory + memory > self.memory:
+      return False
+    return not cpuset & self.pinned
+
+  def _reserve(self, cpus, memory, cpuset):
+    # Must be called with the condition held
+    self.used_cpus += cpus
+    self.used_memory += memory
+    self.pinned |= cpuset
+    self.running += 1
+
+  def acquire(self, resources):
+    '''
+    Wait until the resources are available, and reserve them
+    '''
+
+    cpus, memory, cpuset = self._needs(resources)
+    with self._condition:
+      if not self._fits(cpus, memory, cpuset):
+        logger.debug1(f'Waiting for resources {resources}')
+        self._condition.wait_for(lambda: self._fits(cpus, memory, cpuset))
+      self._reserve(cpus, memory, cpuset)
+
+  def try_acquire(self, resources):
+    '''
+    Reserve the resources if they are available, without waiting
+
+    Returns
+    -------
+    bool
+        Whether the resources were reserved
+    '''
+
+    cpus, memory, cpuset = self._needs(resources)
+    with self._condition:
+      if not self._fits(cpus, memory, cpuset):
+        return False
+      self._reserve(cpus, memory, cpuset)
+      return True
+
+  async def async_acquire(self, resources, poll=0.05):
+    '''
+    Same as :meth:`acquire`, but waits without blocking the event loop
+    '''
+
+    if not self.try_acquire(resources):
+      logger.debug1(f'Waiting for resources {resources}')
+      while not self.try_acquire(resources):
+        await asyncio.sleep(poll)
+
+  def release(self, resources):
+    '''
+    Return resources reserved by :meth:`acquire`
+    '''
+
+    cpus, memory, cpuset = self._needs(resources)
+    with self._condition:
+      self.used_cpus -= cpus
+      self.used_memory -= memory
+      self.pinned -= cpuset
+      self.running -= 1
+      self._condition.notify_all()
+
+  @contextmanager
+  def admit(self, resources):
+    '''
+    Context manager that reserves the resources while a service runs
+    '''
+
+    if not resources:
+      yield
+      return
+
+    with phase('admission'):
+      self.acquire(resources)
+    try:
+      yield
+    finally:
+      self.release(resources)
+
+  @asynccontextmanager
+  async def async_admit(self, resources):
+    '''
+    Same as :meth:`admit`, but waits without blocking the event loop
+    '''
+
+    if not resources:
+      yield
+      return
+
+    with phase('admission'):
+      await self.async_acquire(resources)
+    try:
+      yield
+    finally:
+      self.release(resources)
@@ -1,16 +1,42 @@
 import os
+import asyncio
 from subprocess import PIPE
+from itertools import count
+import json
+from shlex import quote
 
+from terra import settings
 from terra.compute.base import BaseCompute
 from terra.compute.container import ContainerService
-from terra.compute.utils import just
+from terra.compute.utils import (
+  just, ajust, ServiceOutput, write_hashed_file
+)
+from terra.compute.timing import phase
 from terra.compute.base import ServiceRunFailed
+from terra.compute.resources import service_resources, format_cpuset
 
 from terra.logger import getLogger
 logger = getLogger(__name__)
 
 
+_instance_names = count()
+
+
 class Compute(BaseCompute):
+  '''
+  Singularity compute model, using ``singular-compose``
+
+  When :option:`compute.pool` is enabled, a Singularity instance is started
+  the first time a service is run, and every run of the service uses
+  ``singularity exec`` on the instance. The instances are stopped by
+  :meth:`close<terra.compute.base.BaseCompute.close>`, at the end of the
+  workflow.
+  '''
+
+  @property
+  def pooled(self):
+    return bool(settings.compute.get('pool', False))
+
   def run_service(self, service_info):
     '''
     Use the service class information to run the service runner in a docker
@@ -21,15 +47,204 @@ class Compute(BaseCompute):
         just --wrap singular-compose \\
             run {service_info.compose_service_name} \\
             {service_info.command}
+
+    or when pooled, using
+
+    .. code-block:: bash
+
+        just --wrap singularity exec instance://{instance} \\
+            {service_info.command}
+    '''
+    if getattr(service_info, 'pooled', False):
+      return self.run_pooled(service_info)
+
+    args, kwargs = self.run_command(service_info)
+    output = ServiceOutput.from_settings(service_info)
+    with phase('spawn'):
+      pid = just(*args, **kwargs, **output.popen_kwargs)
+    output.wait(pid)
+
+  def run_pooled(self, service_info):
+    '''
+    Run the service runner in the service's Singularity instance, starting it
+    if it is not running yet
+    '''
+
+    args, kwargs = self.pooled_command(service_info)
+    output = ServiceOutput.from_settings(service_info)
+    with phase('spawn'):
+      pid = just(*args, **kwargs, **output.popen_kwargs)
+    output.wait(pid)
+
+  async def arun_service(self, service_info):
+    '''
+    Same as :meth:`run_service`, using :func:`terra.compute.utils.ajust`
+    '''
+
+    if getattr(service_info, 'pooled', False):
+      # Starting the instance is done in a thread, the first time
+      loop = asyncio.get_running_loop()
+      args, kwargs = await loop.run_in_executor(None, self.pooled_command,
+                                                service_info)
+    else:
+      args, kwargs = self.run_command(service_info)
+    output = ServiceOutput.from_settings(service_info)
+    with phase('spawn'):
+      process = await ajust(*args, **kwargs, **output.popen_kwargs)
+    await output.async_wait(process)
+
+  def run_command(self, service_info):
+    '''
+    The :func:`terra.compute.utils.just` arguments and keyword arguments that
+    run the service runner
+    '''
+
+    compose_files = self.run_compose_files(service_info)
+    args = ("singular-compose",
+            *sum([['-f', cf] for cf in compose_files], []),
+            'run', service_info.compose_service_name,
+            *service_info.command)
+    # Per-run variables, like a staged TERRA_SETTINGS_FILE
+    env = service_info.env
+    run_env = getattr(service_info, 'run_env', {})
+    if run_env:
+      env = env.copy()
+      for key, value in run_env.items():
+        env[f'SINGULARITYENV_{key}'] = value
+    return args, {'env': env}
+
+  def pooled_command(self, service_info):
+    '''
+    The :func:`terra.compute.utils.just` arguments and keyword arguments that
+    run the service runner in its Singularity instance
+    '''
+
+    config = self.config(service_info)
+    instance = self.pool_instance(service_info, config)
+
+    # The environment is set per exec, so that per-run variables, like
+    # TERRA_SETTINGS_FILE, apply
+    env = service_info.env.copy()
+    environment = dict(config.get('environment', {}))
+    environment.update(getattr(service_info, 'run_env', {}))
+    for key, value in environment.items():
+      env[f'SINGULARITYENV_{key}'] = value
+
+    args = ("--wrap", "singularity", "exec", f'instance://{instance}',
+            *service_info.command)
+    return args, {'env': env}
+
+  def pool_instance(self, service_info, config):
     '''
-    pid = just("singular-compose",
-               *sum([['-f', cf] for cf in service_info.compose_files], []),
-               'run', service_info.compose_service_name,
-               *service_info.command,
-               env=service_info.env)
+    Get the Singularity instance of a service, starting it if needed
 
-    if pid.wait() != 0:
-      raise ServiceRunFailed()
+    The instance is started with the image, volumes and flags of the
+    service's (cached) ``config-null`` output. There is one instance per
+    ``compose_service_name``, unless the service's volumes change between
+    runs, in which case those runs get an instance of their own.
+
+    Returns
+    -------
+    str
+        The name of the instance
+    '''
+
+    image = config.get('image', [None])[0]
+    if not image:
+      raise ValueError(f'No image found for service '
+                       f'{service_info.compose_service_name}, needed to start '
+                       'an instance')
+    volumes = config.get('volumes', [])
+    flags = config.get('singularity_flags', []) + \
+        self.resource_flags(service_resources(service_info))
+    key = json.dumps([service_info.compose_files,
+                      service_info.compose_service_name,
+                      image, volumes, flags])
+
+    def start():
+      instance = f'terra_{os.getpid()}_{next(_instance_names)}_' + \
+          service_info.compose_service_name
+      pid = just("--wrap", "singularity", "instance", "start", *flags,
+                 *sum([['-B', volume] for volume in volumes], []),
+                 image, instance,
+                 stdout=PIPE,
+                 env=service_info.env)
+      pid.communicate()
+      if pid.returncode != 0:
+        raise ServiceRunFailed(returncode=pid.returncode)
+      return instance
+
+    return self.get_pooled(key, start)
+
+  @staticmethod
+  def resource_flags(resources):
+    '''
+    The ``singularity`` flags that apply resource requests (see
+    :mod:`terra.compute.resources`) using cgroups
+    '''
+
+    flags = []
+    if 'cpus' in resources:
+      flags += ['--cpus', str(resources['cpus'])]
+    if 'memory' in resources:
+      flags += ['--memory', str(resources['memory'])]
+    if 'cpuset' in resources:
+      flags += ['--cpuset-cpus', format_cpuset(resources['cpuset'])]
+    return flags
+
+  def run_compose_files(self, service_info):
+    '''
+    The singular compose files a service is run with: its ``compose_files``,
+    plus a file that adds :meth:`resource_flags` to the service's
+    ``singularity_flags``, if it requests resources
+
+    The added file is named after its content, so services with the same
+    requests share it.
+    '''
+
+    flags = self.resource_flags(service_resources(service_info))
+    if not flags:
+      return list(service_info.compose_files)
+
+    content = f'{service_info.compose_service_name}_singularity_flags+=(' + \
+        ' '.join(quote(flag) for flag in flags) + ')\n'
+    filename = write_hashed_file(self.pool_dir, 'resources_', content, '.env')
+
+    return list(service_info.compose_files) + [filename]
+
+  def stop_pooled(self, names):
+    '''
+    Stop the Singularity instances
+    '''
+    for name in names:
+      just("--wrap", "singularity", "instance", "stop", name,
+           stdout=PIPE).communicate()
+
+  def prepare_tasks(self, service_info):
+    '''
+    Convert the image of a service to a SIF file in Singularity's cache, when
+    the image is a URI (e.g. ``docker://``), so that its first run does not
+    have to. Local images need nothing done
+
+    Keyed on the image, so services using the same image share the task
+    '''
+
+    config = self.config(service_info)
+    image = config.get('image', [None])[0]
+    if not image or '://' not in image or image.startswith('instance://'):
+      return {}
+
+    def convert():
+      # Running anything in the image pulls it, and caches the SIF file
+      pid = just("--wrap", "singularity", "exec", image, "true",
+                 stdout=PIPE,
+                 env=service_info.env)
+      pid.communicate()
+      if pid.returncode != 0:
+        raise ServiceRunFailed(f'Converting {image} failed',
+                               returncode=pid.returncode)
+
+    return {image: convert}
 
   def config_service(self, service_info):
     '''
@@ -43,23 +258,30 @@ class Compute(BaseCompute):
         sum([['-f', cf] for cf in service_info.compose_files], []) + \
         ['config-null', service_info.compose_service_name]
 
-    pid = just(*args, stdout=PIPE,
-               **optional_args,
-               env=service_info.env)
-    data = pid.communicate()[0]
-
-    # Split all the groups by the "header" word, null+^
-    data = data.split(b'\0^')
-    data = dict(zip([header.decode() for header in data[::2]],
-                    # Split all the data up "data" word, null+.
-                    [[chunk.decode() for chunk in group.split(b'\0.')]
-                     for group in data[1::2]]))
-    if 'environment' in data:
-      # Environment is special, it comes in key/value pairs, zip em up.
-      data['environment'] = dict(zip(data['environment'][::2],
-                                     data['environment'][1::2]))
-
-    return data
+    def config():
+      pid = just(*args, stdout=PIPE,
+                 **optional_args,
+                 env=service_info.env)
+      data = pid.communicate()[0]
+      # Raised, so that the failure is not cached
+      if pid.returncode != 0:
+        raise ServiceRunFailed('singular-compose config-null failed',
+                               returncode=pid.returncode)
+
+      # Split all the groups by the "header" word, null+^
+      data = data.split(b'\0^')
+      data = dict(zip([header.decode() for header in data[::2]],
+                      # Split all the data up "data" word, null+.
+                      [[chunk.decode() for chunk in group.split(b'\0.')]
+                       for group in data[1::2]]))
+      if 'environment' in data:
+        # Environment is special, it comes in key/value pairs, zip em up.
+        data['environment'] = dict(zip(data['environment'][::2],
+                                       data['environment'][1::2]))
+
+      return data
+
+    return self.config_cache.get(args, service_info, config)
 
   def get_volume_map(self, config, service_info):
 
@@ -0,0 +1,196 @@
+'''
+Timings of the phases of service commands
+
+Every command run through a compute (e.g. ``compute.run``) is timed, phase by
+phase: ``load_service``, ``pre_run``, ``admission`` (waiting for the requested
+resources), the command itself (e.g. ``run``) and ``post_run``. Code run during a command adds finer phases with :func:`phase`,
+such as ``executor_configuration_map``, ``configuration_map``,
+``serialize_settings``, ``write_settings`` and ``spawn``. Those are also
+included in the phase they happen in, e.g. ``configuration_map`` is part of
+``pre_run``.
+
+The totals are kept in memory, and a summary is logged at the end of a
+workflow. When :option:`compute.service_timings` is ``True``, each command is
+also appended as a json line to ``service_timings.jsonl`` in the
+:option:`processing_dir`.
+'''
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import os
+import threading
+import time
+
+from terra import settings
+from terra.logger import getLogger
+logger = getLogger(__name__)
+
+__all__ = ['ServiceTimer', 'ServiceTimings', 'phase', 'service_timings']
+
+
+_current_timer = ContextVar('terra_service_timer', default=None)
+
+
+class ServiceTimer:
+  '''
+  The timings of one service command
+
+  Parameters
+  ----------
+  command : str
+      The name of the command, e.g. ``run``
+  '''
+
+  def __init__(self, command):
+    self.command = command
+    self.service = None
+    self.start = time.time()
+    self._start = time.perf_counter()
+    self.duration = None
+    self.phases = {}
+    self.failed = False
+
+  @contextmanager
+  def phase(self, name):
+    '''
+    Context manager that adds the time spent in it to a phase. Phases that
+    happen more than once add up
+    '''
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.phases[name] = self.phases.get(name, 0) + \
+          time.perf_counter() - start
+
+  def stop(self):
+    self.duration = time.perf_counter() - self._start
+
+  def record(self):
+    '''
+    dict: The timings, as written to ``service_timings.jsonl``
+    '''
+    return {'service': self.service, 'command': self.command,
+            'start': self.start, 'duration': self.duration,
+            'failed': self.failed, 'phases': self.phases}
+
+
+@contextmanager
+def phase(name):
+  '''
+  Time a phase of the service command currently running in this thread (or
+  asyncio task). Does nothing when there is none
+  '''
+
+  timer = _current_timer.get()
+  if timer is None:
+    yield
+  else:
+    with timer.phase(name):
+      yield
+
+
+class ServiceTimings:
+  '''
+  Collects the :class:`ServiceTimer` of every service command, writes them to
+  the ``service_timings.jsonl`` file, and sums them up for the summary
+  '''
+
+  filename = 'service_timings.jsonl'
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.totals = {}
+    '''dict: ``{(command, phase): [count, total seconds]}``'''
+
+  @contextmanager
+  def time(self, command):
+    '''
+    Context manager that times a service command. A command run while another
+    one is being timed, e.g. ``compute.configuration_map`` in a service's
+    ``pre_run``, is timed as a phase of the outer command instead
+
+    Yields
+    ------
+    :class:`ServiceTimer`
+        The timer, or ``None`` for an inner command
+    '''
+
+    outer = _current_timer.get()
+    if outer is not None:
+      with outer.phase(command):
+        yield None
+      return
+
+    timer = ServiceTimer(command)
+    token = _current_timer.set(timer)
+    try:
+      yield timer
+    except BaseException:
+      timer.failed = True
+      raise
+    finally:
+      _current_timer.reset(token)
+      timer.stop()
+      self.add(timer)
+
+  def add(self, timer):
+    '''
+    Add the timings of a finished command
+    '''
+
+    record = timer.record()
+    with self._lock:
+      for name, duration in [('total', timer.duration)] + \
+          list(timer.phases.items()):
+        total = self.totals.setdefault((timer.command, name), [0, 0.0])
+        total[0] += 1
+        total[1] += duration
+
+      if not settings.configured or \
+         not settings.compute.get('service_timings', False):
+        return
+      try:
+        os.makedirs(settings.processing_dir, exist_ok=True)
+        with open(os.path.join(settings.processing_dir, self.filename),
+                  'a') as fid:
+          fid.write(json.dumps(record) + '\n')
+      except (OSError, TypeError, ValueError) as e:
+        logger.debug1(f'Unable to write service timings: {e}')
+
+  def summary(self):
+    '''
+    Returns
+    -------
+    str
+        A table of the count, total and mean duration of each phase, per
+        command
+    '''
+
+    with self._lock:
+      totals = sorted(self.totals.items())
+    lines = [f'{"command":<12} {"phase":<28} {"count":>6} {"total (s)":>10} '
+             f'{"mean (s)":>10}']
+    for (command, name), (count, total) in totals:
+      lines.append(f'{command:<12} {name:<28} {count:>6} {total:>10.3f} '
+                   f'{total / count:>10.3f}')
+    return '\n'.join(lines)
+
+  def log_summary(self):
+    '''
+    Log the :meth:`summary`, and start over
+    '''
+
+    if self.totals:
+      logger.info('Service timings:\n' + self.summary())
+    self.clear()
+
+  def clear(self):
+    with self._lock:
+      self.totals.clear()
+
+
+service_timings = ServiceTimings()
+''':class:`ServiceTimings`: The timings of all the services run by this
+process'''
@@ -28,13 +28,28 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from importlib import import_module
+import asyncio
 import os
 from os import environ as env
+from glob import glob
 from shlex import quote
-from subprocess import Popen
+from subprocess import Popen, PIPE, DEVNULL
+from tempfile import TemporaryDirectory
+from hashlib import sha256
+from threading import Lock, Thread, get_ident
+from collections import deque
+from concurrent.futures import Future
+from contextlib import nullcontext
+import contextvars
+from functools import lru_cache
 import distutils.spawn
+import selectors
+import sys
 import pathlib
 import ntpath
+import copy
+import json
+import re
 
 from vsi.tools.diff import dict_diff
 from vsi.tools.python import nested_patch
@@ -43,7 +58,7 @@ from terra.core.utils import Handler
 import terra.core.signals
 from terra import settings
 import terra.compute.base
-from terra.core.settings import filename_suffixes
+from terra.core.settings import filename_suffixes, LazySettingsThreaded
 from terra.logger import getLogger, DEBUG1
 logger = getLogger(__name__)
 
@@ -118,11 +133,71 @@ def get_default_service_class(cls):
   return module.Service
 
 
+_service_classes = {}
+_service_prototypes = {}
+_service_lock = Lock()
+
+
+def _service_class(name_or_class, cls):
+  # The service class for a service name or definition, and a compute class.
+  # Cached, as long as the registered implementation stays the same
+  key = (name_or_class, cls)
+  services = terra.compute.base.services
+  try:
+    name, implementation, service_class = _service_classes[key]
+  except KeyError:
+    pass
+  else:
+    if name in services and services[name].get(cls) is implementation:
+      return service_class
+
+  if isinstance(name_or_class, str):
+    name = name_or_class
+    module = name_or_class.rsplit('.', 1)[0]
+    # Import to trigger registration. Don't need return value
+    import_module(module)
+  else:
+    # TODO: Not really designed for nested classes, so don't use __qualname__
+    name = f'{name_or_class.__module__}.{name_or_class.__name__}'
+
+  try:
+    implementations = services[name]
+  except KeyError:
+    logger.fatal(f'{name} is not registered')
+    raise
+
+  implementation = implementations.get(cls)
+  if implementation is None:
+    logger.info(f'Using default {cls} compute handler for {name}')
+    service_class = get_default_service_class(cls)
+  else:
+    service_class = implementation
+
+  _service_classes[key] = (name, implementation, service_class)
+  return service_class
+
+
+def _copy_service(service):
+  # A copy of a service instance that does not share its dicts, lists and
+  # sets, e.g. env and volumes, which are changed by pre_run
+  copy = object.__new__(type(service))
+  for name, value in vars(service).items():
+    if isinstance(value, (dict, list, set)):
+      value = value.copy()
+    object.__setattr__(copy, name, value)
+  return copy
+
+
 def load_service(name_or_class):
   '''
   Get (and optionally import) a service by name. Also accepts the class itself
   or an instance of a class.
 
+  The service class is looked up once per name and compute class. When
+  :option:`compute.reuse_services` is ``True``, the service is only
+  constructed the first time, and later calls get a copy of that instance,
+  so that ``__init__`` (and its copy of the environment) is not run again.
+
   Parameters
   ----------
   name_or_class : :class:`str` or :term:`class` or instance
@@ -135,64 +210,130 @@ def load_service(name_or_class):
       instance, the same instance is returned
   '''
 
-  if not isinstance(name_or_class, str):
-    # If already instance, return it
-    if not isinstance(name_or_class, type):
-      return name_or_class
-    # TODO: Not really designed for nested classes, so don't use __qualname__
-    name_or_class = f'{name_or_class.__module__}.{name_or_class.__name__}'
-  else:
-    module = name_or_class.rsplit('.', 1)[0]
-    # Import to trigger registration. Don't need return value
-    import_module(module)
+  # If already instance, return it
+  if not isinstance(name_or_class, (str, type)):
+    return name_or_class
 
-  try:
-    services = terra.compute.base.services[name_or_class]
-  except KeyError:
-    logger.fatal(f'{name_or_class} is not registered')
-    raise
+  service_class = _service_class(name_or_class, type(compute._connection))
+
+  if not settings.configured or \
+     not settings.compute.get('reuse_services', False):
+    return service_class()
 
-  cls = type(compute._connection)
+  with _service_lock:
+    prototype = _service_prototypes.get(service_class)
+    if prototype is None:
+      prototype = _service_prototypes[service_class] = service_class()
+  return _copy_service(prototype)
 
-  if cls not in services:
-    logger.info(f'Using default {cls} compute handler for {name_or_class}')
-    return get_default_service_class(cls)()
 
-  return services[cls]()
+def clear_service_cache():
+  '''
+  Forget the services looked up and constructed by :func:`load_service`
+  '''
+
+  with _service_lock:
+    _service_classes.clear()
+    _service_prototypes.clear()
 
 
 # The rest is not part of the Django License
 
 
-def just(*args, **kwargs):
+def run_in_background(function, *args, **kwargs):
   '''
-  Run a ``just`` command. Primarily used to run ``--wrap``
+  Call a function in a thread of its own, in a copy of the current context
+  (so :func:`terra.compute.timing.phase` still applies). The thread shares
+  the settings of the calling thread, e.g. the settings copy of a
+  :class:`terra.executor.thread.ThreadPoolExecutor` worker, instead of the
+  main thread's
 
-  Arguments
-  ---------
-  justfile : :class:`str`, optional
-      Optionally allow you to specify a custom ``Justfile``. Defaults to
-      Terra's ``Justfile`` is used, which is the correct course of action
-      most of the time
-  env : :class:`dict`, optional
-      Sets environment variables. Same as Popen's ``env``, except
-      ``JUSTFILE`` is programatically set, and cannot be overridden any other
-      way than chaning the ``justfile`` variable
-  *args :
-      List of arguments to be pass to ``just``
-  **kwargs :
-      Arguments sent to ``Popen`` command
+  Returns
+  -------
+  :class:`concurrent.futures.Future`
+      Resolves to what the function returned, or raises its exception
   '''
 
-  logger.debug('Running: ' + ' '.join(
-      [quote(x) for x in ('just',) + args]))
+  future = Future()
+  context = contextvars.copy_context()
+  # Captured here, the thread would get the main thread's settings
+  if isinstance(settings, LazySettingsThreaded):
+    caller_settings = settings._wrapped
+  else:
+    caller_settings = None
+
+  def target():
+    if not future.set_running_or_notify_cancel():
+      return  # pragma: no cover
+    if caller_settings is None:
+      thread_settings = nullcontext()
+    else:
+      thread_settings = settings.thread_settings(caller_settings)
+    try:
+      with thread_settings:
+        future.set_result(context.run(function, *args, **kwargs))
+    except BaseException as e:
+      future.set_exception(e)
+
+  Thread(target=target, name=f'terra_{function.__name__}',
+         daemon=True).start()
+  return future
+
+
+def write_hashed_file(directory, prefix, content, suffix=''):
+  '''
+  Write a file named after the hash of its content, unless it already exists
 
+  Files with the same content are the same file, so they can be shared by
+  services, e.g. the override files of services with the same resource
+  requests, or the settings files of services with the same settings. Written
+  to a temporary file first, and renamed, so a file that exists is complete.
+
+  Parameters
+  ----------
+  directory : str
+      Where to write the file
+  prefix : str
+      The start of the file name
+  content : str or bytes
+      The content of the file
+  suffix : str, optional
+      The end of the file name, e.g. ``.json``
+
+  Returns
+  -------
+  str
+      The filename
+  '''
+
+  if isinstance(content, str):
+    content = content.encode()
+  filename = os.path.join(
+      directory, f'{prefix}{sha256(content).hexdigest()[:16]}{suffix}')
+  if not os.path.exists(filename):
+    temp_filename = f'{filename}.{os.getpid()}.{get_ident()}.tmp'
+    with open(temp_filename, 'wb') as fid:
+      fid.write(content)
+    os.replace(temp_filename, filename)
+  return filename
+
+
+def _just_command(args, kwargs):
+  # The command line, environment and Popen arguments of a just call
   just_env = kwargs.pop('env', env).copy()
   justfile = kwargs.pop('justfile', None)
   if not justfile:
     justfile = os.path.join(env['TERRA_TERRA_DIR'], 'Justfile')
   just_env['JUSTFILE'] = justfile
 
+  if settings.configured and settings.compute.get('direct_compose', False):
+    resolved = just_resolver.command(args, just_env)
+    if resolved is not None:
+      return resolved[0], resolved[1], kwargs
+
+  logger.debug('Running: ' + ' '.join(
+      [quote(x) for x in ('just',) + args]))
+
   if logger.getEffectiveLevel() <= DEBUG1:
     dd = dict_diff(env, just_env)[3]
     if dd:
@@ -207,48 +348,857 @@ def just(*args, **kwargs):
   # calls WSL bash on execute :(
   kwargs['executable'] = distutils.spawn.find_executable('bash')
   # Have to call bash for windows compatibility, no shebang support
-  pid = Popen(('bash', 'just') + args, env=just_env, **kwargs)
+  return ('bash', 'just') + args, just_env, kwargs
+
+
+def just(*args, **kwargs):
+  '''
+  Run a ``just`` command. Primarily used to run ``--wrap``
+
+  Arguments
+  ---------
+  justfile : :class:`str`, optional
+      Optionally allow you to specify a custom ``Justfile``. Defaults to
+      Terra's ``Justfile`` is used, which is the correct course of action
+      most of the time
+  env : :class:`dict`, optional
+      Sets environment variables. Same as Popen's ``env``, except
+      ``JUSTFILE`` is programatically set, and cannot be overridden any other
+      way than chaning the ``justfile`` variable
+  *args :
+      List of arguments to be pass to ``just``
+  **kwargs :
+      Arguments sent to ``Popen`` command
+  '''
+
+  command, just_env, kwargs = _just_command(args, kwargs)
+  pid = Popen(command, env=just_env, **kwargs)
   return pid
 
 
+async def ajust(*args, **kwargs):
+  '''
+  Same as :func:`just`, but starts the command with
+  :func:`asyncio.create_subprocess_exec`
+
+  Returns
+  -------
+  :class:`asyncio.subprocess.Process`
+  '''
+
+  command, just_env, kwargs = _just_command(args, kwargs)
+  return await asyncio.create_subprocess_exec(*command, env=just_env,
+                                              **kwargs)
+
+
+_capture_script = """import json, os, sys
+json.dump({'argv': sys.argv[1:], 'env': dict(os.environ)}, sys.stdout)
+"""
+
+
+def _file_state(filename):
+  # The path and modification time of a file, for cache keys
+  filename = os.path.abspath(filename)
+  try:
+    return [filename, os.stat(filename).st_mtime_ns]
+  except OSError:
+    return [filename, None]
+
+
+class JustResolver:
+  '''
+  Resolves the command line and environment that a ``just`` wrapper, like
+  ``just --wrap Just-docker-compose`` or ``just singular-compose``, runs, so
+  that the command can be run directly instead
+
+  Each wrapper is resolved once, by running it with vsi_common's ``DRYRUN``
+  set to a script that captures the arguments and environment of the command
+  instead of running it. The result is cached by the wrapper, the justfile
+  (its path and modification time) and the environment variables used by the
+  just and compose wrappers (the same ones as :class:`ConfigCache`). Wrappers
+  that can't be resolved, e.g. that don't honor ``DRYRUN``, or that run a
+  command with temporary files, are remembered, and run with ``just`` as
+  usual.
+  '''
+
+  probe = '--terra-resolve-probe'
+  '''str: Argument the wrapper is resolved with, that it must pass through
+  as the last argument'''
+
+  def __init__(self):
+    self._lock = Lock()
+    self._cache = {}
+    self._temp_dir = None
+
+  @staticmethod
+  def split(args):
+    '''
+    Split the arguments of a ``just`` call into the wrapper and the arguments
+    passed to the wrapped command
+    '''
+
+    if args and args[0] == '--wrap':
+      return tuple(args[:2]), tuple(args[2:])
+    return tuple(args[:1]), tuple(args[1:])
+
+  def key(self, wrapper, just_env):
+    prefixes = ConfigCache.env_prefixes
+    if just_env.get('JUST_PROJECT_PREFIX'):
+      prefixes += (just_env['JUST_PROJECT_PREFIX'] + '_',)
+    relevant_env = sorted((name, value) for name, value in just_env.items()
+                          if name.startswith(prefixes))
+    justfile = just_env.get('JUSTFILE')
+    return json.dumps([wrapper, justfile and _file_state(justfile),
+                       relevant_env])
+
+  def resolve(self, wrapper, just_env):
+    '''
+    Get the resolved command line prefix and environment of a wrapper
+
+    Returns
+    -------
+    tuple
+        The command line the wrapper runs, without the wrapped arguments, the
+        environment it is run with and the environment it was resolved from.
+        ``None`` if the wrapper can't be resolved
+    '''
+
+    key = self.key(wrapper, just_env)
+    with self._lock:
+      if key not in self._cache:
+        self._cache[key] = self._resolve(wrapper, just_env)
+      return self._cache[key]
+
+  def _resolve(self, wrapper, just_env):
+    # Must be called with the lock held
+    if self._temp_dir is None:
+      self._temp_dir = TemporaryDirectory(prefix='terra_resolve_')
+      with open(os.path.join(self._temp_dir.name, 'capture.py'), 'w') as fid:
+        fid.write(_capture_script)
+    dryrun = f'{sys.executable} ' + \
+        os.path.join(self._temp_dir.name, 'capture.py')
+    # DRYRUN is word split by bash
+    if len(dryrun.split()) != 2:
+      return None
+
+    probe_env = just_env.copy()
+    probe_env['DRYRUN'] = dryrun
+    try:
+      pid = Popen(('bash', 'just') + wrapper + (self.probe,), env=probe_env,
+                  stdout=PIPE, stderr=DEVNULL,
+                  executable=distutils.spawn.find_executable('bash'))
+      captured = json.loads(pid.communicate()[0])
+      argv = captured['argv']
+      resolved_env = captured['env']
+    except (OSError, ValueError, KeyError, TypeError):
+      argv = None
+
+    if not argv or argv[-1] != self.probe:
+      logger.debug1(f'Unable to resolve {wrapper}, using just')
+      return None
+    argv = argv[:-1]
+
+    # Compose files made by the wrapper are gone by now
+    for index, arg in enumerate(argv[:-1]):
+      if arg in ('-f', '--file') and not os.path.exists(argv[index + 1]):
+        logger.debug1(f'{wrapper} uses temporary file {argv[index + 1]}, '
+                      'using just')
+        return None
+
+    resolved_env.pop('DRYRUN', None)
+    logger.debug1(f'Resolved {wrapper} to {argv}')
+    return argv, resolved_env, just_env.copy()
+
+  def command(self, args, just_env):
+    '''
+    Get the command line and environment to run a ``just`` call directly
+
+    Returns
+    -------
+    tuple
+        The command line and environment, or ``None`` if the wrapper can't be
+        resolved
+    '''
+
+    wrapper, wrapped_args = self.split(args)
+    resolved = self.resolve(wrapper, just_env)
+    if resolved is None:
+      return None
+    argv, resolved_env, base_env = resolved
+
+    # Start from the environment just would have made, and apply the changes
+    # this call made, compared to the call that was resolved
+    run_env = resolved_env.copy()
+    for name, value in just_env.items():
+      if base_env.get(name) != value:
+        run_env[name] = value
+    for name in base_env:
+      if name not in just_env and \
+         resolved_env.get(name) == base_env[name]:
+        run_env.pop(name, None)
+
+    command = list(argv) + list(wrapped_args)
+    logger.debug('Running: ' + ' '.join(quote(x) for x in command))
+    return command, run_env
+
+  def popen(self, args, just_env, **kwargs):
+    '''
+    Run a ``just`` call directly, if its wrapper can be resolved
+
+    Returns
+    -------
+    :class:`subprocess.Popen`
+        The process, or ``None`` if the wrapper can't be resolved
+    '''
+
+    resolved = self.command(args, just_env)
+    if resolved is None:
+      return None
+    command, run_env = resolved
+    return Popen(command, env=run_env, **kwargs)
+
+  def clear(self):
+    '''
+    Forget the resolved wrappers
+    '''
+
+    with self._lock:
+      self._cache.clear()
+
+
+just_resolver = JustResolver()
+''':class:`JustResolver`: Resolver used by :func:`just` when
+:option:`compute.direct_compose` is enabled'''
+
+
+class ConfigCache:
+  '''
+  A cache of ``docker-compose config`` and ``singular-compose config-null``
+  results
+
+  Running a compose ``config`` starts bash, just and compose, and takes
+  hundreds of milliseconds, for a result that only changes when the compose
+  files or the environment variables they use change. Results are keyed by
+  the compose command (including the service name, for commands that depend
+  on it), the paths and modification times of the compose files, the justfile
+  and the ``*.env`` files next to it (that just sources, like ``local.env``),
+  and the values of the environment variables that are referenced in those
+  files or used by the just and compose wrappers. Failed calls are not cached.
+
+  Parameters
+  ----------
+  filename : str, optional
+      A json file the cache is persisted to, so that it is reused between
+      runs. By default the cache is only kept in memory.
+  '''
+
+  env_prefixes = ('JUST_', 'COMPOSE_', 'DOCKER_', 'SINGULAR')
+  '''tuple: Prefixes of environment variables that are always part of the
+  key, in addition to ``{JUST_PROJECT_PREFIX}_``'''
+
+  _env_reference_re = re.compile(rb'\$\{?([A-Za-z_][A-Za-z0-9_]*)')
+
+  def __init__(self, filename=None):
+    self.filename = filename
+    self._lock = Lock()
+    self._cache = {}
+    self._pending = {}
+    self._references = {}
+    self.hits = 0
+    self.misses = 0
+
+    if filename and os.path.exists(filename):
+      try:
+        with open(filename, 'r') as fid:
+          self._cache = json.load(fid)
+      except (OSError, ValueError) as e:
+        logger.warning(f'Ignoring unreadable config cache {filename}: {e}')
+
+  @classmethod
+  def from_settings(cls):
+    '''
+    Create a :class:`ConfigCache` persisted to :option:`compute.config_cache`,
+    if set
+    '''
+
+    filename = None
+    if settings.configured:
+      filename = settings.compute.get('config_cache', None)
+    return cls(filename)
+
+  def _env_references(self, filename, mtime):
+    # Names of the environment variables referenced in a compose file
+    try:
+      return self._references[(filename, mtime)]
+    except KeyError:
+      pass
+
+    names = set()
+    if mtime is not None:
+      try:
+        with open(filename, 'rb') as fid:
+          names = {name.decode() for name in
+                   self._env_reference_re.findall(fid.read())}
+      except OSError:
+        pass
+    self._references[(filename, mtime)] = names
+    return names
+
+  def key(self, args, service_info):
+    '''
+    Calculate the key of a compose ``config`` call
+
+    Parameters
+    ----------
+    args : list
+        The arguments of the just call, including the compose files and
+        service name
+    service_info : :class:`terra.compute.base.BaseService`
+        The service, for its ``compose_files``, ``justfile`` and ``env``
+
+    Returns
+    -------
+    str
+        The key
+    '''
+
+    files = [_file_state(filename)
+             for filename in getattr(service_info, 'compose_files', [])]
+    justfile = getattr(service_info, 'justfile', None)
+    if not justfile and 'TERRA_TERRA_DIR' in env:
+      justfile = os.path.join(env['TERRA_TERRA_DIR'], 'Justfile')
+    if justfile:
+      files.append(_file_state(justfile))
+      # The env files just sources, e.g. terra.env and local.env
+      env_files = glob(os.path.join(os.path.dirname(
+          os.path.abspath(justfile)), '*.env'))
+      files.extend(_file_state(filename) for filename in sorted(env_files))
+
+    service_env = getattr(service_info, 'env', env)
+    names = set()
+    for filename, mtime in files:
+      names.update(self._env_references(filename, mtime))
+    prefixes = self.env_prefixes
+    if service_env.get('JUST_PROJECT_PREFIX'):
+      prefixes += (service_env['JUST_PROJECT_PREFIX'] + '_',)
+
+    relevant_env = sorted((name, value) for name, value in service_env.items()
+                          if name in names or name.startswith(prefixes))
+
+    return sha256(json.dumps([list(args), files,
+                              relevant_env]).encode()).hexdigest()
+
+  def get(self, args, service_info, config_function):
+    '''
+    Get the cached result of a compose ``config`` call, calling
+    ``config_function`` on a cache miss
+
+    Returns
+    -------
+    object
+        A copy of the cached result, so it can be modified freely
+    '''
+
+    key = self.key(args, service_info)
+    with self._lock:
+      if key in self._cache:
+        self.hits += 1
+        logger.debug2('Using cached compose config')
+        return copy.deepcopy(self._cache[key])
+      # The same call already running, e.g. for a service started at the
+      # same time, is waited for instead of run again
+      pending = self._pending.get(key)
+      if pending is None:
+        pending = self._pending[key] = Future()
+        self.misses += 1
+        running = False
+      else:
+        self.hits += 1
+        running = True
+
+    if running:
+      logger.debug2('Waiting for the same compose config')
+      return copy.deepcopy(pending.result())
+
+    try:
+      config = config_function()
+    except BaseException as e:
+      with self._lock:
+        del self._pending[key]
+      pending.set_exception(e)
+      raise
+
+    with self._lock:
+      self._cache[key] = copy.deepcopy(config)
+      del self._pending[key]
+      if self.filename:
+        self._save()
+    pending.set_result(self._cache[key])
+    return config
+
+  def _save(self):
+    # Must be called with the lock held
+    temp_filename = f'{self.filename}.{os.getpid()}.tmp'
+    try:
+      os.makedirs(os.path.dirname(os.path.abspath(self.filename)),
+                  exist_ok=True)
+      with open(temp_filename, 'w') as fid:
+        json.dump(self._cache, fid)
+      os.replace(temp_filename, self.filename)
+    except (OSError, TypeError, ValueError) as e:
+      logger.warning(f'Unable to save config cache {self.filename}: {e}')
+
+  def clear(self):
+    '''
+    Forget all the cached results, including the persisted ones
+    '''
+
+    with self._lock:
+      self._cache.clear()
+      self._references.clear()
+      if self.filename:
+        self._save()
+
+
+class ServiceOutput:
+  '''
+  Captures the stdout and stderr of a service runner, when
+  :option:`compute.capture_output` is enabled
+
+  The output is read from pipes by a single thread, using a selector, and
+  every line is forwarded to the terra logger, prefixed with the service's
+  name. Only the last ``tail`` lines are kept, for the error message of a
+  failed service, so the memory used does not grow with the output. When
+  capturing is disabled, the service inherits the controller's stdio, like
+  before.
+
+  Parameters
+  ----------
+  name : str
+      The name the lines are tagged with
+  capture : bool, optional
+      Whether to capture the output. Default: ``False``
+  tail : int, optional
+      The number of lines kept for the error message. Default: ``100``
+  '''
+
+  max_line_length = 65536
+  '''int: Longer lines are split, so that a service printing without newlines
+  can't use up the memory'''
+
+  def __init__(self, name, capture=False, tail=100):
+    self.name = name
+    self.capture = capture
+    self.tail = deque(maxlen=tail)
+    self._thread = None
+
+  @classmethod
+  def from_settings(cls, service_info):
+    '''
+    Create the :class:`ServiceOutput` of a service, configured by
+    :option:`compute.capture_output` and :option:`compute.capture_tail`
+    '''
+    capture = False
+    tail = 100
+    if settings.configured:
+      capture = bool(settings.compute.get('capture_output', False))
+      tail = settings.compute.get('capture_tail', tail)
+    return cls(type(service_info).__name__, capture, tail)
+
+  @property
+  def popen_kwargs(self):
+    '''
+    dict: The arguments to start the service's process with
+    '''
+    if self.capture:
+      return {'stdout': PIPE, 'stderr': PIPE}
+    return {}
+
+  def _line(self, stream, data):
+    line = data.decode(errors='replace').rstrip('\r\n')
+    self.tail.append(f'{stream}: {line}')
+    logger.info(f'{self.name} {stream}: {line}')
+
+  def _feed(self, stream, buffer, data):
+    # Returns the remainder after the last complete line
+    buffer += data
+    lines = buffer.split(b'\n')
+    buffer = lines.pop()
+    for line in lines:
+      self._line(stream, line)
+    while len(buffer) >= self.max_line_length:
+      self._line(stream, buffer[:self.max_line_length])
+      buffer = buffer[self.max_line_length:]
+    return buffer
+
+  def _read(self, pipes):
+    # pipes: {file object: stream name}
+    buffers = {pipe: b'' for pipe in pipes}
+    if os.name == 'nt':  # pragma: no linux cover
+      # Selectors only support sockets on windows
+      for pipe, stream in pipes.items():
+        for data in iter(lambda: pipe.read1(self.max_line_length), b''):
+          buffers[pipe] = self._feed(stream, buffers[pipe], data)
+    else:
+      with selectors.DefaultSelector() as selector:
+        for pipe in pipes:
+          selector.register(pipe, selectors.EVENT_READ)
+        while selector.get_map():
+          for key, _ in selector.select():
+            data = os.read(key.fd, self.max_line_length)
+            if data:
+              buffers[key.fileobj] = self._feed(
+                  pipes[key.fileobj], buffers[key.fileobj], data)
+            else:
+              selector.unregister(key.fileobj)
+
+    for pipe, buffer in buffers.items():
+      if buffer:
+        self._line(pipes[pipe], buffer)
+      pipe.close()
+
+  def start(self, pid):
+    '''
+    Start reading the output of a process started with :attr:`popen_kwargs`
+    '''
+    if not self.capture:
+      return
+    pipes = {pid.stdout: 'stdout', pid.stderr: 'stderr'}
+    if os.name == 'nt':  # pragma: no linux cover
+      # One thread per pipe, so that neither pipe can fill up
+      self._thread = [Thread(target=self._read, args=({pipe: stream},),
+                             daemon=True)
+                      for pipe, stream in pipes.items()]
+    else:
+      self._thread = [Thread(target=self._read, args=(pipes,), daemon=True)]
+    for thread in self._thread:
+      thread.start()
+
+  def wait(self, pid):
+    '''
+    Wait for the process to exit, and raise
+    :class:`terra.compute.base.ServiceRunFailed` if it failed. The error
+    message includes the tail of the output, when it is captured
+    '''
+    self.start(pid)
+    returncode = pid.wait()
+    for thread in self._thread or []:
+      thread.join()
+    self.check(returncode)
+
+  async def _async_read(self, reader, stream):
+    buffer = b''
+    while True:
+      data = await reader.read(self.max_line_length)
+      if not data:
+        break
+      buffer = self._feed(stream, buffer, data)
+    if buffer:
+      self._line(stream, buffer)
+
+  async def async_wait(self, process):
+    '''
+    Same as :meth:`wait`, for an :class:`asyncio.subprocess.Process`. The
+    output is read by the event loop, instead of a thread
+    '''
+    if self.capture:
+      await asyncio.gather(self._async_read(process.stdout, 'stdout'),
+                           self._async_read(process.stderr, 'stderr'))
+    self.check(await process.wait())
+
+  def check(self, returncode):
+    '''
+    Raise :class:`terra.compute.base.ServiceRunFailed` if ``returncode`` is
+    not zero
+    '''
+    if returncode != 0:
+      message = f'{self.name} exited with return code {returncode}'
+      if self.tail:
+        message += '. Last output:\n' + '\n'.join(self.tail)
+      raise terra.compute.base.ServiceRunFailed(message,
+                                                returncode=returncode)
+
+
+class VolumeTranslator:
+  '''
+  Translates paths through a volume map, e.g. from the host to a container
+
+  The mount points are compiled once into a trie of path components, so a
+  path is translated in a single walk over its components, no matter how many
+  volumes there are. The deepest mount point that contains the path wins, the
+  same as for nested mounts, and only whole components match, so ``/data2``
+  is not translated by a ``/data`` volume.
+
+  Parameters
+  ----------
+  volume_map : list
+      List of ``(from, to)`` pairs. If the same mount point is listed more
+      than once, the last one is used
+  sep : str, optional
+      The path separator. Default: ``/``
+  '''
+
+  def __init__(self, volume_map, sep='/'):
+    self.volume_map = [tuple(volume) for volume in volume_map]
+    self.sep = sep
+    self._trie = {}
+    for vol_from, vol_to in self.volume_map:
+      node = self._trie
+      for part in vol_from.rstrip(sep).split(sep):
+        node = node.setdefault(part, {})
+      # None can't be a path component, so it marks the mount points
+      node[None] = vol_to
+
+  def inverse(self):
+    '''
+    Returns
+    -------
+    VolumeTranslator
+        The translator for the opposite direction, e.g. from the container
+        back to the host
+    '''
+    return type(self)([(vol_to, vol_from)
+                       for vol_from, vol_to in reversed(self.volume_map)],
+                      self.sep)
+
+  def _walk(self, path):
+    # Returns the trie node of the path (None if it is not in the trie), the
+    # target of the deepest mount point and where that mount point ends
+    node = self._trie
+    target = None
+    match_end = 0
+    end = -1
+    for part in path.split(self.sep):
+      node = node.get(part)
+      if node is None:
+        break
+      end += len(part) + 1
+      if None in node:
+        target = node[None]
+        match_end = end
+    return node, target, match_end
+
+  def _join(self, target, remainder):
+    if not remainder:
+      return target
+    return target.rstrip(self.sep) + remainder
+
+  def translate(self, path):
+    '''
+    Translate a single path. Paths that are not in any volume are returned
+    unchanged
+    '''
+    _, target, end = self._walk(path)
+    if target is None:
+      return path
+    return self._join(target, path[end:])
+
+  def translate_many(self, paths):
+    '''
+    Translate a list of paths, e.g. a ``_files`` setting
+
+    The files in a list usually share a few directories, so the trie is only
+    walked once per directory. Items that are not strings are left as is.
+
+    Returns
+    -------
+    list or tuple
+        The translated paths, the same type as ``paths``
+    '''
+
+    sep = self.sep
+    walks = {}
+    translated = []
+    for path in paths:
+      if not isinstance(path, str):
+        translated.append(path)
+        continue
+
+      directory, has_sep, name = path.rpartition(sep)
+      if not has_sep:
+        translated.append(self.translate(path))
+        continue
+
+      try:
+        node, target, end = walks[directory]
+      except KeyError:
+        node, target, end = walks[directory] = self._walk(directory)
+
+      # The last component can be a mount point itself
+      if node is not None:
+        child = node.get(name)
+        if child is not None and None in child:
+          target = child[None]
+          end = len(path)
+
+      if target is None:
+        translated.append(path)
+      else:
+        translated.append(self._join(target, path[end:]))
+
+    if isinstance(paths, tuple):
+      return tuple(translated)
+    return translated
+
+
+class WindowsVolumeTranslator:
+  '''
+  Translates Windows paths through a volume map, e.g. from a Windows host to
+  a Linux or Windows container
+
+  Paths match a mount point the same way :meth:`pathlib.PurePath.relative_to`
+  does for :class:`pathlib.PureWindowsPath`: ``\\`` and ``/`` are both
+  separators, case is ignored and only whole components match. The deepest
+  mount point that contains the path wins, the same as for
+  :class:`VolumeTranslator`. The mount points and targets are normalized
+  once, when the translator is made, so translating a path only takes an
+  :func:`ntpath.normpath` and string comparisons.
+
+  Parameters
+  ----------
+  volume_map : list
+      List of ``(from, to)`` pairs. If the same mount point is listed more
+      than once, the last one is used
+  container_platform : str, optional
+      ``linux`` or ``windows``, the paths the mount points are translated to
+  '''
+
+  def __init__(self, volume_map, container_platform='linux'):
+    self.volume_map = [tuple(volume) for volume in volume_map]
+    self.container_platform = container_platform
+    if container_platform == 'windows':
+      self.sep = '\\'
+      target_path = pathlib.PureWindowsPath
+    else:
+      self.sep = '/'
+      target_path = pathlib.PurePosixPath
+
+    # (mount point, the mount point ending in a separator, the number of
+    # components it has, target), in the order they are tried: deepest first,
+    # and the last of the same mount point first
+    self._volumes = []
+    for vol_from, vol_to in reversed(self.volume_map):
+      prefix = ntpath.normcase(ntpath.normpath(vol_from))
+      root = prefix.rstrip('\\')
+      self._volumes.append((prefix, root + '\\', len(root.split('\\')),
+                            str(target_path(vol_to))))
+    self._volumes.sort(key=lambda volume: volume[2], reverse=True)
+
+  def _join(self, target, parts):
+    if not parts:
+      return target
+    remainder = self.sep.join(parts)
+    if target == '.':
+      return remainder
+    # Roots, and drives without one, e.g. "c:"
+    if target.endswith((self.sep, ':')):
+      return target + remainder
+    return target + self.sep + remainder
+
+  def translate(self, path):
+    '''
+    Translate a single path. Paths that are not in any volume are returned
+    unchanged
+    '''
+
+    normalized = ntpath.normpath(path)
+    # normcase, the separators are already normalized
+    folded = normalized.lower()
+    for prefix, directory, count, target in self._volumes:
+      if folded == prefix:
+        return target
+      if folded.startswith(directory):
+        # By component, lower() can change the length of a string
+        return self._join(target, normalized.split('\\')[count:])
+    return path
+
+  def translate_many(self, paths):
+    '''
+    Translate a list of paths, e.g. a ``_files`` setting. Items that are not
+    strings are left as is
+
+    Returns
+    -------
+    list or tuple
+        The translated paths, the same type as ``paths``
+    '''
+
+    translated = [self.translate(path) if isinstance(path, str) else path
+                  for path in paths]
+    if isinstance(paths, tuple):
+      return tuple(translated)
+    return translated
+
+
+@lru_cache(maxsize=64)
+def _volume_translator(volume_map, sep):
+  return VolumeTranslator(volume_map, sep)
+
+
+def volume_translator(volume_map, sep='/'):
+  '''
+  Get the :class:`VolumeTranslator` for a volume map, compiling it only the
+  first time the map is used
+  '''
+  return _volume_translator(tuple(tuple(volume) for volume in volume_map),
+                            sep)
+
+
+@lru_cache(maxsize=64)
+def _windows_volume_translator(volume_map, container_platform):
+  return WindowsVolumeTranslator(volume_map, container_platform)
+
+
+def windows_volume_translator(volume_map, container_platform='linux'):
+  '''
+  Get the :class:`WindowsVolumeTranslator` for a volume map, compiling it only
+  the first time the map is used
+  '''
+  return _windows_volume_translator(
+      tuple(tuple(volume) for volume in volume_map), container_platform)
+
+
 def translate_settings_paths(container_config, volume_map,
                              container_platform='linux'):
+  '''
+  Translate the paths in the settings, those whose names end in one of the
+  :data:`terra.core.settings.filename_suffixes`, through a volume map
+
+  A path is translated by the deepest volume that contains it, on Linux
+  (:class:`VolumeTranslator`) and Windows (:class:`WindowsVolumeTranslator`)
+  hosts alike, e.g. ``/data/in/a.tif`` is translated by a ``/data/in`` volume,
+  rather than ``/data``, wherever they are in the map. Paths in no volume are
+  left as is.
+
+  Parameters
+  ----------
+  container_config : dict
+      The settings
+  volume_map : list
+      List of ``(from, to)`` pairs
+  container_platform : str, optional
+      ``linux`` or ``windows``, the platform of the container, used for
+      Windows hosts
+
+  Returns
+  -------
+  dict
+      The translated settings
+  '''
 
   if os.name == "nt":  # pragma: no linux cover
     logger.warning("Windows volume mapping is experimental.")
-
-    def patch_volume(value, volume_map):
-      if isinstance(value, str):
-        value_path = pathlib.PureWindowsPath(ntpath.normpath(value))
-        for vol_from, vol_to in volume_map:
-          # pattern = re.compile(re.escape(vol_from), re.IGNORECASE)
-
-          # if isinstance(value, str) and pattern.match(value):
-          #   value = pattern.sub(vol_to, value)
-          #   value = value.replace('\\', '/')
-          #   break
-
-          vol_from = pathlib.PureWindowsPath(ntpath.normpath(vol_from))
-
-          try:
-            remainder = value_path.relative_to(vol_from)
-          except ValueError:
-            continue
-          if container_platform == "windows":
-            value = pathlib.PureWindowsPath(vol_to)
-          else:
-            value = pathlib.PurePosixPath(vol_to)
-
-          value /= remainder
-          return str(value)
-      return value
+    translator = windows_volume_translator(volume_map, container_platform)
   else:  # pragma: no nt cover
-    def patch_volume(value, volume_map):
-      if isinstance(value, str):
-        for vol_from, vol_to in volume_map:
-          if value.startswith(vol_from):
-            return value.replace(vol_from, vol_to, 1)
-      return value
+    translator = volume_translator(volume_map)
+
+  def patch_volume(value):
+    if isinstance(value, str):
+      return translator.translate(value)
+    # Lists of paths, e.g. "_files"
+    if isinstance(value, (list, tuple)):
+      return translator.translate_many(value)
+    return value
 
   # Apply map translation to settings configuration
   return nested_patch(
@@ -256,5 +1206,5 @@ def translate_settings_paths(container_config, volume_map,
       lambda key, value: (isinstance(key, str)
                           and any(key.endswith(pattern)
                                   for pattern in filename_suffixes)),
-      lambda key, value: patch_volume(value, reversed(volume_map))
+      lambda key, value: patch_volume(value)
   )
@@ -1,25 +1,191 @@
+import asyncio
 import distutils.spawn
 import json
 import os
+import socket
 from shlex import quote
-from subprocess import Popen
+from subprocess import Popen, TimeoutExpired
 from tempfile import TemporaryDirectory
 
 from vsi.tools.diff import dict_diff
 from vsi.tools.dir_util import is_subdir
 
 from terra.compute.base import BaseService, BaseCompute, ServiceRunFailed
+from terra.compute import forkserver, compute
+from terra.compute.utils import ServiceOutput, write_hashed_file
+from terra.compute.timing import phase
+from terra.compute.resources import service_resources, limit_process
 from terra.core.settings import TerraJSONEncoder
 from terra import settings
 from terra.logger import getLogger, DEBUG1
 logger = getLogger(__name__)
 
 
+class WarmInterpreter:
+  '''
+  A warm python interpreter, that runs python commands in processes forked
+  from it, using :mod:`terra.compute.forkserver`
+
+  Parameters
+  ----------
+  executable : str
+      The python executable
+  preload : list, optional
+      Modules imported by the interpreter before it forks
+  env : dict, optional
+      The environment the interpreter is started with. Variables read when
+      python starts, like ``PYTHONPATH``, are fixed from then on
+  '''
+
+  def __init__(self, executable, preload=(), env=None):
+    self.executable = executable
+    self._temp_dir = TemporaryDirectory(prefix='terra_warm_')
+    self.address = os.path.join(self._temp_dir.name, 'socket')
+
+    # Listen before starting the server, so runs can be requested right away
+    listener = socket.socket(socket.AF_UNIX)
+    try:
+      listener.bind(self.address)
+      listener.listen(16)
+      self.process = Popen([executable, forkserver.__file__,
+                            '--fd', str(listener.fileno()), *preload],
+                           env=env, pass_fds=(listener.fileno(),))
+    finally:
+      listener.close()
+    logger.debug1(f'Started warm interpreter {executable} '
+                  f'({self.process.pid})')
+
+  def run(self, argv, env, cwd, resources=None):
+    '''
+    Run python in a process forked from the interpreter, and wait for it
+
+    Parameters
+    ----------
+    argv : list
+        The arguments to python: ``-m module ...``, ``-c code ...`` or
+        ``script ...``
+    env : dict
+        The environment variables of the process
+    cwd : str
+        The working directory of the process
+    resources : dict, optional
+        The ``cpuset`` and ``memory`` limits of the process, see
+        :func:`terra.compute.resources.service_resources`
+
+    Returns
+    -------
+    int
+        The exit code of the process
+    '''
+
+    with socket.socket(socket.AF_UNIX) as sock:
+      sock.connect(self.address)
+      forkserver.send(sock, self._request(argv, env, cwd, resources))
+      with sock.makefile('rb') as sock_file:
+        started = forkserver.recv(sock_file)
+        if started is not None:
+          logger.debug2(f'Forked process {started["pid"]}')
+          result = forkserver.recv(sock_file)
+    if started is None or result is None:
+      raise ConnectionError('Lost the warm interpreter '
+                            f'{self.process.pid}')
+    return result['returncode']
+
+  async def arun(self, argv, env, cwd, resources=None):
+    '''
+    Same as :meth:`run`, but waits for the process without blocking the event
+    loop
+    '''
+
+    reader, writer = await asyncio.open_unix_connection(self.address)
+    try:
+      writer.write(json.dumps(self._request(argv, env, cwd,
+                                            resources)).encode() + b'\n')
+      await writer.drain()
+      started = result = None
+      line = await reader.readline()
+      if line:
+        started = json.loads(line)
+        logger.debug2(f'Forked process {started["pid"]}')
+        line = await reader.readline()
+        if line:
+          result = json.loads(line)
+    finally:
+      writer.close()
+    if started is None or result is None:
+      raise ConnectionError('Lost the warm interpreter '
+                            f'{self.process.pid}')
+    return result['returncode']
+
+  @staticmethod
+  def _request(argv, env, cwd, resources):
+    request = {'argv': list(argv), 'env': dict(env), 'cwd': cwd}
+    for key in ('cpuset', 'memory'):
+      if key in (resources or {}):
+        request[key] = resources[key]
+    return request
+
+  def close(self):
+    '''
+    Stop the interpreter, once the processes forked from it exit
+    '''
+
+    try:
+      with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(self.address)
+        forkserver.send(sock, {'shutdown': True})
+      self.process.wait(timeout=60)
+    except (OSError, TimeoutExpired):
+      self.process.kill()
+      self.process.wait()
+    self._temp_dir.cleanup()
+
+
 class Compute(BaseCompute):
   '''
   Virtual env computing model
+
+  When :option:`compute.pool` is enabled, python commands (``python -m
+  module``, ``python -c code`` and ``python script``) are run in processes
+  forked from a :class:`WarmInterpreter` started for the virtualenv, that
+  has already imported :option:`compute.pool_preload`. Each run is still its
+  own process, with its own environment, including ``TERRA_SETTINGS_FILE``.
   '''
 
+  @property
+  def pooled(self):
+    return bool(settings.compute.get('pool', False)) and \
+        hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX')
+
+  @staticmethod
+  def warmable(command):
+    '''
+    Whether a command can be run by a :class:`WarmInterpreter`
+    '''
+
+    return len(command) > 1 and \
+        os.path.basename(command[0]).startswith('python') and \
+        (command[1] in ('-m', '-c') or not command[1].startswith('-'))
+
+  def warm_interpreter(self, executable, env):
+    '''
+    Get the warm interpreter for a python executable, starting it if needed
+    '''
+
+    preload = list(settings.compute.get('pool_preload', []))
+    # Interpreters started with different python settings are not
+    # interchangeable
+    python_env = sorted((key, value) for key, value in env.items()
+                        if key.startswith('PYTHON'))
+    key = json.dumps([os.path.realpath(executable), preload, python_env])
+
+    return self.get_pooled(
+        key, lambda: WarmInterpreter(executable, preload, env))
+
+  def stop_pooled(self, names):
+    for interpreter in names:
+      interpreter.close()
+
   # run the service in a virtual env with the subprocess module
   def run_service(self, service_info):
     '''
@@ -40,6 +206,79 @@ class Compute(BaseCompute):
         Arguments sent to ``Popen`` command
     '''
 
+    env, executable = self.prepare_run(service_info)
+    resources = service_resources(service_info)
+
+    # Warm interpreters run the command with their own stdio, so their output
+    # is not captured
+    if self.pooled and self.warmable(service_info.command):
+      interpreter = self.warm_interpreter(executable, env)
+      try:
+        returncode = interpreter.run(service_info.command[1:], env,
+                                     os.getcwd(), resources)
+      except OSError as e:
+        raise ServiceRunFailed() from e
+      output = ServiceOutput(type(service_info).__name__)
+      output.check(returncode)
+      return
+
+    # run command -- command must be a list of strings
+    output = ServiceOutput.from_settings(service_info)
+    with phase('spawn'):
+      pid = Popen(service_info.command, env=env, executable=executable,
+                  **output.popen_kwargs)
+    self._limit(pid, resources)
+    output.wait(pid)
+
+  async def arun_service(self, service_info):
+    '''
+    Same as :meth:`run_service`, using
+    :func:`asyncio.create_subprocess_exec`, or :meth:`WarmInterpreter.arun`
+    '''
+
+    env, executable = self.prepare_run(service_info)
+    resources = service_resources(service_info)
+
+    if self.pooled and self.warmable(service_info.command):
+      interpreter = self.warm_interpreter(executable, env)
+      try:
+        returncode = await interpreter.arun(service_info.command[1:], env,
+                                            os.getcwd(), resources)
+      except OSError as e:
+        raise ServiceRunFailed() from e
+      output = ServiceOutput(type(service_info).__name__)
+      output.check(returncode)
+      return
+
+    output = ServiceOutput.from_settings(service_info)
+    with phase('spawn'):
+      process = await asyncio.create_subprocess_exec(
+          *service_info.command, env=env, executable=executable,
+          **output.popen_kwargs)
+    self._limit(process, resources)
+    await output.async_wait(process)
+
+  @staticmethod
+  def _limit(process, resources):
+    if resources:
+      try:
+        limit_process(process.pid, resources)
+      except OSError as e:
+        process.kill()
+        raise ServiceRunFailed(f'Unable to apply {resources}: {e}') from e
+
+  def prepare_run(self, service_info):
+    '''
+    Get the environment and the executable the service's command is run with
+
+    Returns
+    -------
+    dict
+        The environment
+    str
+        The executable
+    '''
+
     logger.debug('Running: ' + ' '.join(
         [quote(x) for x in service_info.command]))
 
@@ -76,11 +315,7 @@ class Compute(BaseCompute):
                      "If you weren't expecting this, then make sure the "
                      "compute.virtualenv_dir is correct.")
 
-    # run command -- command must be a list of strings
-    pid = Popen(service_info.command, env=env, executable=executable)
-
-    if pid.wait() != 0:
-      raise ServiceRunFailed()
+    return env, executable
 
   def add_volume(self, local, no_remote=None, flags=None, prefix=None,
                  local_must_exist=False):
@@ -101,21 +336,31 @@ class Service(BaseService):
   def pre_run(self):
     super().pre_run()
 
-    # Create a temp directory, store it in this instance
-    self.temp_dir = TemporaryDirectory(suffix=f"_{type(self).__name__}")
-    if self.env.get('TERRA_KEEP_TEMP_DIR', None) == "1":
-      self.temp_dir._finalizer.detach()
-
-    # Use a config.json file to store settings within that temp directory
-    temp_config_file = os.path.join(self.temp_dir.name, 'config.json')
+    self.staged = compute.staging
+    if not self.staged:
+      # Create a temp directory, store it in this instance
+      self.temp_dir = TemporaryDirectory(suffix=f"_{type(self).__name__}")
+      if self.env.get('TERRA_KEEP_TEMP_DIR', None) == "1":
+        self.temp_dir._finalizer.detach()
 
     # Serialize config file
-    venv_config = TerraJSONEncoder.serializableSettings(settings)
+    with phase('serialize_settings'):
+      venv_config = TerraJSONEncoder.serializableSettings(settings)
 
     # Dump the serialized config to the temp config file
     venv_config['terra']['zone'] = 'runner'
-    with open(temp_config_file, 'w') as fid:
-      json.dump(venv_config, fid)
+    if self.staged:
+      # Services with the same settings share the same file
+      with phase('write_settings'):
+        temp_config_file = write_hashed_file(
+            compute.staging_dir, 'settings_',
+            json.dumps(venv_config, sort_keys=True), '.json')
+    else:
+      # Use a config.json file to store settings within that temp directory
+      temp_config_file = os.path.join(self.temp_dir.name, 'config.json')
+      with phase('write_settings'), open(temp_config_file, 'w') as fid:
+        json.dump(venv_config, fid)
+    self.settings_file = temp_config_file
 
     # Set the Terra settings file for this service runner to the temp config
     # file
@@ -123,8 +368,10 @@ class Service(BaseService):
 
   def post_run(self):
     super().post_run()
-    # Delete temp_dir
-    if self.env.get('TERRA_KEEP_TEMP_DIR', None) != "1":
+    # Delete temp_dir. Staged settings files are shared with other services,
+    # and removed with the staging directory
+    if not getattr(self, 'staged', False) and \
+       self.env.get('TERRA_KEEP_TEMP_DIR', None) != "1":
       # Calling this just prevents the annoying warning from saying "Hey, you
       # know that automatic cleanup? It happened! Maybe you should manually
       # call  the automatic cleanup, cause yeah, that makes sense!"
@@ -0,0 +1,180 @@
+'''
+The volumes of services that mount many files and directories
+
+:class:`VolumeSet` collects the volumes of a container service when it is
+run. Volumes that are added more than once are mounted once, and a volume
+that its nearest parent volume already mounts, at the same place and with the
+same flags, is not mounted at all, e.g. ``/data/images:/data/images`` when
+``/data:/data`` is mounted. :class:`VolumeSlots` hands out the
+``{JUST_PROJECT_PREFIX}_VOLUME_{N}`` environment variables the volumes are
+passed to the compose files in.
+
+:meth:`terra.compute.base.BaseService.add_volumes` adds many volumes at once,
+checking that they exist with :func:`missing_paths`, in parallel.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import posixpath
+
+__all__ = ['VolumeSet', 'VolumeSlots', 'missing_paths']
+
+
+def _strip(path, sep):
+  # Trailing separators, but not the root
+  return path.rstrip(sep) or path[:1]
+
+
+class VolumeSet:
+  '''
+  An ordered set of volumes, ``(local, remote, flags)``
+
+  Parameters
+  ----------
+  volumes : list, optional
+      Volumes to start with, ``(local, remote)`` or ``(local, remote,
+      flags)``
+  remote_path : module, optional
+      The path module of the remote paths, :mod:`posixpath` or
+      :mod:`ntpath`
+  '''
+
+  def __init__(self, volumes=(), remote_path=posixpath):
+    self.remote_path = remote_path
+    self._volumes = {}
+    for volume in volumes:
+      self.add(*volume)
+
+  def _key(self, local, remote, flags):
+    return (os.path.normcase(_strip(os.path.normpath(local), os.sep)),
+            _strip(self.remote_path.normpath(remote), self.remote_path.sep),
+            flags or None)
+
+  def add(self, local, remote, flags=None):
+    '''
+    Add a volume
+
+    Returns
+    -------
+    bool
+        ``False`` if the volume was already in the set
+    '''
+
+    key = self._key(local, remote, flags)
+    if key in self._volumes:
+      return False
+    self._volumes[key] = (local, remote, flags)
+    return True
+
+  def __len__(self):
+    return len(self._volumes)
+
+  def __iter__(self):
+    return iter(self._volumes.values())
+
+  def __contains__(self, volume):
+    return self._key(*volume) in self._volumes
+
+  def mounts(self):
+    '''
+    The volumes that need mounting: all of them, except those that their
+    nearest parent volume (on the remote side) already mounts, with the same
+    flags
+
+    Returns
+    -------
+    list
+        The ``(local, remote, flags)`` of each volume, in the order they were
+        added
+    '''
+
+    # The mount at each remote path. Remote paths mounted from more than one
+    # place are ambiguous, and keep everything under them
+    targets = {}
+    for key in self._volumes:
+      local, remote, flags = key
+      targets[remote] = None if remote in targets else (local, flags)
+
+    dirname = self.remote_path.dirname
+    sep = self.remote_path.sep
+    mounts = []
+    for key, volume in self._volumes.items():
+      local, remote, flags = key
+      parent = remote
+      while True:
+        parent, child = dirname(parent), parent
+        if parent == child:
+          # No parent volume
+          mounts.append(volume)
+          break
+        if parent not in targets:
+          continue
+        if targets[parent] is None or targets[parent][1] != flags:
+          mounts.append(volume)
+          break
+        parts = remote[len(parent):].lstrip(sep).split(sep)
+        if os.path.normcase(os.path.join(targets[parent][0],
+                                         *parts)) != local:
+          mounts.append(volume)
+        break
+    return mounts
+
+
+class VolumeSlots:
+  '''
+  Hands out the ``{prefix}_VOLUME_{N}`` environment variables of a service,
+  in order, skipping those that are already set
+
+  Parameters
+  ----------
+  env : dict
+      The environment of the service, updated by :meth:`assign`
+  prefix : str
+      The ``JUST_PROJECT_PREFIX``
+  '''
+
+  def __init__(self, env, prefix):
+    self.env = env
+    self.prefix = f'{prefix}_VOLUME_'
+    self._used = set()
+    for key in env:
+      if key.startswith(self.prefix) and key[len(self.prefix):].isdigit():
+        self._used.add(int(key[len(self.prefix):]))
+    self._next = 1
+
+  def assign(self, volume):
+    '''
+    Set the next free variable to ``volume``
+
+    Returns
+    -------
+    str
+        The name of the variable
+    '''
+
+    while self._next in self._used:
+      self._next += 1
+    name = f'{self.prefix}{self._next}'
+    self.env[name] = volume
+    self._next += 1
+    return name
+
+
+def missing_paths(paths, max_workers=None):
+  '''
+  Check that files and directories exist, in parallel, since each check can
+  be a round trip to a network file system
+
+  Returns
+  -------
+  list
+      The paths that do not exist
+  '''
+
+  paths = list(paths)
+  if len(paths) < 16:
+    exists = map(os.path.exists, paths)
+  else:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      exists = list(executor.map(os.path.exists, paths))
+  return [path for path, found in zip(paths, exists) if not found]
@@ -152,6 +152,7 @@ from uuid import uuid4
 from logging.handlers import DEFAULT_TCP_LOGGING_PORT
 from inspect import isfunction
 from functools import wraps
+from contextlib import contextmanager
 from json import JSONEncoder
 import platform
 import warnings
@@ -319,6 +320,12 @@ global_templates = [
   (  # So much for DRY :(
     {"compute": {"arch": "virtualenv"}},
     {"compute": {"virtualenv_dir": need_to_set_virtualenv_dir}}
+  ),
+  (
+    {"executor": {"type": "TCPExecutor"}},
+    {"executor": {"tcp": {"hostname": "localhost",
+                          # terra.executor.tcp.DEFAULT_TCP_EXECUTOR_PORT
+                          "port": DEFAULT_TCP_LOGGING_PORT + 1}}}
   )
 ]
 ''':class:`list` of (:class:`dict`, :class:`dict`): Templates are how we
@@ -607,14 +614,33 @@ class LazySettingsThreaded(LazySettings):
     '''
     Thread safe version of _wrapped getter
     '''
+    if hasattr(self.__tls, 'settings'):
+      return self.__tls.settings
     thread = threading.current_thread()
     if thread._target == concurrent.futures.thread._worker:
-      if not hasattr(self.__tls, 'settings'):
-        self.__tls.settings = copy.deepcopy(self.__wrapped)
+      self.__tls.settings = copy.deepcopy(self.__wrapped)
       return self.__tls.settings
     else:
       return self.__wrapped
 
+  @contextmanager
+  def thread_settings(self, wrapped):
+    '''
+    Context manager that makes the current thread use ``wrapped`` as its
+    settings, e.g. the settings of the thread that started it
+    '''
+
+    missing = object()
+    previous = getattr(self.__tls, 'settings', missing)
+    self.__tls.settings = wrapped
+    try:
+      yield
+    finally:
+      if previous is missing:
+        del self.__tls.settings
+      else:
+        self.__tls.settings = previous
+
   def __setattr__(self, name, value):
     '''Supported'''
     if name in ("_LazySettingsThreaded__wrapped",
@@ -1,10 +1,229 @@
-from concurrent.futures import Future, Executor
+import os
+from concurrent.futures import Future, Executor, wait, InvalidStateError
+from threading import Lock, Thread
+from logging import NullHandler, StreamHandler
+from logging.handlers import SocketHandler
 
+import terra
+from terra import settings
+from terra.executor.metrics import ExecutorMetrics
 from terra.logger import getLogger
 logger = getLogger(__name__)
 
 
+def _find_futures(args, kwargs):
+  '''
+  Find all the :class:`concurrent.futures.Future` arguments of a call.
+
+  Futures are searched for in the positional and keyword arguments, and one
+  level deep into any :class:`list`, :class:`tuple` or :class:`dict` argument
+  (e.g. a reduce step that takes a list of map futures).
+
+  Returns
+  -------
+  list
+      The futures found, in order of appearance, without duplicates
+  '''
+
+  # Keyed by id, since futures are compared by identity. Dicts keep the order
+  futures = {}
+
+  def collect(value):
+    if isinstance(value, Future):
+      futures.setdefault(id(value), value)
+    elif isinstance(value, (list, tuple)):
+      for item in value:
+        if isinstance(item, Future):
+          futures.setdefault(id(item), item)
+    elif isinstance(value, dict):
+      for item in value.values():
+        if isinstance(item, Future):
+          futures.setdefault(id(item), item)
+
+  for arg in args:
+    collect(arg)
+  for arg in kwargs.values():
+    collect(arg)
+  return list(futures.values())
+
+
+def _resolve_futures(args, kwargs):
+  '''
+  Replace every future found by :func:`_find_futures` with its result. All
+  the futures must already be done.
+  '''
+
+  def resolve(value):
+    if isinstance(value, Future):
+      return value.result()
+    elif isinstance(value, (list, tuple)):
+      return type(value)(resolve(item) if isinstance(item, Future) else item
+                         for item in value)
+    elif isinstance(value, dict):
+      return type(value)((key, item.result()) if isinstance(item, Future)
+                         else (key, item) for key, item in value.items())
+    return value
+
+  return (tuple(resolve(arg) for arg in args),
+          {key: resolve(value) for key, value in kwargs.items()})
+
+
 class BaseExecutor(Executor):
+  '''
+  The base class for all Terra Executors
+
+  Besides the standard :class:`concurrent.futures.Executor` interface, Terra
+  executors accept futures as arguments to ``submit``. Such a task is held
+  until all of its input futures are done, and is then dispatched with the
+  futures replaced by their results. This allows map-reduce and diamond shaped
+  dependencies to be submitted all at once, without the controller having to
+  wait on ``as_completed`` between stages.
+
+  If any input future fails or is cancelled, the task is never dispatched, and
+  its future is resolved with the same exception (or
+  :class:`concurrent.futures.CancelledError`).
+
+  Every executor also records :attr:`metrics` on the tasks it runs.
+
+  Executor implementations should start ``submit`` with a call to
+  :meth:`_submit_dependent`, pass the future of every task they run to
+  ``self.metrics.track``, start ``shutdown`` with a call to
+  :meth:`_wait_dependent` and end it with ``self.metrics.shutdown()``
+  '''
+
+  _dispatch_dependent_in_thread = False
+  '''bool: Dependent tasks are dispatched from the done callback of their last
+  input future. Set this to ``True`` for executors where submitting from
+  inside a done callback is unsafe, so that a short lived thread is used
+  instead.'''
+
+  def __init__(self):
+    # Executors that also inherit from a concurrent.futures executor call this
+    # explicitly, since those don't call super().__init__
+    self._dependent_futures = set()
+    self._dependent_lock = Lock()
+
+  @property
+  def metrics(self):
+    '''
+    :class:`terra.executor.metrics.ExecutorMetrics`: Queue depth, latency and
+    throughput metrics of the tasks run by this executor
+    '''
+    # Created on first use, since executors can be created before the
+    # settings are configured
+    try:
+      return self._metrics
+    except AttributeError:
+      self._metrics = ExecutorMetrics.from_settings(type(self).__name__)
+      return self._metrics
+
+  def _submit_dependent(self, fn, args, kwargs):
+    '''
+    Handle a ``submit`` call whose arguments contain futures.
+
+    Returns
+    -------
+    :class:`BaseFuture` or None
+        ``None`` if there are no futures in the arguments, and the caller
+        should submit normally. Otherwise, a future that will be resolved
+        once the task has been dispatched and finished.
+    '''
+
+    dependencies = _find_futures(args, kwargs)
+    if not dependencies:
+      return None
+
+    future = BaseFuture()
+    lock = Lock()
+    remaining = [len(dependencies)]
+    self._hold_shutdown(future)
+
+    def dispatch():
+      if future.cancelled():
+        return
+
+      for dependency in dependencies:
+        if dependency.cancelled() or dependency.exception() is not None:
+          try:
+            if dependency.cancelled():
+              future.cancel()
+            else:
+              future.set_exception(dependency.exception())
+          except InvalidStateError:  # pragma: no cover
+            pass
+          return
+
+      resolved_args, resolved_kwargs = _resolve_futures(args, kwargs)
+      logger.debug4(f'Dispatching dependent task {fn}')
+      try:
+        inner = self.submit(fn, *resolved_args, **resolved_kwargs)
+      except BaseException as e:
+        future.set_exception(e)
+        return
+
+      # Let a cancel on the dependent future try to stop the real task
+      future.add_done_callback(
+          lambda f: inner.cancel() if f.cancelled() else None)
+      inner.add_done_callback(copy_state)
+
+    def copy_state(inner):
+      try:
+        if inner.cancelled():
+          future.cancel()
+        elif inner.exception() is not None:
+          future.set_exception(inner.exception())
+        else:
+          future.set_result(inner.result())
+      except InvalidStateError:  # pragma: no cover
+        # The dependent future was cancelled in the mean time
+        pass
+
+    def input_done(_):
+      with lock:
+        remaining[0] -= 1
+        ready = remaining[0] == 0
+      if ready:
+        if self._dispatch_dependent_in_thread:
+          thread = Thread(target=dispatch)
+          thread.daemon = True
+          thread.start()
+        else:
+          dispatch()
+
+    for dependency in dependencies:
+      dependency.add_done_callback(input_done)
+
+    return future
+
+  def _hold_shutdown(self, future):
+    '''
+    Make :meth:`_wait_dependent` (and therefore ``shutdown``) wait for
+    ``future``, for work that will submit more tasks to this executor later
+    '''
+
+    with self._dependent_lock:
+      self._dependent_futures.add(future)
+    # Outside of the lock, since a done future calls back right away
+    future.add_done_callback(self._release_shutdown)
+
+  def _release_shutdown(self, future):
+    with self._dependent_lock:
+      self._dependent_futures.discard(future)
+
+  def _wait_dependent(self):
+    '''
+    Wait for all the dependent futures submitted to this executor to finish.
+    Must be called by ``shutdown`` before new submissions are refused.
+    '''
+
+    while True:
+      with self._dependent_lock:
+        pending = tuple(self._dependent_futures)
+      if not pending:
+        return
+      # Dependent futures done in the mean time may have added more
+      wait(pending)
+
   @staticmethod
   def configure_logger(sender, **kwargs):
     pass
@@ -14,5 +233,73 @@ class BaseExecutor(Executor):
     pass
 
 
+class RemoteExecutor(BaseExecutor):
+  '''
+  The base class for executors whose tasks are run by separate worker
+  processes, possibly on other hosts (e.g. celery workers)
+
+  The process managing the workers runs in the ``task_controller`` zone, and
+  logs to the log file in the ``processing_dir``. The tasks themselves run in
+  the ``task`` zone, and send their logs back to the master controller's
+  logging server.
+  '''
+
+  @staticmethod
+  def configure_logger(sender, **kwargs):
+    if settings.terra.zone == 'task':  # pragma: no cover
+      # This will never really be reached, because the task_controller will
+      # configure the logger, and then fork.
+      sender.main_log_handler = NullHandler()
+    elif settings.terra.zone == 'task_controller':
+      # Setup log file for use in configure
+      if os.environ.get('TERRA_DISABLE_TERRA_LOG') != '1':
+        sender._log_file = os.path.join(settings.processing_dir,
+                                        terra.logger._logs.default_log_prefix)
+      else:
+        sender._log_file = os.devnull
+      os.makedirs(settings.processing_dir, exist_ok=True)
+      sender._log_file = open(sender._log_file, 'a')
+      sender.main_log_handler = StreamHandler(stream=sender._log_file)
+      sender.root_logger.addHandler(sender.main_log_handler)
+
+  @staticmethod
+  def reconfigure_logger(sender, pre_run_task=False,
+                         post_settings_context=False, **kwargs):
+    if settings.terra.zone == 'task':
+      if pre_run_task:
+        if sender.main_log_handler:
+          sender.main_log_handler.close()
+          try:
+            sender.root_logger.removeHandler(sender.main_log_handler)
+          except ValueError:
+            pass
+        sender.main_log_handler = SocketHandler(
+            settings.logging.server.hostname,
+            settings.logging.server.port)
+        sender.root_logger.addHandler(sender.main_log_handler)
+      if post_settings_context:
+        # when the celery task is done, its logger is automatically
+        # reconfigured; use that opportunity to close the stream
+        if sender.main_log_handler:
+          sender.main_log_handler.close()
+          try:
+            sender.root_logger.removeHandler(sender.main_log_handler)
+          except ValueError:
+            pass
+          sender.main_log_handler = NullHandler()
+          sender.root_logger.addHandler(sender.main_log_handler)
+    elif settings.terra.zone == 'task_controller':
+      if os.environ.get('TERRA_DISABLE_TERRA_LOG') != '1':
+        log_file = os.path.join(settings.processing_dir,
+                                terra.logger._logs.default_log_prefix)
+      else:
+        log_file = os.devnull
+
+      if log_file != sender._log_file.name:
+        os.makedirs(settings.processing_dir, exist_ok=True)
+        sender._log_file.close()
+        sender._log_file = open(log_file, 'a')
+
+
 class BaseFuture(Future):
   pass
@@ -21,6 +21,9 @@ if main_name is None:
 app = Celery(main_name)
 
 app.config_from_object(env['TERRA_CELERY_CONF'])
+# Report the STARTED state, so that executors can tell running tasks from
+# queued ones, e.g. for speculative execution and the run time metrics
+app.conf.task_track_started = True
 
 
 @worker_process_init.connect
@@ -16,21 +16,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
 from os import environ as env
 from concurrent.futures import as_completed
 from concurrent.futures._base import (RUNNING, FINISHED, CANCELLED,
                                       CANCELLED_AND_NOTIFIED)
 from threading import Lock, Thread
 import time
-from logging import NullHandler, StreamHandler
-from logging.handlers import SocketHandler
 
 from celery.signals import setup_logging
 
-from terra.executor.base import BaseFuture, BaseExecutor
-import terra
-from terra import settings
+from terra.executor.base import BaseFuture, RemoteExecutor
+from terra.executor.speculative import Speculator
+from terra.executor.utils import worker_configuration_map
 from terra.logger import getLogger
 logger = getLogger(__name__)
 
@@ -90,7 +87,7 @@ class CeleryExecutorFuture(BaseFuture):
       return result
 
 
-class CeleryExecutor(BaseExecutor):
+class CeleryExecutor(RemoteExecutor):
   """
   Executor implementation using celery tasks.
 
@@ -108,11 +105,15 @@ class CeleryExecutor(BaseExecutor):
       Sugar to set an alternative queue specially for errors
   update_delay
       Delay time between checks for Future state changes
+  speculative
+      Enable speculative re-execution of straggling tasks. See
+      :meth:`terra.executor.speculative.Speculator.from_options`
   """
 
   def __init__(self, predelay=None, postdelay=None, applyasync_kwargs=None,
                retry_kwargs=None, retry_queue='', update_delay=0.1,
-               max_workers=None):
+               max_workers=None, speculative=None):
+    super().__init__()
     # Options about calling the Task
     self._predelay = predelay
     self._postdelay = postdelay
@@ -132,6 +133,8 @@ class CeleryExecutor(BaseExecutor):
     self._monitor_stopping = False
     self._monitor = Thread(target=self._update_futures)
     self._monitor.setDaemon(True)
+    self._speculator = Speculator.from_options(speculative, self._submit,
+                                               self._revoke)
 
   def _update_futures(self):
     while True:
@@ -156,7 +159,8 @@ class CeleryExecutor(BaseExecutor):
             fut.set_running_or_notify_cancel()
           # Future is CANCELLED -> CANCELLED_AND_NOTIFIED
 
-        elif ar.state in ('RUNNING', 'RETRY'):
+        elif ar.state in ('STARTED', 'RUNNING', 'RETRY'):
+          # STARTED needs task_track_started, see terra.executor.celery
           logger.debug4('Celery task "%s" running.', ar.id)
           if not fut.running():
             fut.set_running_or_notify_cancel()
@@ -172,12 +176,21 @@ class CeleryExecutor(BaseExecutor):
           fut.set_exception(ar.result)
           # Future is FINISHED
 
-        # else:  # ar.state in [RECEIVED, STARTED, REJECTED, RETRY]
+        # else:  # ar.state in [PENDING, RECEIVED, REJECTED]
         #     pass
 
   def submit(self, fn, *args, **kwargs):
     """
     """  # Original python comment has * and isn't napoleon compatible
+    dependent = self._submit_dependent(fn, args, kwargs)
+    if dependent is not None:
+      return dependent
+
+    if self._speculator is not None:
+      return self._speculator.submit(fn, *args, **kwargs)
+    return self._submit(fn, *args, **kwargs)
+
+  def _submit(self, fn, *args, **kwargs):
     with self._shutdown_lock:
       if self._shutdown:
         raise RuntimeError('cannot schedule new futures after shutdown')
@@ -200,11 +213,24 @@ class CeleryExecutor(BaseExecutor):
         self._postdelay(asyncresult)
 
       future = CeleryExecutorFuture(asyncresult)
+      self.metrics.track(future, fn)
       self._futures.add(future)
       return future
 
+  @staticmethod
+  def _revoke(future):
+    # A losing speculative copy is most likely already running on a worker,
+    # which a normal cancel will not stop
+    if not future.cancel():
+      logger.debug4(f'Terminating task {future._ar.id}')
+      future._ar.revoke(terminate=True)
+
   def shutdown(self, wait=True):
     logger.debug1('Shutting down celery tasks...')
+    if wait:
+      self._wait_dependent()
+    if self._speculator is not None:
+      self._speculator.shutdown()
     with self._shutdown_lock:
       self._shutdown = True
       for fut in tuple(self._futures):
@@ -220,87 +246,8 @@ class CeleryExecutor(BaseExecutor):
       except RuntimeError:  # pragma: no cover
         # Thread never started. Cannot join
         pass
+    self.metrics.shutdown()
 
   @staticmethod
   def configuration_map(service_info):
-    from terra.compute import compute
-    service_name = env['TERRA_CELERY_SERVICE']
-
-    class ServiceClone:
-      def __init__(self, service_info):
-        self.compose_service_name = service_name
-
-        if hasattr(service_info, 'justfile'):
-          self.justfile = service_info.justfile
-        if hasattr(service_info, 'compose_files'):
-          self.compose_files = service_info.compose_files
-
-        self.env = env  # .copy()
-        self.volumes = []
-
-    service_clone = ServiceClone(service_info)
-
-    if hasattr(compute, 'config'):
-      config = compute.config(service_clone)
-    else:
-      config = None
-
-    volume_map = compute.get_volume_map(config, service_clone)
-
-    return volume_map
-
-  @staticmethod
-  def configure_logger(sender, **kwargs):
-    if settings.terra.zone == 'task':  # pragma: no cover
-      # This will never really be reached, because the task_controller will
-      # configure the logger, and then fork.
-      sender.main_log_handler = NullHandler()
-    elif settings.terra.zone == 'task_controller':
-      # Setup log file for use in configure
-      if os.environ.get('TERRA_DISABLE_TERRA_LOG') != '1':
-        sender._log_file = os.path.join(settings.processing_dir,
-                                        terra.logger._logs.default_log_prefix)
-      else:
-        sender._log_file = os.devnull
-      os.makedirs(settings.processing_dir, exist_ok=True)
-      sender._log_file = open(sender._log_file, 'a')
-      sender.main_log_handler = StreamHandler(stream=sender._log_file)
-      sender.root_logger.addHandler(sender.main_log_handler)
-
-  @staticmethod
-  def reconfigure_logger(sender, pre_run_task=False,
-                         post_settings_context=False, **kwargs):
-    if settings.terra.zone == 'task':
-      if pre_run_task:
-        if sender.main_log_handler:
-          sender.main_log_handler.close()
-          try:
-            sender.root_logger.removeHandler(sender.main_log_handler)
-          except ValueError:
-            pass
-        sender.main_log_handler = SocketHandler(
-            settings.logging.server.hostname,
-            settings.logging.server.port)
-        sender.root_logger.addHandler(sender.main_log_handler)
-      if post_settings_context:
-        # when the celery task is done, its logger is automatically
-        # reconfigured; use that opportunity to close the stream
-        if sender.main_log_handler:
-          sender.main_log_handler.close()
-          try:
-            sender.root_logger.removeHandler(sender.main_log_handler)
-          except ValueError:
-            pass
-          sender.main_log_handler = NullHandler()
-          sender.root_logger.addHandler(sender.main_log_handler)
-    elif settings.terra.zone == 'task_controller':
-      if os.environ.get('TERRA_DISABLE_TERRA_LOG') != '1':
-        log_file = os.path.join(settings.processing_dir,
-                                terra.logger._logs.default_log_prefix)
-      else:
-        log_file = os.devnull
-
-      if log_file != sender._log_file.name:
-        os.makedirs(settings.processing_dir, exist_ok=True)
-        sender._log_file.close()
-        sender._log_file = open(log_file, 'a')
+    return worker_configuration_map(env['TERRA_CELERY_SERVICE'], service_info)
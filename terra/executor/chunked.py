@@ -0,0 +1,254 @@
+'''
+Adaptive chunking for :meth:`Executor.map<concurrent.futures.Executor.map>`
+
+:class:`concurrent.futures.ProcessPoolExecutor` sends ``map`` items to its
+workers in chunks of a fixed ``chunksize``. Too small, and cheap items are
+drowned out by the overhead of sending each chunk; too large, and a few
+workers are left running the last chunks while the rest of the pool sits idle.
+
+:func:`adaptive_map` measures how long items take as the map runs instead.
+It starts with single item chunks, and doubles the chunk size while a chunk
+takes less than ``target_duration`` to run. Towards the end of the input, the
+chunks are shrunk again, so that the remaining items are spread over all the
+workers. Results can be yielded in the order of the input, like ``map``, or
+in the order the chunks finish.
+'''
+
+from concurrent.futures import Future, wait, FIRST_COMPLETED, TimeoutError
+from math import ceil
+from queue import Queue, Empty
+from threading import Event, Thread
+import time
+
+from terra.logger import getLogger
+logger = getLogger(__name__)
+
+__all__ = ['AdaptiveChunker', 'adaptive_map']
+
+
+def _run_chunk(fn, chunk):
+  # Module level, so it can be pickled for process pools. The results before
+  # a failed item are still returned, so they can be yielded before the error
+  start = time.perf_counter()
+  results = []
+  try:
+    for args in chunk:
+      results.append(fn(*args))
+  except Exception as error:
+    return results, time.perf_counter() - start, error
+  return results, time.perf_counter() - start, None
+
+
+class AdaptiveChunker:
+  '''
+  Picks the size of the next chunk of a map, from the measured cost per item
+
+  Parameters
+  ----------
+  workers : int
+      Number of workers running the chunks
+  target_duration : float, optional
+      How long, in seconds, a chunk should take to run. Default: ``0.05``
+  max_chunksize : int, optional
+      Upper limit on the chunk size
+  chunksize : int, optional
+      Disable the adaptation, and always use this chunk size
+  smoothing : float, optional
+      Weight of the newest measurement in the moving average of the cost per
+      item. Default: ``0.3``
+  '''
+
+  def __init__(self, workers, target_duration=0.05, max_chunksize=None,
+               chunksize=None, smoothing=0.3):
+    self.workers = max(1, workers or 1)
+    self.target_duration = target_duration
+    self.max_chunksize = max_chunksize
+    self.chunksize = chunksize
+    self.smoothing = smoothing
+
+    self.size = 1
+    self.cost = None
+    '''float: Moving average of the cost per item, in seconds'''
+
+  def record(self, size, duration):
+    '''
+    Record that a chunk of ``size`` items took ``duration`` seconds to run
+    '''
+
+    cost = duration / size
+    if self.cost is None:
+      self.cost = cost
+    else:
+      self.cost += self.smoothing * (cost - self.cost)
+
+  def next_size(self, remaining):
+    '''
+    Get the size of the next chunk
+
+    Parameters
+    ----------
+    remaining : int
+        The number of items not yet submitted
+
+    Returns
+    -------
+    int
+        The chunk size, never more than ``remaining``
+    '''
+
+    if self.chunksize is not None:
+      return max(1, min(self.chunksize, remaining))
+
+    if self.cost is not None:
+      # Grow at most twice as big at a time, until a chunk takes the target
+      # duration
+      if self.cost > 0:
+        ideal = int(self.target_duration / self.cost)
+      else:
+        ideal = self.size * 2
+      self.size = max(1, min(self.size * 2, ideal))
+      if self.max_chunksize:
+        self.size = min(self.size, self.max_chunksize)
+
+    # Near the end, leave enough chunks for every worker to get a couple,
+    # instead of a few workers finishing off big chunks
+    tail = ceil(remaining / (2 * self.workers))
+    return max(1, min(self.size, tail, remaining))
+
+
+def adaptive_map(executor, fn, *iterables, timeout=None, ordered=True,
+                 chunksize=None, target_duration=0.05, max_chunksize=None):
+  '''
+  Run ``fn`` over the items of ``iterables`` on ``executor``, in chunks that
+  adapt to the cost of the items
+
+  The chunks are submitted by a feeder thread, that keeps two chunks per
+  worker in flight, so the map makes progress whether or not the results are
+  being consumed.
+
+  Parameters
+  ----------
+  executor : :class:`concurrent.futures.Executor`
+      The executor the chunks are submitted to
+  fn : :term:`function`
+      The function applied to each item. Must be picklable for process pools
+  iterables
+      Same as for :func:`map`
+  timeout : float, optional
+      Same as for :meth:`concurrent.futures.Executor.map`
+  ordered : bool, optional
+      ``True`` yields the results in the order of the input. ``False`` streams
+      the results in the order their chunks finish. Default: ``True``
+  chunksize : int, optional
+      Use fixed size chunks instead of adapting their size
+  target_duration : float, optional
+      See :class:`AdaptiveChunker`
+  max_chunksize : int, optional
+      See :class:`AdaptiveChunker`
+
+  Returns
+  -------
+  :term:`iterator`
+      The results. If ``fn`` raises an exception, it is raised when its result
+      would have been retrieved from the iterator
+  '''
+
+  if timeout is not None:
+    end_time = timeout + time.monotonic()
+
+  items = list(zip(*iterables))
+  workers = getattr(executor, '_max_workers', None) or 1
+  chunker = AdaptiveChunker(workers, target_duration=target_duration,
+                            max_chunksize=max_chunksize, chunksize=chunksize)
+  # (start, size, results, exception) for every chunk, then None
+  finished = Queue()
+  stopping = Event()
+
+  def feed():
+    starts = {}
+    pending = set()
+    index = 0
+    failed = False
+    try:
+      while not stopping.is_set():
+        while not failed and index < len(items) and \
+            len(pending) < 2 * chunker.workers:
+          size = chunker.next_size(len(items) - index)
+          future = executor.submit(_run_chunk, fn, items[index:index + size])
+          starts[future] = (index, size)
+          pending.add(future)
+          index += size
+
+        if not pending:
+          break
+
+        done, pending = wait(pending, timeout=0.1,
+                             return_when=FIRST_COMPLETED)
+        for future in done:
+          start, size = starts.pop(future)
+          try:
+            results, duration, error = future.result()
+          except BaseException as e:
+            results, error = [], e
+          else:
+            chunker.record(max(1, len(results)), duration)
+          if error is not None:
+            # Stop submitting, but let the chunks before it finish
+            failed = True
+          finished.put((start, size, results, error))
+    except BaseException as error:  # pragma: no cover
+      finished.put((index, 0, None, error))
+    finally:
+      # The results are no longer wanted
+      for future in pending:
+        future.cancel()
+      finished.put(None)
+      feeding.set_result(None)
+
+  # Like a normal map, shutting down the executor waits for the whole map
+  feeding = Future()
+  if hasattr(executor, '_hold_shutdown'):
+    executor._hold_shutdown(feeding)
+
+  feeder = Thread(target=feed)
+  feeder.daemon = True
+  feeder.start()
+
+  def result_iterator():
+    buffered = {}
+    next_start = 0
+    try:
+      while True:
+        try:
+          if timeout is None:
+            chunk = finished.get()
+          else:
+            chunk = finished.get(timeout=max(0, end_time - time.monotonic()))
+        except Empty:
+          raise TimeoutError() from None
+
+        if chunk is None:
+          # Only left over when an earlier chunk never finished
+          for _, _, error in buffered.values():
+            if error is not None:
+              raise error
+          return
+
+        start, size, results, error = chunk
+        if not ordered:
+          yield from results
+          if error is not None:
+            raise error
+          continue
+
+        buffered[start] = (size, results, error)
+        while next_start in buffered:
+          size, results, error = buffered.pop(next_start)
+          yield from results
+          if error is not None:
+            raise error
+          next_start += size
+    finally:
+      stopping.set()
+
+  return result_iterator()
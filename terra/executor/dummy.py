@@ -14,6 +14,7 @@ class DummyExecutor(BaseExecutor):
   """
 
   def __init__(self, *arg, **kwargs):
+    super().__init__()
     self._shutdown = False
     self._shutdown_lock = Lock()
 
@@ -0,0 +1,395 @@
+'''
+Instrumentation for Terra executors
+
+Every Terra executor keeps an :class:`ExecutorMetrics` object, available as
+``executor.metrics``, that records when each task was submitted, started and
+finished. From these the queue wait, run time and total latency of each task
+are kept in :class:`Histogram` objects, along with counts of in-flight, failed
+and cancelled tasks, and the throughput. This is meant to size worker pools
+from measurements rather than guesses.
+
+Two optional outputs are controlled by :option:`executor.metrics`:
+
+* ``log_interval`` - Log a one line summary every ``log_interval`` seconds
+* ``file`` - ``jsonl`` or ``csv``, write one record per finished task to
+  ``executor_metrics.{jsonl,csv}`` in the
+  :func:`processing_dir<terra.core.settings.processing_dir>`
+'''
+
+import os
+import csv
+import json
+import time
+from threading import Lock, Thread, Event
+from concurrent.futures import CancelledError
+
+from terra import settings
+from terra.logger import getLogger
+logger = getLogger(__name__)
+
+__all__ = ['Histogram', 'ExecutorMetrics']
+
+
+class Histogram:
+  '''
+  A log-linear histogram of durations, in the style of an HDR histogram
+
+  Values are stored in microseconds. Each power of two range is split into
+  ``2**precision`` equal sub-buckets, so the recorded value of any sample is
+  within a relative error of ``2**-precision`` (less than 1% by default),
+  while the memory used only grows with the logarithm of the value range.
+
+  Parameters
+  ----------
+  precision : int, optional
+      Number of bits of precision kept for each value. Default: ``7``
+  '''
+
+  def __init__(self, precision=7):
+    self.precision = precision
+    self.buckets = {}
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def _bucket(self, value):
+    micro = int(value * 1e6)
+    shift = max(0, micro.bit_length() - self.precision)
+    return (micro >> shift) << shift
+
+  def record(self, value):
+    '''
+    Record a duration, in seconds
+    '''
+
+    value = max(0.0, value)
+    bucket = self._bucket(value)
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  @property
+  def mean(self):
+    '''float: The mean of the recorded values, or ``None`` if empty'''
+    if not self.count:
+      return None
+    return self.total / self.count
+
+  def percentile(self, percent):
+    '''
+    Get a percentile of the recorded values
+
+    Parameters
+    ----------
+    percent : float
+        The percentile, from 0 to 100
+
+    Returns
+    -------
+    float
+        The value, in seconds, or ``None`` if nothing was recorded
+    '''
+
+    if not self.count:
+      return None
+    if percent >= 100:
+      return self.max
+
+    target = max(1, percent / 100.0 * self.count)
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= target:
+        # Report the lower bound of the bucket, clamped to the real range
+        return min(max(bucket / 1e6, self.min), self.max)
+    return self.max  # pragma: no cover
+
+  def to_dict(self):
+    '''
+    Summary of the histogram as a json serializable :class:`dict`
+    '''
+
+    return {'count': self.count,
+            'min': self.min,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max}
+
+
+class _TaskRecord:
+  __slots__ = ('name', 'submit', 'start', 'finish', 'status')
+
+  def __init__(self, name):
+    self.name = name
+    self.submit = time.time()
+    self.start = None
+    self.finish = None
+    self.status = 'pending'
+
+
+class ExecutorMetrics:
+  '''
+  Records the life cycle of every task submitted to an executor
+
+  Parameters
+  ----------
+  name : str
+      Name of the executor, used in the log messages and records
+  log_interval : float, optional
+      If set, log a summary line every ``log_interval`` seconds while tasks
+      are being run
+  file_format : str, optional
+      ``jsonl`` or ``csv``. If set, write a record for every finished task to
+      ``executor_metrics.{file_format}`` in ``processing_dir``
+  processing_dir : str, optional
+      Directory the records are written to. Defaults to
+      ``settings.processing_dir``
+  '''
+
+  record_fields = ('executor', 'name', 'status', 'submit', 'start', 'finish',
+                   'queue_wait', 'run_time')
+
+  def __init__(self, name, log_interval=None, file_format=None,
+               processing_dir=None):
+    self.name = name
+    self.log_interval = log_interval
+    self.file_format = file_format
+    self.processing_dir = processing_dir
+
+    self._lock = Lock()
+    self._file = None
+    self._writer = None
+    self._stopping = Event()
+    self._monitor = None
+
+    self.submitted = 0
+    self.started = 0
+    self.running = 0
+    self.finished = 0
+    self.failed = 0
+    self.cancelled = 0
+    self._first_submit = None
+    self._last_finish = None
+    self.histograms = {'queue_wait': Histogram(),
+                       'run_time': Histogram(),
+                       'latency': Histogram()}
+    '''dict: :class:`Histogram` of the ``queue_wait``, ``run_time`` and
+    ``latency`` (submit to finish) of the tasks'''
+
+  @classmethod
+  def from_settings(cls, name):
+    '''
+    Create an :class:`ExecutorMetrics` using :option:`executor.metrics`, if
+    the settings are configured.
+    '''
+
+    options = {}
+    if settings.configured:
+      options = settings.executor.get('metrics', None) or {}
+    return cls(name, log_interval=options.get('log_interval', None),
+               file_format=options.get('file', None))
+
+  @property
+  def in_flight(self):
+    '''int: Number of tasks submitted, but not done yet'''
+    return self.submitted - self.finished - self.failed - self.cancelled
+
+  @property
+  def queued(self):
+    '''int: Number of tasks in flight, but not known to be running'''
+    return self.in_flight - self.running
+
+  @property
+  def throughput(self):
+    '''
+    float: Tasks finished (or failed) per second, from the first submit to the
+    last finish, or ``None`` before any task is finished
+    '''
+    if self._last_finish is None:
+      return None
+    elapsed = self._last_finish - self._first_submit
+    done = self.finished + self.failed
+    return done / elapsed if elapsed > 0 else None
+
+  def track(self, future, fn):
+    '''
+    Start tracking a task's future
+
+    Parameters
+    ----------
+    future : :class:`concurrent.futures.Future`
+        The future, as returned by the executor, before it has started
+    fn : :term:`function`
+        The function being run, used to name the records
+
+    Returns
+    -------
+    :class:`concurrent.futures.Future`
+        The same ``future``, for convenience
+    '''
+
+    record = _TaskRecord(getattr(fn, 'name', None)
+                         or getattr(fn, '__qualname__', None) or repr(fn))
+
+    with self._lock:
+      self.submitted += 1
+      if self._first_submit is None:
+        self._first_submit = record.submit
+      if self._monitor is None and self.log_interval:
+        self._monitor = Thread(target=self._watch)
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    # Executors mark a future as running right before its task is started (or
+    # handed to a worker), so hook in there to get the start time. An idle
+    # thread pool worker can start the task before this hook is in place; the
+    # submit time is used then, which is accurate since it did not queue.
+    original_set_running = future.set_running_or_notify_cancel
+
+    def set_running_or_notify_cancel():
+      running = original_set_running()
+      if running:
+        record.start = time.time()
+        with self._lock:
+          self.started += 1
+          self.running += 1
+      return running
+
+    future.set_running_or_notify_cancel = set_running_or_notify_cancel
+    future.add_done_callback(lambda future: self._done(record, future))
+    return future
+
+  def _done(self, record, future):
+    record.finish = time.time()
+    try:
+      record.status = 'failed' if future.exception() else 'done'
+    except CancelledError:
+      record.status = 'cancelled'
+
+    with self._lock:
+      if record.start is not None:
+        self.running -= 1
+      if record.status == 'cancelled':
+        self.cancelled += 1
+      else:
+        if record.status == 'failed':
+          self.failed += 1
+        else:
+          self.finished += 1
+        # Some executors never mark a future as running
+        start = record.start if record.start is not None else record.submit
+        self.histograms['queue_wait'].record(start - record.submit)
+        self.histograms['run_time'].record(record.finish - start)
+        self.histograms['latency'].record(record.finish - record.submit)
+        self._last_finish = record.finish
+
+      if self.file_format:
+        self._write(record)
+
+  def _write(self, record):
+    # Must be called with the lock held
+    start = record.start if record.start is not None else record.submit
+    row = {'executor': self.name,
+           'name': record.name,
+           'status': record.status,
+           'submit': record.submit,
+           'start': record.start,
+           'finish': record.finish,
+           'queue_wait': start - record.submit,
+           'run_time': record.finish - start}
+
+    try:
+      if self._file is None:
+        processing_dir = self.processing_dir or settings.processing_dir
+        os.makedirs(processing_dir, exist_ok=True)
+        filename = os.path.join(processing_dir,
+                                f'executor_metrics.{self.file_format}')
+        new_file = not os.path.exists(filename)
+        self._file = open(filename, 'a', newline='')
+        if self.file_format == 'csv':
+          self._writer = csv.DictWriter(self._file, self.record_fields)
+          if new_file:
+            self._writer.writeheader()
+
+      if self.file_format == 'csv':
+        self._writer.writerow(row)
+      else:
+        self._file.write(json.dumps(row) + '\n')
+      self._file.flush()
+    except OSError as e:  # pragma: no cover
+      logger.warning(f'Unable to write executor metrics: {e}')
+      self.file_format = None
+
+  def snapshot(self):
+    '''
+    Get the current state of all the metrics
+
+    Returns
+    -------
+    dict
+        json serializable summary of the counters and histograms
+    '''
+
+    with self._lock:
+      return {'executor': self.name,
+              'submitted': self.submitted,
+              'started': self.started,
+              'running': self.running,
+              'finished': self.finished,
+              'failed': self.failed,
+              'cancelled': self.cancelled,
+              'in_flight': self.in_flight,
+              'queued': self.queued,
+              'throughput': self.throughput,
+              **{name: histogram.to_dict()
+                 for name, histogram in self.histograms.items()}}
+
+  def summary(self):
+    '''
+    A one line, human readable, summary of the metrics
+    '''
+
+    def fmt(value):
+      return '-' if value is None else f'{value:.3f}s'
+
+    snapshot = self.snapshot()
+    wait = snapshot['queue_wait']
+    run = snapshot['run_time']
+    throughput = snapshot['throughput']
+    throughput = '-' if throughput is None else f'{throughput:.2f}'
+    return (f"{self.name}: {snapshot['submitted']} submitted, "
+            f"{snapshot['in_flight']} in flight ({snapshot['queued']} "
+            f"queued), {snapshot['finished']} done, {snapshot['failed']} "
+            f"failed, {snapshot['cancelled']} cancelled, {throughput} "
+            f"tasks/s; queue wait "
+            f"p50={fmt(wait['p50'])} p99={fmt(wait['p99'])}; run time "
+            f"p50={fmt(run['p50'])} p99={fmt(run['p99'])} "
+            f"max={fmt(run['max'])}")
+
+  def _watch(self):
+    while not self._stopping.wait(self.log_interval):
+      logger.info(self.summary())
+
+  def shutdown(self):
+    '''
+    Stop the periodic logging, log a final summary and close the records file
+    '''
+
+    self._stopping.set()
+    if self._monitor is not None:
+      self._monitor.join()
+      self._monitor = None
+    if self.submitted:
+      logger.info(self.summary())
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+        self._writer = None
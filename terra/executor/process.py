@@ -1,9 +1,64 @@
 import concurrent.futures
+
 import terra.executor.base
+from terra.executor.chunked import adaptive_map
+from terra.executor.speculative import Speculator
 
 __all__ = ['ProcessPoolExecutor']
 
 
 class ProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor,
                           terra.executor.base.BaseExecutor):
-  pass
+  '''
+  Terra version of :class:`concurrent.futures.ProcessPoolExecutor`
+
+  Parameters
+  ----------
+  speculative : bool or dict, optional
+      Enable speculative re-execution of straggling tasks. See
+      :meth:`terra.executor.speculative.Speculator.from_options`. Since a
+      running process pool task cannot be stopped, the losing copy of a
+      speculated task runs to completion, and its result is discarded.
+  '''
+
+  # Done callbacks run in the executor's management thread, which must not
+  # block on its own wakeup pipe
+  _dispatch_dependent_in_thread = True
+
+  def __init__(self, *args, speculative=None, **kwargs):
+    super().__init__(*args, **kwargs)
+    terra.executor.base.BaseExecutor.__init__(self)
+    self._speculator = Speculator.from_options(speculative, self._submit)
+
+  def submit(self, fn, *args, **kwargs):
+    dependent = self._submit_dependent(fn, args, kwargs)
+    if dependent is not None:
+      return dependent
+    if self._speculator is not None:
+      return self._speculator.submit(fn, *args, **kwargs)
+    return self._submit(fn, *args, **kwargs)
+
+  def _submit(self, fn, *args, **kwargs):
+    return self.metrics.track(super().submit(fn, *args, **kwargs), fn)
+
+  def map(self, fn, *iterables, timeout=None, chunksize=None, ordered=True,
+          target_duration=0.05):
+    '''
+    Same as :meth:`concurrent.futures.Executor.map`, except the items are
+    sent to the workers in chunks whose size adapts to the measured cost of
+    the items, unless a fixed ``chunksize`` is given. Setting ``ordered`` to
+    ``False`` yields the results in the order they finish instead. See
+    :func:`terra.executor.chunked.adaptive_map`
+    '''
+
+    return adaptive_map(self, fn, *iterables, timeout=timeout,
+                        ordered=ordered, chunksize=chunksize,
+                        target_duration=target_duration)
+
+  def shutdown(self, wait=True, **kwargs):
+    if wait:
+      self._wait_dependent()
+    if self._speculator is not None:
+      self._speculator.shutdown()
+    super().shutdown(wait=wait, **kwargs)
+    self.metrics.shutdown()
@@ -0,0 +1,270 @@
+'''
+Speculative re-execution of straggling tasks
+
+For long fan-outs, the slowest few tasks (usually on an overloaded node) set
+the wall time of the whole batch. When speculation is enabled, an executor
+keeps track of how long its tasks take. Once enough of the tasks of the
+current batch (the tasks submitted since the executor was last idle) have
+finished, any task that has been running for much longer than the median of
+the recent run times is submitted a second time. Whichever copy finishes
+first wins, and the other copy is revoked.
+
+Speculation is only safe for tasks that can be run more than once (idempotent
+tasks), and is therefore opt-in, either by passing ``speculative`` to the
+executor, or by setting :option:`executor.speculative`.
+'''
+
+from collections import deque
+from statistics import median
+from threading import RLock, Thread, Event
+from concurrent.futures import InvalidStateError
+import time
+
+from terra import settings
+from terra.executor.base import BaseFuture
+from terra.logger import getLogger
+logger = getLogger(__name__)
+
+__all__ = ['Speculator']
+
+
+class _SpeculativeTask:
+  def __init__(self, fn, args, kwargs):
+    self.fn = fn
+    self.args = args
+    self.kwargs = kwargs
+    self.future = BaseFuture()
+    # List of [attempt_future, time first seen running, time submitted]
+    self.attempts = []
+
+
+class Speculator:
+  '''
+  Tracks the tasks of an executor, and resubmits the stragglers.
+
+  Parameters
+  ----------
+  submit : :term:`function`
+      Function used to submit a single attempt of a task, with the signature
+      ``submit(fn, *args, **kwargs)``. This must not recurse back into the
+      speculator
+  revoke : :term:`function`, optional
+      Function called on the future of an attempt that lost the race. Defaults
+      to calling ``cancel`` on the future
+  fraction : float, optional
+      The fraction of the tasks of the current batch that must be finished
+      before any speculation is attempted. A batch starts with the first task
+      submitted while no other task is running. Default: ``0.75``
+  multiplier : float, optional
+      A task is speculated once it has been running for longer than
+      ``multiplier`` times the median run time of the finished tasks.
+      Default: ``3``
+  interval : float, optional
+      How often, in seconds, running tasks are checked. Default: ``0.5``
+  window : int, optional
+      The number of most recently finished tasks the median run time is
+      taken over. Default: ``1000``
+  '''
+
+  def __init__(self, submit, revoke=None, fraction=0.75, multiplier=3,
+               interval=0.5, window=1000):
+    self._submit = submit
+    self._revoke = revoke or (lambda future: future.cancel())
+    self.fraction = fraction
+    self.multiplier = multiplier
+    self.interval = interval
+
+    # Reentrant, since done callbacks can run immediately inside submit
+    self._lock = RLock()
+    self._tasks = []
+    self._durations = deque(maxlen=window)
+    # The tasks of the current batch, submitted and not done yet
+    self._batch_submitted = 0
+    self._batch_running = 0
+    self._stopping = Event()
+    self._monitor = None
+
+    self.submitted = 0
+    '''int: Number of tasks submitted'''
+    self.speculated = 0
+    '''int: Number of tasks that were speculatively resubmitted'''
+    self.speculative_wins = 0
+    '''int: Number of speculative copies that finished first'''
+
+  @classmethod
+  def from_options(cls, options, submit, revoke=None):
+    '''
+    Create a :class:`Speculator` from an executor's ``speculative`` argument.
+
+    Parameters
+    ----------
+    options : bool or dict or None
+        ``False`` disables speculation, ``True`` enables it with the default
+        options, and a :class:`dict` enables it with the arguments of
+        :class:`Speculator`. ``None`` uses :option:`executor.speculative`, if
+        settings are configured and it is set
+    submit : :term:`function`
+        See :class:`Speculator`
+    revoke : :term:`function`, optional
+        See :class:`Speculator`
+
+    Returns
+    -------
+    :class:`Speculator` or None
+        ``None`` when speculation is disabled
+    '''
+
+    if options is None and settings.configured:
+      options = settings.executor.get('speculative', None)
+
+    if not options:
+      return None
+    if options is True:
+      options = {}
+    options = dict(options)
+    # Allow the settings form {"enabled": false, ...}
+    if not options.pop('enabled', True):
+      return None
+    return cls(submit, revoke, **options)
+
+  def submit(self, fn, *args, **kwargs):
+    '''
+    Submit a task, returning a future that resolves with the result of the
+    first attempt to finish.
+    '''
+
+    task = _SpeculativeTask(fn, args, kwargs)
+
+    with self._lock:
+      if not self._batch_running:
+        # Idle, so this starts a new batch
+        self._batch_submitted = 0
+      self._batch_submitted += 1
+      self._batch_running += 1
+      task.future.add_done_callback(lambda future: self._task_done(task))
+      self._tasks.append(task)
+      self.submitted += 1
+      self._attempt(task)
+      if self._monitor is None:
+        self._monitor = Thread(target=self._watch)
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    return task.future
+
+  def _attempt(self, task):
+    # Must be called with the lock held
+    attempt = [self._submit(task.fn, *task.args, **task.kwargs), None,
+               time.monotonic()]
+    task.attempts.append(attempt)
+    attempt[0].add_done_callback(
+        lambda future: self._attempt_done(task, attempt))
+
+  def _attempt_done(self, task, attempt):
+    future = attempt[0]
+    with self._lock:
+      if task.future.done():
+        return
+      if future.cancelled():
+        return
+
+      if future.exception() is not None:
+        # Only fail once no other copy could still succeed
+        if any(not other[0].done() for other in task.attempts):
+          return
+        result = None
+        exception = future.exception()
+      else:
+        result = future.result()
+        exception = None
+        # Tasks finishing before they are ever seen running fall back on the
+        # submit time, which only makes speculation more conservative
+        started = attempt[1] if attempt[1] is not None else attempt[2]
+        self._durations.append(time.monotonic() - started)
+        if attempt is not task.attempts[0]:
+          self.speculative_wins += 1
+
+      losers = [other[0] for other in task.attempts
+                if other is not attempt and not other[0].done()]
+
+    try:
+      if exception is not None:
+        task.future.set_exception(exception)
+      else:
+        task.future.set_result(result)
+    except InvalidStateError:  # pragma: no cover
+      pass
+
+    for loser in losers:
+      logger.debug1('Revoking losing copy of speculative task')
+      self._revoke(loser)
+
+  def _task_done(self, task):
+    with self._lock:
+      self._batch_running -= 1
+    if task.future.cancelled():
+      for attempt in task.attempts:
+        self._revoke(attempt[0])
+
+  def check(self):
+    '''
+    Check all running tasks once, and resubmit the stragglers.
+
+    Returns
+    -------
+    int
+        The number of tasks speculatively resubmitted by this check
+    '''
+
+    now = time.monotonic()
+    fired = 0
+
+    with self._lock:
+      # Forget finished tasks, but keep counting them
+      running = [task for task in self._tasks if not task.future.done()]
+      self._tasks = running
+
+      for task in running:
+        for attempt in task.attempts:
+          if attempt[1] is None and attempt[0].running():
+            attempt[1] = now
+
+      finished = self._batch_submitted - self._batch_running
+      if not self._durations or \
+         finished < self.fraction * self._batch_submitted:
+        return 0
+
+      threshold = self.multiplier * median(self._durations)
+      for task in running:
+        # Only ever speculate a task once
+        if len(task.attempts) > 1:
+          continue
+        started = task.attempts[0][1]
+        if started is not None and now - started > threshold:
+          logger.info(f'Speculatively resubmitting {task.fn}, running for '
+                      f'{now - started:.3f}s (threshold {threshold:.3f}s)')
+          self._attempt(task)
+          self.speculated += 1
+          fired += 1
+
+    return fired
+
+  def _watch(self):
+    while not self._stopping.wait(self.interval):
+      try:
+        self.check()
+      except Exception:  # pragma: no cover
+        logger.exception('Speculative execution check failed')
+
+  def shutdown(self):
+    '''
+    Stop watching the tasks, and log how often speculation fired.
+    '''
+
+    self._stopping.set()
+    if self._monitor is not None:
+      self._monitor.join()
+    if self.submitted:
+      logger.info(f'Speculative execution fired for {self.speculated} of '
+                  f'{self.submitted} tasks; {self.speculative_wins} '
+                  'speculative copies finished first')
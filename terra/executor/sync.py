@@ -16,17 +16,23 @@ class SyncExecutor(BaseExecutor):
   """
 
   def __init__(self, *arg, **kwargs):
+    super().__init__()
     self._shutdown = False
     self._shutdown_lock = Lock()
 
   def submit(self, fn, *args, **kwargs):
     '''
     '''  # Sphinx incompatible comment in original code
+    dependent = self._submit_dependent(fn, args, kwargs)
+    if dependent is not None:
+      return dependent
+
     with self._shutdown_lock:
       if self._shutdown:
         raise RuntimeError('cannot schedule new futures after shutdown')
 
-      f = BaseFuture()
+      f = self.metrics.track(BaseFuture(), fn)
+      f.set_running_or_notify_cancel()
       try:
         result = fn(*args, **kwargs)
       except BaseException as e:
@@ -37,5 +43,8 @@ class SyncExecutor(BaseExecutor):
       return f
 
   def shutdown(self, wait=True):
+    if wait:
+      self._wait_dependent()
     with self._shutdown_lock:
       self._shutdown = True
+    self.metrics.shutdown()
@@ -0,0 +1,3 @@
+from .executor import TCPExecutor
+
+__all__ = ['TCPExecutor']
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+'''
+Worker daemon for :class:`terra.executor.tcp.TCPExecutor`
+
+Connects to the executor, and runs the tasks it is sent until the executor
+shuts down. The worker then reconnects, waiting for the next executor to
+start, unless ``--once`` is given. The executor's
+:option:`executor.tcp.authkey<executor.tcp>` is read from the
+``TERRA_TCP_AUTHKEY`` environment variable, or from the file given by
+``--authkey-file``.
+'''
+
+import argparse
+import os
+import pickle
+import platform
+import socket
+import time
+from multiprocessing import AuthenticationError, Process
+from os import environ as env
+
+from terra import settings
+from terra.executor.tcp.executor import (
+  send_message, recv_message, authenticate, TaskError,
+  DEFAULT_TCP_EXECUTOR_PORT
+)
+from terra.executor.utils import run_task
+from terra.logger import getLogger
+logger = getLogger(__name__)
+
+
+def run(message):
+  '''
+  Run a task message, and return the pickled result message
+  '''
+
+  try:
+    task = pickle.loads(message['payload'])
+    if task['settings'] is None:
+      # The executor's settings were not configured, nothing to translate
+      value = task['fn'](*task['args'], **task['kwargs'])
+    else:
+      value = run_task(task['fn'], task['settings'], task['args'],
+                       task['kwargs'])
+    result = {'type': 'result', 'id': message['id'], 'ok': True,
+              'value': value}
+  except Exception as e:
+    logger.debug1(f'Task {message["id"]} failed: {e!r}')
+    result = {'type': 'result', 'id': message['id'], 'ok': False,
+              'value': e}
+
+  try:
+    return pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+  except Exception as e:
+    error = TaskError(f'Unable to send back the result of task '
+                      f'{message["id"]}: {e!r}')
+    return pickle.dumps({'type': 'result', 'id': message['id'], 'ok': False,
+                         'value': error},
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def serve(hostname, port, authkey, once=False, retry_interval=1.0):
+  '''
+  Connect to a :class:`terra.executor.tcp.TCPExecutor` and run its tasks
+
+  Parameters
+  ----------
+  hostname : str
+      Host the executor is listening on
+  port : int
+      Port the executor is listening on
+  authkey : bytes
+      The executor's :option:`executor.tcp.authkey<executor.tcp>`
+  once : bool, optional
+      Return once the executor shuts down, instead of reconnecting
+  retry_interval : float, optional
+      Seconds between attempts to connect to the executor
+  '''
+
+  # Same as celery's worker_process_init
+  settings.terra.zone = 'task'
+
+  while True:
+    try:
+      sock = socket.create_connection((hostname, port))
+    except OSError:
+      time.sleep(retry_interval)
+      continue
+
+    with sock:
+      try:
+        authenticate(sock, authkey, server_side=False)
+        send_message(sock, {'type': 'hello', 'hostname': platform.node(),
+                            'pid': os.getpid()})
+        while True:
+          message = recv_message(sock)
+          if message is None or message['type'] == 'shutdown':
+            break
+          send_message(sock, run(message))
+      except AuthenticationError as e:
+        logger.error(f'Executor at {hostname}:{port} refused: {e}')
+      except OSError as e:
+        logger.warning(f'Lost connection to executor: {e}')
+
+    if once:
+      return
+
+
+def main(args=None):
+  parser = argparse.ArgumentParser(
+      description='Run tasks for a Terra TCPExecutor')
+  parser.add_argument('--hostname',
+                      default=env.get('TERRA_TCP_HOSTNAME', 'localhost'),
+                      help='Host the executor is listening on')
+  parser.add_argument('--port', type=int,
+                      default=int(env.get('TERRA_TCP_PORT',
+                                          DEFAULT_TCP_EXECUTOR_PORT)),
+                      help='Port the executor is listening on')
+  parser.add_argument('--authkey-file',
+                      default=env.get('TERRA_TCP_AUTHKEY_FILE', None),
+                      help='File containing the executor.tcp.authkey, '
+                           'instead of the TERRA_TCP_AUTHKEY environment '
+                           'variable')
+  parser.add_argument('--processes', '-n', type=int, default=1,
+                      help='Number of worker processes (task slots)')
+  parser.add_argument('--once', action='store_true', default=False,
+                      help='Exit when the executor shuts down')
+  args = parser.parse_args(args)
+
+  if args.authkey_file:
+    with open(args.authkey_file, 'r') as fid:
+      authkey = fid.read().strip()
+  else:
+    authkey = env.get('TERRA_TCP_AUTHKEY', '')
+  if not authkey:
+    parser.error('Set TERRA_TCP_AUTHKEY or --authkey-file to the '
+                 "executor's executor.tcp.authkey")
+  authkey = authkey.encode()
+
+  if env.get('TERRA_SETTINGS_FILE', '') == '':
+    settings.configure(
+      {
+        'executor': {'type': 'TCPExecutor'},
+        'terra': {'zone': 'task_controller'},
+        'logging': {'level': 'NOTSET'}
+      }
+    )
+
+  if args.processes == 1:
+    serve(args.hostname, args.port, authkey, args.once)
+  else:
+    workers = [Process(target=serve,
+                       args=(args.hostname, args.port, authkey, args.once))
+               for _ in range(args.processes)]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+
+
+if __name__ == '__main__':  # pragma: no cover
+  main()
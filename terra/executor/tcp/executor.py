@@ -0,0 +1,402 @@
+'''
+A lightweight distributed executor, using plain TCP sockets
+
+The :class:`TCPExecutor` listens on :option:`executor.tcp` for worker daemons,
+started with ``python -m terra.executor.tcp``, to connect to it. Each
+connection is one worker slot, running one task at a time. Messages are
+pickled, and framed with a 4-byte big endian length, the same as the
+:class:`logging.handlers.SocketHandler` protocol used for Terra's logging.
+
+Since unpickling a message can run arbitrary code, both ends first prove they
+know the shared :option:`executor.tcp.authkey<executor.tcp>` with an HMAC
+challenge, the same as :mod:`multiprocessing.connection`'s ``authkey``. A
+peer that fails it is disconnected before anything it sent is unpickled.
+
+Submitted tasks are put in one central queue. Each connection pulls the task
+at the head of the queue, runs it, and only pulls the next one once the result
+is back, so faster workers simply run more tasks. When a worker disconnects,
+its running task is put back at the head of the queue.
+
+Like :class:`terra.executor.celery.CeleryExecutor`, a copy of the settings is
+sent along with every task, and the task's arguments and return value are
+translated using the executor and compute volume maps. Tasks must be
+picklable, the same as for :class:`terra.executor.ProcessPoolExecutor`.
+'''
+
+from os import environ as env
+from logging.handlers import DEFAULT_TCP_LOGGING_PORT
+from collections import deque
+from itertools import count
+from multiprocessing import AuthenticationError
+from threading import Condition, Thread
+import concurrent.futures
+import hmac
+import os
+import pickle
+import socketserver
+import struct
+
+from terra import settings
+from terra.core.settings import TerraJSONEncoder
+from terra.executor.base import BaseFuture, RemoteExecutor
+from terra.executor.utils import worker_configuration_map
+from terra.logger import getLogger
+logger = getLogger(__name__)
+
+__all__ = ['TCPExecutor', 'TaskError', 'send_message', 'recv_message',
+           'authenticate', 'DEFAULT_TCP_EXECUTOR_PORT']
+
+DEFAULT_TCP_EXECUTOR_PORT = DEFAULT_TCP_LOGGING_PORT + 1
+'''int: The default port of :option:`executor.tcp`, next to the logging
+server's'''
+
+
+class TaskError(RuntimeError):
+  '''
+  Raised for a task that failed with an exception that could not be sent back
+  from the worker
+  '''
+
+
+def _recv_exactly(sock, size):
+  data = b''
+  while len(data) < size:
+    chunk = sock.recv(size - len(data))
+    if not chunk:
+      return None
+    data += chunk
+  return data
+
+
+def _send_bytes(sock, data):
+  sock.sendall(struct.pack('>L', len(data)) + data)
+
+
+def _recv_bytes(sock, max_size=None):
+  header = _recv_exactly(sock, 4)
+  if header is None:
+    return None
+  size = struct.unpack('>L', header)[0]
+  if max_size is not None and size > max_size:
+    return None
+  return _recv_exactly(sock, size)
+
+
+_CHALLENGE_SIZE = 32
+_WELCOME = b'#WELCOME#'
+_FAILURE = b'#FAILURE#'
+
+
+def _digest(authkey, role, challenge):
+  # The role is part of the message, so a response can't be reflected back
+  # from a peer with the other role
+  return hmac.new(authkey, role + challenge, 'sha256').digest()
+
+
+def _deliver_challenge(sock, authkey, role):
+  challenge = os.urandom(_CHALLENGE_SIZE)
+  _send_bytes(sock, challenge)
+  response = _recv_bytes(sock, 256)
+  if response is not None and \
+     hmac.compare_digest(response, _digest(authkey, role, challenge)):
+    _send_bytes(sock, _WELCOME)
+  else:
+    _send_bytes(sock, _FAILURE)
+    raise AuthenticationError('digest received was wrong')
+
+
+def _answer_challenge(sock, authkey, role):
+  challenge = _recv_bytes(sock, 256)
+  if challenge is None:
+    raise AuthenticationError('no challenge received')
+  _send_bytes(sock, _digest(authkey, role, challenge))
+  if _recv_bytes(sock, 256) != _WELCOME:
+    raise AuthenticationError('digest sent was rejected')
+
+
+def authenticate(sock, authkey, server_side):
+  '''
+  Mutually authenticate both ends of a connection with a shared key
+
+  Must be done before any :func:`recv_message`, since unpickling a message
+  from an unknown peer can run arbitrary code.
+
+  Parameters
+  ----------
+  sock : :class:`socket.socket`
+      The connected socket
+  authkey : bytes
+      The shared key
+  server_side : bool
+      ``True`` for the executor, ``False`` for the worker
+
+  Raises
+  ------
+  multiprocessing.AuthenticationError
+      When the peer does not know the key
+  '''
+
+  if server_side:
+    _deliver_challenge(sock, authkey, b'worker')
+    _answer_challenge(sock, authkey, b'executor')
+  else:
+    _answer_challenge(sock, authkey, b'worker')
+    _deliver_challenge(sock, authkey, b'executor')
+
+
+def send_message(sock, message):
+  '''
+  Send a pickled message, prefixed with its 4-byte length
+
+  Parameters
+  ----------
+  sock : :class:`socket.socket`
+      The connected socket
+  message : object or bytes
+      The message. ``bytes`` are assumed to be already pickled
+  '''
+
+  if not isinstance(message, bytes):
+    message = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+  _send_bytes(sock, message)
+
+
+def recv_message(sock):
+  '''
+  Receive a message sent by :func:`send_message`
+
+  Returns
+  -------
+  object
+      The unpickled message, or ``None`` if the connection was closed
+  '''
+
+  data = _recv_bytes(sock)
+  if data is None:
+    return None
+  return pickle.loads(data)
+
+
+class _Task:
+  def __init__(self, task_id, fn, data):
+    self.id = task_id
+    self.fn = fn
+    self.data = data
+    self.future = BaseFuture()
+    self.started = False
+
+
+class _WorkerHandler(socketserver.BaseRequestHandler):
+  '''
+  Serves tasks to a single worker connection
+  '''
+
+  def handle(self):
+    executor = self.server.executor
+    try:
+      authenticate(self.request, executor._authkey, server_side=True)
+    except (AuthenticationError, OSError) as e:
+      logger.warning(f'Rejected connection from {self.client_address}: {e}')
+      return
+
+    hello = recv_message(self.request)
+    if hello is None or hello.get('type') != 'hello':
+      logger.warning(f'Unexpected message from {self.client_address}')
+      return
+
+    logger.debug1(f'Worker {hello.get("hostname")}:{hello.get("pid")} '
+                  f'connected from {self.client_address}')
+    executor._add_worker()
+    task = None
+    try:
+      while True:
+        task = executor._next_task()
+        if task is None:
+          send_message(self.request, {'type': 'shutdown'})
+          return
+        send_message(self.request, task.data)
+        result = recv_message(self.request)
+        if result is None:
+          raise ConnectionError('Worker disconnected')
+        executor._finish_task(task, result)
+        task = None
+    except OSError as e:
+      logger.warning(f'Lost worker {hello.get("hostname")}:'
+                     f'{hello.get("pid")}: {e}')
+    finally:
+      executor._remove_worker(task)
+
+
+class _TaskServer(socketserver.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, executor, address):
+    self.executor = executor
+    super().__init__(address, _WorkerHandler)
+
+
+class TCPExecutor(RemoteExecutor):
+  '''
+  Executor that runs tasks on worker daemons connected over TCP
+
+  Parameters
+  ----------
+  max_workers : int, optional
+      Ignored, the number of workers is the number of connected worker slots
+  hostname : str, optional
+      The address to listen on. Defaults to
+      :option:`executor.tcp.hostname<executor.tcp>`
+  port : int, optional
+      The port to listen on, ``0`` picks a free port. Defaults to
+      :option:`executor.tcp.port<executor.tcp>`
+  authkey : str or bytes, optional
+      The key workers must know to connect. Defaults to
+      :option:`executor.tcp.authkey<executor.tcp>`
+
+  Raises
+  ------
+  ValueError
+      If there is no ``authkey``
+  '''
+
+  def __init__(self, max_workers=None, hostname=None, port=None,
+               authkey=None):
+    super().__init__()
+    tcp = settings.executor.get('tcp', {}) if settings.configured else {}
+    if hostname is None:
+      hostname = tcp.get('hostname', 'localhost')
+    if port is None:
+      port = tcp.get('port', 0)
+    if authkey is None:
+      authkey = tcp.get('authkey', None)
+    if not authkey:
+      raise ValueError('The TCPExecutor needs executor.tcp.authkey set, '
+                       'workers connecting without it are refused')
+    if isinstance(authkey, str):
+      authkey = authkey.encode()
+    self._authkey = authkey
+
+    self._condition = Condition()
+    self._queue = deque()
+    self._workers = 0
+    self._tasks = {}
+    self._ids = count()
+    self._shutdown = False
+
+    self._server = _TaskServer(self, (hostname, port))
+    self.address = self._server.server_address
+    ''':class:`tuple`: The (hostname, port) the executor is listening on'''
+    self._server_thread = Thread(target=self._server.serve_forever,
+                                 kwargs={'poll_interval': 0.1})
+    self._server_thread.daemon = True
+    self._server_thread.start()
+    logger.debug1(f'TCPExecutor listening on {self.address}')
+
+  def submit(self, fn, *args, **kwargs):
+    """
+    """  # Original python comment has * and isn't napoleon compatible
+    dependent = self._submit_dependent(fn, args, kwargs)
+    if dependent is not None:
+      return dependent
+
+    if settings.configured:
+      # Smuggle a copy of the settings to the task, like TerraTask does
+      task_settings = TerraJSONEncoder.serializableSettings(settings)
+    else:
+      task_settings = None
+
+    task_id = next(self._ids)
+    # Pickled once, so that a requeued task is sent as is. The payload is
+    # pickled separately, so a worker can still report back a task it fails
+    # to unpickle
+    payload = pickle.dumps({'fn': fn, 'args': args, 'kwargs': kwargs,
+                            'settings': task_settings},
+                           protocol=pickle.HIGHEST_PROTOCOL)
+    data = pickle.dumps({'type': 'task', 'id': task_id, 'payload': payload},
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+    with self._condition:
+      if self._shutdown:
+        raise RuntimeError('cannot schedule new futures after shutdown')
+
+      task = _Task(task_id, fn, data)
+      self.metrics.track(task.future, fn)
+      self._tasks[task_id] = task
+      self._queue.append(task)
+      self._condition.notify()
+    return task.future
+
+  def _add_worker(self):
+    with self._condition:
+      self._workers += 1
+
+  def _remove_worker(self, task):
+    with self._condition:
+      self._workers -= 1
+      # The running task of a lost worker is the next to run
+      if task is not None and not task.future.done():
+        self._queue.appendleft(task)
+        self._condition.notify()
+
+  def _next_task(self):
+    '''
+    Wait for the next task for a worker to run, or ``None`` on shutdown
+    '''
+
+    with self._condition:
+      while True:
+        if self._queue:
+          task = self._queue.popleft()
+          # A requeued task is already running
+          if task.started or task.future.set_running_or_notify_cancel():
+            task.started = True
+            return task
+          self._tasks.pop(task.id, None)
+          continue
+        if self._shutdown:
+          return None
+        self._condition.wait()
+
+  def _finish_task(self, task, result):
+    with self._condition:
+      self._tasks.pop(task.id, None)
+    if result['ok']:
+      task.future.set_result(result['value'])
+    else:
+      task.future.set_exception(result['value'])
+
+  @property
+  def workers(self):
+    '''int: Number of worker slots currently connected'''
+    with self._condition:
+      return self._workers
+
+  def shutdown(self, wait=True):
+    logger.debug1('Shutting down TCP executor...')
+    if wait:
+      self._wait_dependent()
+      with self._condition:
+        futures = [task.future for task in self._tasks.values()]
+      concurrent.futures.wait(futures)
+
+    with self._condition:
+      self._shutdown = True
+      if not wait:
+        for task in list(self._tasks.values()):
+          task.future.cancel()
+      self._condition.notify_all()
+
+    self._server.shutdown()
+    self._server.server_close()
+    self._server_thread.join()
+    self.metrics.shutdown()
+
+  @staticmethod
+  def configuration_map(service_info):
+    # Workers on the same host share its filesystem, unless they are run in a
+    # compute service of their own
+    service_name = env.get('TERRA_TCP_SERVICE', None)
+    if not service_name:
+      return []
+    return worker_configuration_map(service_name, service_info)
@@ -1,6 +1,7 @@
 import concurrent.futures
 
 import terra.executor.base
+from terra.executor.chunked import adaptive_map
 import terra.core.settings
 
 __all__ = ['ThreadPoolExecutor']
@@ -37,3 +38,30 @@ class ThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor,
                       terra.core.settings.LazySettingsThreaded):
       terra.core.settings.LazySettingsThreaded.downcast(terra.settings)
     super().__init__(*args, **kwargs)
+    terra.executor.base.BaseExecutor.__init__(self)
+
+  def submit(self, fn, *args, **kwargs):
+    dependent = self._submit_dependent(fn, args, kwargs)
+    if dependent is not None:
+      return dependent
+    return self.metrics.track(super().submit(fn, *args, **kwargs), fn)
+
+  def map(self, fn, *iterables, timeout=None, chunksize=None, ordered=True,
+          target_duration=0.05):
+    '''
+    Same as :meth:`concurrent.futures.Executor.map`, except the items are
+    sent to the workers in chunks whose size adapts to the measured cost of
+    the items, unless a fixed ``chunksize`` is given. Setting ``ordered`` to
+    ``False`` yields the results in the order they finish instead. See
+    :func:`terra.executor.chunked.adaptive_map`
+    '''
+
+    return adaptive_map(self, fn, *iterables, timeout=timeout,
+                        ordered=ordered, chunksize=chunksize,
+                        target_duration=target_duration)
+
+  def shutdown(self, wait=True, **kwargs):
+    if wait:
+      self._wait_dependent()
+    super().shutdown(wait=wait, **kwargs)
+    self.metrics.shutdown()
@@ -1,9 +1,17 @@
 from importlib import import_module
+from os import environ as env
+from tempfile import gettempdir
+import os
+
+from vsi.tools.python import args_to_kwargs, ARGS, KWARGS
 
 from terra import settings
 import terra.core.signals
+from terra.core.settings import TerraJSONEncoder
 from terra.core.utils import ClassHandler
 import terra.logger
+from terra.logger import getLogger
+logger = getLogger(__name__)
 
 
 class ExecutorHandler(ClassHandler):
@@ -46,6 +54,9 @@ class ExecutorHandler(ClassHandler):
     elif backend_name == "CeleryExecutor":
       from terra.executor.celery import CeleryExecutor
       return CeleryExecutor
+    elif backend_name == "TCPExecutor":
+      from terra.executor.tcp import TCPExecutor
+      return TCPExecutor
     else:
       module_name = backend_name.rsplit('.', 1)
       module = import_module(f'{module_name[0]}')
@@ -72,3 +83,170 @@ terra.core.signals.logger_configure.connect(
 terra.core.signals.logger_reconfigure.connect(
     lambda *args, **kwargs: Executor.reconfigure_logger(*args, **kwargs),
     weak=False)
+
+
+def worker_configuration_map(service_name, service_info):
+  '''
+  Calculate the volume map of an executor whose workers run in the compute
+  service ``service_name`` (e.g. a celery worker running in a docker), using
+  the compose files of ``service_info``
+
+  Returns
+  -------
+  list
+      Return a list of tuple pairs [(host, remote), ... ] of the volumes
+      mounted from the host to the worker
+  '''
+
+  from terra.compute import compute
+
+  class ServiceClone:
+    def __init__(self, service_info):
+      self.compose_service_name = service_name
+
+      if hasattr(service_info, 'justfile'):
+        self.justfile = service_info.justfile
+      if hasattr(service_info, 'compose_files'):
+        self.compose_files = service_info.compose_files
+
+      self.env = env  # .copy()
+      self.volumes = []
+
+  service_clone = ServiceClone(service_info)
+
+  if hasattr(compute, 'config'):
+    config = compute.config(service_clone)
+  else:
+    config = None
+
+  return compute.get_volume_map(config, service_clone)
+
+
+def get_volume_mappings(task_settings):
+  '''
+  Get the volume maps needed to translate a task's arguments, given the
+  settings smuggled from the runner that submitted the task
+
+  Returns
+  -------
+  tuple
+      ``compute_volume_map``, ``reverse_compute_volume_map``,
+      ``executor_volume_map`` and ``reverse_executor_volume_map``
+  '''
+
+  executor_volume_map = task_settings['executor']['volume_map']
+
+  if executor_volume_map:
+    compute_volume_map = task_settings['compute']['volume_map']
+    # Flip each mount point, so it goes from runner to controller
+    reverse_compute_volume_map = [[x[1], x[0]]
+                                  for x in compute_volume_map]
+    # Reverse order. This will be important in case one mount point mounts
+    # inside another
+    reverse_compute_volume_map.reverse()
+
+    reverse_executor_volume_map = [[x[1], x[0]]
+                                   for x in executor_volume_map]
+    reverse_executor_volume_map.reverse()
+
+  else:
+    reverse_compute_volume_map = []
+    compute_volume_map = []
+    reverse_executor_volume_map = []
+
+  return (compute_volume_map, reverse_compute_volume_map,
+          executor_volume_map, reverse_executor_volume_map)
+
+
+def translate_paths(payload, reverse_compute_volume_map, executor_volume_map):
+  '''
+  Translate the paths in ``payload`` from the compute runner to the master
+  controller, and then from the master controller to the executor
+  '''
+
+  import terra.compute.utils
+
+  if reverse_compute_volume_map or executor_volume_map:
+    # If either translation is needed, start by applying the ~ home dir
+    # expansion and settings_property (which wouldn't have made it through
+    # pure json conversion, but the ~ will)
+    payload = TerraJSONEncoder.serializableSettings(payload)
+    # Go from compute runner to master controller
+    if reverse_compute_volume_map:
+      payload = terra.compute.utils.translate_settings_paths(
+          payload, reverse_compute_volume_map)
+    # Go from master controller to executor
+    if executor_volume_map:
+      payload = terra.compute.utils.translate_settings_paths(
+          payload, executor_volume_map)
+  return payload
+
+
+def run_task(fn, task_settings, args, kwargs, signature=None):
+  '''
+  Run a task on an executor worker, using the settings smuggled from the
+  runner that submitted it
+
+  The settings are translated to the executor's point of view, and used in a
+  settings context (in the ``task`` zone) while the task runs. Arguments and
+  return values are translated the same way.
+
+  Parameters
+  ----------
+  fn : :term:`function`
+      The task being run
+  task_settings : dict
+      The serialized settings from the runner
+  args : tuple
+      Positional arguments for ``fn``
+  kwargs : dict
+      Keyword arguments for ``fn``
+  signature : :term:`function`, optional
+      Function whose signature is used to name the arguments, when it is not
+      ``fn``'s (e.g. a celery task's ``run``)
+  '''
+
+  if not settings.configured:
+    # Cover a potential (unlikely) corner case where setting might not be
+    # configured yet
+    settings.configure({'processing_dir': gettempdir()})
+
+  # Create a settings context, so I can replace it with the task's settings
+  with settings:
+    # Calculate the exector's mapped version of the runner's settings
+    compute_volume_map, reverse_compute_volume_map, \
+        executor_volume_map, reverse_executor_volume_map = \
+        get_volume_mappings(task_settings)
+
+    # Load the executor version of the runner's settings
+    settings._wrapped.clear()
+    settings._wrapped.update(translate_paths(task_settings,
+                                             reverse_compute_volume_map,
+                                             executor_volume_map))
+    # This is needed here because I just loaded settings from a runner!
+    settings.terra.zone = 'task'
+
+    # Just in case processing dir doesn't exist
+    if not os.path.exists(settings.processing_dir):
+      logger.critical(f'Dir "{settings.processing_dir}" is not accessible '
+                      'by the executor, please make sure the worker has '
+                      'access to this directory')
+      settings.processing_dir = gettempdir()
+      logger.warning('Using temporary directory: '
+                     f'"{settings.processing_dir}" for the processing dir')
+
+    # Calculate the executor's mapped version of the arguments
+    kwargs = args_to_kwargs(signature or fn, args, kwargs)
+    args_only = kwargs.pop(ARGS, ())
+    kwargs.update(kwargs.pop(KWARGS, ()))
+    kwargs = translate_paths(kwargs,
+                             reverse_compute_volume_map,
+                             executor_volume_map)
+    # Set up logger to talk to master controller
+    terra.logger._logs.reconfigure_logger(pre_run_task=True)
+    return_value = fn(*args_only, **kwargs)
+
+    # Calculate the runner mapped version of the executor's return value
+    return translate_paths(return_value,
+                           reverse_executor_volume_map,
+                           compute_volume_map)
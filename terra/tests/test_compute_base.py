@@ -1,4 +1,7 @@
+import asyncio
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 from terra import settings
@@ -29,6 +32,17 @@ class TestServiceBase(TestSettingsConfiguredCase):
     # Make sure it's in the list
     self.assertIn(("/local", "/remote"), service.volumes)
 
+  def test_add_many_volumes(self):
+    service = terra.compute.base.BaseService()
+    service.add_volumes([(self.temp_dir.name, '/a'), ('/local', '/b')])
+    self.assertEqual(service.volumes, [(self.temp_dir.name, '/a'),
+                                       ('/local', '/b')])
+
+    with self.assertRaisesRegex(ValueError, 'does not exist /missing'):
+      service.add_volumes([(self.temp_dir.name, '/a'), ('/missing', '/c')],
+                          local_must_exist=True)
+    self.assertEqual(len(service.volumes), 2)
+
   def test_registry(self):
     with mock.patch.dict(terra.compute.base.services, clear=True):
       # Registration test
@@ -77,6 +91,81 @@ class TestServiceBaseUnconfigured(TestSettingsUnconfiguredCase):
         terra.compute.base.BaseCompute().configuration_map(service))
 
 
+class AsyncService:
+  def __init__(self):
+    self.calls = []
+    self.resources = {'cpus': 1}
+
+  def pre_run(self, value):
+    self.calls.append(('pre_run', value))
+
+  def post_run(self, value):
+    self.calls.append(('post_run', value))
+
+
+class AsyncCompute(terra.compute.base.BaseCompute):
+  def run_service(self, service_info, value):
+    service_info.calls.append(('run', value, self.admission.used_cpus))
+    return value * 2
+
+
+class TestArun(TestSettingsUnconfiguredCase):
+  def test_arun(self):
+    settings.configure({})
+    compute = AsyncCompute()
+    service = AsyncService()
+    self.assertEqual(asyncio.run(compute.arun(service, 3)), 6)
+    # The same hooks as run, with the resources admitted
+    self.assertEqual(service.calls, [('pre_run', 3), ('run', 3, 1.0),
+                                     ('post_run', 3)])
+    self.assertEqual(compute.admission.running, 0)
+
+
+class PoolCompute(terra.compute.base.BaseCompute):
+  def stop_pooled(self, names):
+    self.stopped = names
+
+
+class TestPool(TestCase):
+  def test_get_pooled(self):
+    compute = PoolCompute()
+    starts = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_start():
+      starts.append('slow')
+      started.set()
+      return 'slow' if release.wait(2) else 'blocked'
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+      slow = [executor.submit(compute.get_pooled, 'slow', slow_start)
+              for _ in range(2)]
+      self.assertTrue(started.wait(5))
+      # Other containers are not held up by one that is starting
+      self.assertEqual(compute.get_pooled('fast', lambda: 'fast'), 'fast')
+      release.set()
+      self.assertEqual([future.result() for future in slow],
+                       ['slow', 'slow'])
+    self.assertEqual(starts, ['slow'])
+
+    compute.close()
+    self.assertEqual(sorted(compute.stopped), ['fast', 'slow'])
+
+  def test_start_failed(self):
+    compute = PoolCompute()
+
+    def fail():
+      raise RuntimeError('start')
+
+    with self.assertRaisesRegex(RuntimeError, 'start'):
+      compute.get_pooled('key', fail)
+    # Tried again on the next run
+    self.assertEqual(compute.get_pooled('key', lambda: 'name'), 'name')
+    compute.close()
+    self.assertEqual(compute.stopped, ['name'])
+
+
 class TestUnitTests(TestCase):
   def last_test_registered_services(self):
     self.assertFalse(
@@ -0,0 +1,139 @@
+import os
+import sys
+import textwrap
+import types
+from unittest import mock
+
+from terra import settings
+from terra.executor.utils import Executor
+from terra.compute import base
+from terra.compute import batch
+from terra.compute import inprocess
+from terra.compute import virtualenv
+import terra.compute.utils
+
+from .utils import TestCase, TestSettingsUnconfiguredCase
+
+
+class TestBatchUtils(TestCase):
+  def test_command(self):
+    self.assertEqual(
+        batch.batch_command(['python3', '-m', 'my.runner', '--flag']),
+        (['python3', '-m', 'terra.compute.batch'], 'my.runner'))
+    with self.assertRaises(ValueError):
+      batch.batch_command(['ls'])
+
+  def test_settings(self):
+    batch_settings = batch.batch_settings('my.runner',
+                                          ['/a', {'image_file': '/b'}])
+    self.assertEqual(batch_settings['runner'], 'my.runner')
+    self.assertEqual(batch_settings['inputs'],
+                     [{'input_path': '/a'}, {'image_file': '/b'}])
+    # Every batch has results of its own
+    self.assertNotEqual(batch_settings['id'],
+                        batch.batch_settings('my.runner', [])['id'])
+    self.assertEqual(batch.results_filename('/tmp_settings/config.json',
+                                            'abc'),
+                     '/tmp_settings/batch_abc.results.jsonl')
+
+  def test_read_results(self):
+    filename = os.path.join(self.temp_dir.name, 'results.jsonl')
+    with open(filename, 'w') as fid:
+      fid.write('{"index": 1, "returncode": 0, "value": 3}\n')
+      fid.write('{"index": 0, "returncode": 2, "error": "exited with 2"}\n')
+      fid.write('{"index": 2, "retur')
+    results = batch.read_results(filename, ['a', 'b', 'c'], 'crashed')
+    self.assertEqual([result.ok for result in results], [False, True, False])
+    self.assertEqual(results[0].returncode, 2)
+    self.assertEqual(results[1].value, 3)
+    self.assertEqual(results[2].error, 'crashed')
+    self.assertEqual(results[2].input, 'c')
+
+
+class MockInProcessService(inprocess.Service):
+  def __init__(self):
+    super().__init__()
+    self.command = ['python', '-m', 'terra_test_batch_runner']
+
+
+class TestInProcessBatch(TestSettingsUnconfiguredCase):
+  def setUp(self):
+    self.patches.append(mock.patch.dict(Executor.__dict__))
+    self.patches.append(
+        mock.patch.object(
+            terra.compute.utils.ComputeHandler,
+            '_connection',
+            mock.PropertyMock(return_value=inprocess.Compute())))
+
+    self.runner = types.ModuleType('terra_test_batch_runner')
+    self.runner.main = self.main
+    self.patches.append(mock.patch.dict(sys.modules,
+                                        terra_test_batch_runner=self.runner))
+    self.calls = []
+    super().setUp()
+    settings.configure({'compute': {'arch': 'inprocess'},
+                        'processing_dir': self.temp_dir.name})
+
+  def main(self):
+    self.calls.append((settings.batch.index, settings.input_path))
+    # Each input in its own settings context
+    self.assertNotIn('leaked', settings)
+    settings.leaked = True
+    if settings.input_path == 'bad':
+      raise ValueError('bad input')
+    if settings.input_path == 'exit':
+      raise SystemExit(3)
+    return settings.input_path.upper()
+
+  def test_run_batch(self):
+    compute = inprocess.Compute()
+    with self.assertLogs(base.__name__, level='WARNING'):
+      results = compute.run_batch(MockInProcessService(),
+                                  ['a', 'bad', 'exit', 'd'])
+    self.assertEqual(self.calls, [(0, 'a'), (1, 'bad'), (2, 'exit'),
+                                  (3, 'd')])
+    self.assertEqual([result.ok for result in results],
+                     [True, False, False, True])
+    self.assertEqual(results[0].value, 'A')
+    self.assertIn('bad input', results[1].error)
+    self.assertEqual(results[2].returncode, 3)
+    self.assertEqual(results[3].input, 'd')
+    self.assertNotIn('batch', settings)
+
+
+class TestVirtualEnvBatch(TestSettingsUnconfiguredCase):
+  def setUp(self):
+    self.patches.append(mock.patch.dict(Executor.__dict__))
+    self.patches.append(
+        mock.patch.object(
+            terra.compute.utils.ComputeHandler,
+            '_connection',
+            mock.PropertyMock(return_value=virtualenv.Compute())))
+    super().setUp()
+    settings.configure({
+        'compute': {'arch': 'virtualenv',
+                    'virtualenv_dir': None},
+        'processing_dir': self.temp_dir.name})
+
+    with open(os.path.join(self.temp_dir.name,
+                           'terra_test_batch_runner.py'), 'w') as fid:
+      fid.write(textwrap.dedent('''\
+          from terra import settings
+
+          def main():
+            if settings.number < 0:
+              raise ValueError('negative')
+            return settings.number * 2
+          '''))
+
+  def test_run_batch(self):
+    compute = virtualenv.Compute()
+    service = virtualenv.Service()
+    service.command = [sys.executable, '-m', 'terra_test_batch_runner']
+    service.env['PYTHONPATH'] = os.pathsep.join(
+        [self.temp_dir.name] + sys.path)
+
+    results = compute.run_batch(service, [{'number': 1}, {'number': -1},
+                                          {'number': 3}])
+    self.assertEqual([result.value for result in results], [2, None, 6])
+    self.assertEqual([result.ok for result in results], [True, False, True])
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import os
+import pickle
+from unittest import mock
+
+from terra import settings
+from terra.compute import base
+from terra.compute import checkpoint
+import terra.compute.utils
+from .utils import TestCase, TestSettingsUnconfiguredCase
+
+
+class FlakyService:
+  def __init__(self):
+    self.inputs = []
+    self.calls = []
+
+  def pre_run(self):
+    self.calls.append('pre_run')
+
+  def post_run(self):
+    self.calls.append('post_run')
+
+
+class FlakyCompute(base.BaseCompute):
+  def __init__(self, returncodes):
+    self.returncodes = list(returncodes)
+
+  def run_service(self, service_info):
+    service_info.calls.append('run')
+    returncode = self.returncodes.pop(0)
+    if returncode:
+      raise base.ServiceRunFailed(returncode=returncode)
+    return len(service_info.calls)
+
+  async def arun_service(self, service_info):
+    return self.run_service(service_info)
+
+
+class TestRetryPolicy(TestSettingsUnconfiguredCase):
+  def test_defaults(self):
+    policy = checkpoint.RetryPolicy.from_settings(object())
+    self.assertEqual(policy.max_attempts, 1)
+    with self.assertRaises(base.ServiceRunFailed):
+      policy.retry_delay('Service', base.ServiceRunFailed(), 1)
+
+  def test_settings(self):
+    settings.configure({'compute': {
+        'retry': {'max_attempts': 3, 'backoff': 1},
+        'service_retry': {'FlakyService': {'exit_codes': [75]}}}})
+    service = FlakyService()
+    service.retry = {'backoff': 2, 'max_backoff': 3}
+    policy = checkpoint.RetryPolicy.from_settings(service)
+    self.assertEqual(policy.max_attempts, 3)
+    self.assertEqual(policy.exit_codes, {75})
+    self.assertEqual([policy.delay(attempt) for attempt in (1, 2, 3)],
+                     [2, 3, 3])
+
+    self.assertTrue(policy.retryable(base.ServiceRunFailed(returncode=75)))
+    self.assertFalse(policy.retryable(base.ServiceRunFailed(returncode=1)))
+    self.assertFalse(policy.retryable(ValueError()))
+
+  def test_pickle(self):
+    # Failures come back from executors pickled
+    exception = pickle.loads(pickle.dumps(
+        base.ServiceRunFailed('failed', returncode=3)))
+    self.assertEqual(exception.returncode, 3)
+    self.assertEqual(exception.args, ('failed',))
+
+
+class TestRetry(TestSettingsUnconfiguredCase):
+  def setUp(self):
+    self.patches.append(mock.patch.object(terra.compute.utils,
+                                          'load_service',
+                                          lambda service: service))
+    super().setUp()
+    settings.configure({'processing_dir': self.temp_dir.name,
+                        'compute': {'retry': {'max_attempts': 3,
+                                              'exit_codes': [75]}}})
+
+  def test_retried(self):
+    service = FlakyService()
+    self.assertEqual(FlakyCompute([75, 75, 0]).run(service), 4)
+    # Only the runner is run again
+    self.assertEqual(service.calls,
+                     ['pre_run', 'run', 'run', 'run', 'post_run'])
+
+  def test_gives_up(self):
+    with self.assertLogs(checkpoint.__name__, level='WARNING'):
+      with self.assertRaises(base.ServiceRunFailed):
+        FlakyCompute([75, 75, 75, 0]).run(FlakyService())
+
+  def test_not_retryable(self):
+    service = FlakyService()
+    with self.assertRaises(base.ServiceRunFailed) as cm:
+      FlakyCompute([1, 0]).run(service)
+    self.assertEqual(cm.exception.returncode, 1)
+    self.assertEqual(service.calls, ['pre_run', 'run'])
+
+  def test_arun(self):
+    service = FlakyService()
+    compute = FlakyCompute([75, 0])
+    self.assertEqual(asyncio.run(compute.arun(service)), 3)
+    self.assertEqual(service.calls, ['pre_run', 'run', 'run', 'post_run'])
+
+
+class TestHash(TestSettingsUnconfiguredCase):
+  def test_hash_path(self):
+    self.assertIsNone(checkpoint.hash_path(
+        os.path.join(self.temp_dir.name, 'missing')))
+
+    filename = os.path.join(self.temp_dir.name, 'input.txt')
+    with open(filename, 'w') as fid:
+      fid.write('1')
+    file_hash = checkpoint.hash_path(filename)
+    dir_hash = checkpoint.hash_path(self.temp_dir.name)
+
+    with open(filename, 'w') as fid:
+      fid.write('22')
+    self.assertNotEqual(checkpoint.hash_path(filename), file_hash)
+    self.assertNotEqual(checkpoint.hash_path(self.temp_dir.name), dir_hash)
+
+  def test_service_hash(self):
+    settings.configure({'processing_dir': self.temp_dir.name,
+                        'foo': 1})
+    service = FlakyService()
+    service_hash = checkpoint.service_hash(service)
+    # Settings that change from run to run don't count
+    settings.terra.uuid = 'other'
+    settings.executor.volume_map = [('/a', '/b')]
+    settings.compute.volume_map = [('/c', '/d')]
+    self.assertEqual(checkpoint.service_hash(service), service_hash)
+
+    self.assertNotEqual(checkpoint.service_hash(service, (1,)), service_hash)
+    settings.foo = 2
+    self.assertNotEqual(checkpoint.service_hash(service), service_hash)
+
+
+class TestSkipCompleted(TestSettingsUnconfiguredCase):
+  def setUp(self):
+    self.patches.append(mock.patch.object(terra.compute.utils,
+                                          'load_service',
+                                          lambda service: service))
+    super().setUp()
+    settings.configure({'processing_dir': self.temp_dir.name,
+                        'compute': {'skip_completed': True}})
+    self.input = os.path.join(self.temp_dir.name, 'input.txt')
+    with open(self.input, 'w') as fid:
+      fid.write('input')
+
+  def run_service(self):
+    service = FlakyService()
+    service.inputs = [self.input]
+    FlakyCompute([0]).run(service)
+    return service.calls
+
+  def test_skipped(self):
+    self.assertEqual(self.run_service(), ['pre_run', 'run', 'post_run'])
+    self.assertEqual(self.run_service(), [])
+
+    with open(os.path.join(self.temp_dir.name,
+                           'completed_services.json'), 'r') as fid:
+      completed = json.load(fid)
+    self.assertEqual(len(completed), 1)
+    self.assertEqual(list(completed.values())[0]['service'],
+                     f'{__name__}.FlakyService')
+
+    # A new input runs it again
+    with open(self.input, 'w') as fid:
+      fid.write('changed')
+    self.assertEqual(self.run_service(), ['pre_run', 'run', 'post_run'])
+
+  def test_failed_not_recorded(self):
+    with self.assertRaises(base.ServiceRunFailed):
+      FlakyCompute([1]).run(FlakyService())
+    self.assertEqual(self.run_service(), ['pre_run', 'run', 'post_run'])
+
+  def test_clear(self):
+    completed = checkpoint.CompletedServices.from_settings()
+    completed.add('abc', FlakyService())
+    self.assertIn('abc', checkpoint.CompletedServices.from_settings())
+    completed.clear()
+    self.assertNotIn('abc', checkpoint.CompletedServices.from_settings())
+
+  def test_disabled(self):
+    settings.compute.skip_completed = False
+    self.assertIsNone(FlakyCompute([]).completed)
+
+
+class TestCompletedCorrupt(TestCase):
+  def test_corrupt(self):
+    with self.assertLogs(checkpoint.__name__, level='WARNING'):
+      completed = checkpoint.CompletedServices(__file__)
+      self.assertNotIn('abc', completed)
@@ -1,6 +1,7 @@
 import os
 import ntpath
 import json
+import time
 from unittest import mock, skipIf
 
 from terra import settings
@@ -138,6 +139,189 @@ class TestContainerService(TestComputeContainerCase,
                    if k.startswith('TERRA_VOLUME_')),
                   'Added volume failed to be bound')
 
+  @skipIf(os.name != "posix", "Required Linux")
+  @mock.patch.object(base.BaseCompute, 'configuration_map_service', mock_map)
+  @mock.patch.object(base.BaseCompute, 'pooled',
+                     mock.PropertyMock(return_value=True))
+  def test_service_pooled(self):
+    compute = terra.compute.container.compute
+    service1 = SomeService()
+    service1.pre_run()
+    service2 = SomeService()
+    service2.pre_run()
+
+    # The same /tmp_settings for every run, with its own settings file
+    volume = f'{compute.pool_dir}:/tmp_settings:rw'
+    self.assertEqual(service1.env['TERRA_VOLUME_1'], volume)
+    self.assertEqual(service2.env['TERRA_VOLUME_1'], volume)
+    self.assertNotEqual(service1.settings_file, service2.settings_file)
+    self.assertEqual(os.path.dirname(service1.settings_file),
+                     compute.pool_dir)
+    self.assertEqual(service1.run_env['TERRA_SETTINGS_FILE'],
+                     '/tmp_settings/'
+                     + os.path.basename(service1.settings_file))
+
+    service1.post_run()
+    self.assertFalse(os.path.exists(service1.settings_file))
+    self.assertTrue(os.path.exists(service2.settings_file))
+    service2.post_run()
+
+  @skipIf(os.name != "posix", "Required Linux")
+  @mock.patch.object(base.BaseCompute, 'configuration_map_service', mock_map)
+  def test_service_volume_set(self):
+    service = SomeService()
+    service.env['TERRA_VOLUME_2'] = '/Foo:/Bar'
+    service.add_volume('/data', '/in')
+    service.add_volume('/data', '/in')
+    service.add_volume('/data/a', '/in/a')
+    service.add_volume('/data/b', '/in/b', 'ro')
+    service.pre_run()
+    volumes = {k: v for k, v in service.env.items()
+               if k.startswith('TERRA_VOLUME_')}
+    self.assertEqual(volumes, {
+        'TERRA_VOLUME_1': f'{service.temp_dir.name}:/tmp_settings:rw',
+        'TERRA_VOLUME_2': '/Foo:/Bar',
+        'TERRA_VOLUME_3': '/data:/in',
+        'TERRA_VOLUME_4': '/data/b:/in/b:ro'})
+    service.post_run()
+
+  def test_volume_maps_concurrent(self):
+    def compute_map(self, service_info):
+      time.sleep(0.2)
+      return [('/foo', '/bar')]
+
+    def executor_map(service_info):
+      time.sleep(0.2)
+      return [('/foo', '/worker')]
+
+    start = time.time()
+    with mock.patch.object(base.BaseCompute, 'configuration_map_service',
+                           compute_map), \
+        mock.patch.object(Executor, 'configuration_map', executor_map):
+      service = SomeService()
+      service.pre_run()
+    # One after the other would take 0.4s
+    self.assertLess(time.time() - start, 0.35)
+    self.assertEqual(settings.compute.volume_map, [('/foo', '/bar')])
+    self.assertEqual(settings.executor.volume_map, [('/foo', '/worker')])
+    service.post_run()
+
+  @mock.patch.object(base.BaseCompute, 'configuration_map_service', mock_map)
+  def test_service_staged(self):
+    compute = terra.compute.container.compute
+    settings.compute.staging = True
+    # Evaluated once, like the logger does
+    settings.terra.uuid
+    service1 = SomeService(env={'BAR': 'FOO'})
+    service1.pre_run()
+    service2 = SomeService(env={'BAR': 'FOO'})
+    service2.pre_run()
+    with settings:
+      settings.other = 1
+      service3 = SomeService(env={'BAR': 'FOO'})
+      service3.pre_run()
+
+    # A stable /tmp_settings, with one file per content
+    volume = f'{compute.staging_dir}:/tmp_settings:rw'
+    self.assertEqual(service1.env['TERRA_VOLUME_1'], volume)
+    self.assertEqual(service3.env['TERRA_VOLUME_1'], volume)
+    self.assertEqual(service1.settings_file, service2.settings_file)
+    self.assertNotEqual(service1.settings_file, service3.settings_file)
+    self.assertEqual(os.path.dirname(service1.settings_file),
+                     compute.staging_dir)
+    self.assertEqual(service1.run_env['TERRA_SETTINGS_FILE'],
+                     '/tmp_settings/'
+                     + os.path.basename(service1.settings_file))
+    with open(service1.settings_file, 'r') as fid:
+      self.assertEqual(json.load(fid)['terra']['zone'], 'runner')
+
+    # Shared, so kept
+    service1.post_run()
+    self.assertTrue(os.path.exists(service1.settings_file))
+
+
+class ResumeCompute(base.BaseCompute):
+  def __init__(self):
+    self.ran = []
+
+  def run_service(self, service_info):
+    self.ran.append(service_info.compose_service_name)
+
+
+def mock_service_map(self, service_info):
+  return [(f'/{service_info.compose_service_name}', '/data')]
+
+
+class FirstService(SomeService):
+  pass
+
+
+class SecondService(SomeService):
+  pass
+
+
+class ThirdService(SomeService):
+  pass
+
+
+class TestContainerResume(TestComputeContainerCase):
+  def setUp(self):
+    self.patches.append(mock.patch.dict(Executor.__dict__))
+    self.patches.append(mock.patch.object(
+        base.BaseCompute, 'configuration_map_service', mock_service_map))
+    super().setUp()
+    settings.compute.skip_completed = True
+    # Evaluated once, like the logger does
+    settings.terra.uuid
+
+  def run_pipeline(self):
+    compute = ResumeCompute()
+    for service, name in ((FirstService, 'first'), (SecondService, 'second'),
+                          (ThirdService, 'third')):
+      compute.run(service(compose_service_name=name))
+    return compute.ran
+
+  @skipIf(os.name != "posix", "Required Linux")
+  def test_resume(self):
+    self.assertEqual(self.run_pipeline(), ['first', 'second', 'third'])
+    # Each pre_run sets the compute volume map, which the next service's hash
+    # must not depend on, as skipped services don't run their pre_run
+    self.assertEqual(self.run_pipeline(), [])
+
+
+class BatchCompute(base.BaseCompute):
+  def run_service(self, service_info):
+    self.command = service_info.command
+    with open(service_info.settings_file, 'r') as fid:
+      self.config = json.load(fid)
+
+
+class TestContainerBatch(TestComputeContainerCase):
+  def setUp(self):
+    self.patches.append(mock.patch.dict(Executor.__dict__))
+    self.patches.append(mock.patch.object(
+        base.BaseCompute, 'configuration_map_service', mock_map))
+    super().setUp()
+    settings.terra.uuid
+
+  @skipIf(os.name != "posix", "Requires Linux")
+  def test_run_batch(self):
+    compute = BatchCompute()
+    service = SomeService(command=['python', '-m', 'my.runner'])
+    # Nothing runs the batch driver, so every input fails
+    with self.assertLogs(base.__name__, level='WARNING'):
+      compute.run_batch(service, ['/foo/1.tif', {'image_file': '/foo/2.tif',
+                                                 'name': '/foo/3.tif'}])
+
+    # The paths of the inputs are translated, like any other settings
+    self.assertEqual(compute.config['batch']['inputs'],
+                     [{'input_path': '/bar/1.tif'},
+                      {'image_file': '/bar/2.tif', 'name': '/foo/3.tif'}])
+    self.assertEqual(compute.command,
+                     ['python', '-m', 'terra.compute.batch'])
+    # The service can be run again
+    self.assertEqual(service.command, ['python', '-m', 'my.runner'])
+
 
 class TestContainerService2(TestComputeContainerCase):
   def test_add_volume(self):
@@ -1,5 +1,7 @@
+import asyncio
 import os
 import re
+import threading
 from unittest import mock
 import warnings
 
@@ -10,7 +12,9 @@ from terra.compute import base
 from terra.compute import docker
 import terra.compute.utils
 
-from .utils import TestSettingsUnconfiguredCase
+from .utils import (
+  TestSettingsUnconfiguredCase, TestThreadPoolExecutorCase
+)
 
 
 class TestComputeDockerCase(TestSettingsUnconfiguredCase):
@@ -110,6 +114,224 @@ class TestDockerRun(TestComputeDockerCase):
     with self.assertRaises(base.ServiceRunFailed):
       compute.run(MockJustService())
 
+  def test_run_env(self):
+    # Per-run variables of staged services
+    service = MockJustService()
+    service.run_env = {'TERRA_SETTINGS_FILE': '/tmp_settings/settings_1.json'}
+    args, _ = docker.Compute().run_command(service)
+    self.assertEqual(args[4:8], ('run', '-T', '-e',
+                                 'TERRA_SETTINGS_FILE='
+                                 '/tmp_settings/settings_1.json'))
+
+
+class TestDockerResources(TestDockerRun):
+  def setUp(self):
+    self.patches.append(mock.patch.object(
+        docker.Compute, 'config_service',
+        lambda self, service_info: {'version': '2.4'}))
+    super().setUp()
+
+  def test_resources(self):
+    compute = docker.Compute()
+    self.return_value = 0
+    service = MockJustService()
+    service.resources = {'cpus': 2, 'memory': '1g', 'cpuset': '0-1'}
+    compute.run(service)
+
+    override = self.just_args[5]
+    self.assertEqual(self.just_args[2:6], ('-f', 'file1', '-f', override))
+    self.assertEqual(os.path.dirname(override), compute.pool_dir)
+    with open(override, 'r') as fid:
+      self.assertEqual(yaml.safe_load(fid),
+                       {'version': '2.4',
+                        'services': {'launch': {'cpus': 2.0,
+                                                'mem_limit': 1024**3,
+                                                'cpuset': '0,1'}}})
+
+    # Same requests, same file
+    self.assertEqual(compute.run_compose_files(service), ['file1', override])
+    self.assertEqual(compute.run_compose_files(MockJustService()), ['file1'])
+
+
+class TestDockerAsync(TestComputeDockerCase):
+  def setUp(self):
+    self.patches.append(mock.patch.object(docker, 'ajust', self.mock_ajust))
+    super().setUp()
+
+  async def mock_ajust(_self, *args, **kwargs):
+    _self.just_args = args
+    _self.just_kwargs = kwargs
+
+    async def wait():
+      return _self.return_value
+    return type('blah', (object,), {'wait': staticmethod(wait)})()
+
+  def test_arun(self):
+    compute = docker.Compute()
+    self.return_value = 0
+    asyncio.run(compute.arun(MockJustService()))
+    self.assertEqual(('--wrap', 'Just-docker-compose',
+                      '-f', 'file1', 'run', '-T', 'launch', 'ls'),
+                     self.just_args)
+    self.assertEqual({'justfile': None, 'env': {'BAR': 'FOO'}},
+                     self.just_kwargs)
+
+    self.return_value = 1
+    with self.assertRaises(base.ServiceRunFailed):
+      asyncio.run(compute.arun(MockJustService()))
+
+
+class MockPooledService(MockJustService):
+  pooled = True
+
+  def __init__(self, settings_file='config_1.json', **env):
+    self.run_env = {'TERRA_SETTINGS_FILE': f'/tmp_settings/{settings_file}'}
+    self.env = dict(MockJustService.env, **env)
+
+
+class TestDockerPool(TestComputeDockerCase):
+  def mock_just(_self, *args, **kwargs):
+    _self.just_calls.append(args)
+    return type('blah', (object,),
+                {'wait': lambda self: _self.return_value,
+                 'communicate': lambda self: ('', None),
+                 'returncode': _self.return_value})()
+
+  def mock_config(_self, service_info):
+    return {'services': {'launch': {'entrypoint': ['/entry.sh', 'run'],
+                                    'environment': dict(service_info.env)}}}
+
+  def setUp(self):
+    self.just_calls = []
+    self.return_value = 0
+    self.patches.append(mock.patch.object(docker, 'just', self.mock_just))
+    self.patches.append(mock.patch.object(docker.Compute, 'config_service',
+                                          self.mock_config))
+    self.patches.append(mock.patch.object(base, 'atexit'))
+    super().setUp()
+    settings.compute.pool = True
+
+  def test_pooled(self):
+    compute = docker.Compute()
+    self.assertTrue(compute.pooled)
+    compute.run(MockPooledService('config_1.json'))
+    compute.run(MockPooledService('config_2.json'))
+
+    # Started once, with the idle command
+    self.assertEqual(len(self.just_calls), 3)
+    start = self.just_calls[0]
+    container = start[start.index('--name') + 1]
+    self.assertEqual(start[start.index('--entrypoint'):],
+                     ('--entrypoint', 'tail', 'launch', '-f', '/dev/null'))
+
+    # Each run is an exec, with its own settings file
+    for call, settings_file in zip(self.just_calls[1:],
+                                   ['config_1.json', 'config_2.json']):
+      self.assertEqual(call, ('--wrap', 'docker', 'exec', '-e',
+                              f'TERRA_SETTINGS_FILE=/tmp_settings/'
+                              f'{settings_file}', container,
+                              '/entry.sh', 'run', 'ls'))
+
+    compute.close()
+    self.assertEqual(self.just_calls[-1],
+                     ('--wrap', 'docker', 'rm', '-f', container))
+    # Nothing left to close
+    compute.close()
+    self.assertEqual(len(self.just_calls), 4)
+
+  def test_pool_by_config(self):
+    compute = docker.Compute()
+    compute.run(MockPooledService())
+    compute.run(MockPooledService(TERRA_VOLUME_2='/data:/data'))
+    compute.run(MockPooledService())
+
+    starts = [call for call in self.just_calls if '-d' in call]
+    self.assertEqual(len(starts), 2)
+    compute.close()
+    self.assertEqual(len(self.just_calls[-1]), 6)
+
+  def test_run_failed(self):
+    compute = docker.Compute()
+    self.return_value = 1
+    with self.assertRaises(base.ServiceRunFailed):
+      compute.run(MockPooledService())
+
+  def test_not_pooled(self):
+    settings.compute.pool = False
+    compute = docker.Compute()
+    self.assertFalse(compute.pooled)
+
+
+class MockPrepareService(MockJustService):
+  def __init__(self, name):
+    self.compose_service_name = name
+
+
+class TestDockerPrepare(TestThreadPoolExecutorCase, TestComputeDockerCase):
+  def mock_just(_self, *args, **kwargs):
+    with _self.lock:
+      _self.just_calls.append(args)
+    returncode = 0
+    if args[2:4] == ('image', 'inspect'):
+      returncode = 0 if args[4] in _self.images else 1
+    elif args[-1] in _self.failing:
+      returncode = 1
+    return type('blah', (object,),
+                {'communicate': lambda self: ('', None),
+                 'returncode': returncode})()
+
+  def mock_config(_self, service_info):
+    return {'services': {'web': {'image': 'nginx:latest'},
+                         'proxy': {'image': 'nginx:latest'},
+                         'db': {'image': 'postgres:13'},
+                         'app': {'image': 'app:dev',
+                                 'build': {'context': '.'}},
+                         'tool': {'build': {'context': 'tool'}},
+                         'bare': {}}}
+
+  def setUp(self):
+    self.just_calls = []
+    self.lock = threading.Lock()
+    self.images = set()
+    self.failing = set()
+    self.patches.append(mock.patch.object(docker, 'just', self.mock_just))
+    self.patches.append(mock.patch.object(docker.Compute, 'config_service',
+                                          self.mock_config))
+    super().setUp()
+
+  def test_prepare(self):
+    self.images.add('postgres:13')
+    compute = docker.Compute()
+    results = compute.prepare([MockPrepareService(name) for name in
+                               ['web', 'proxy', 'db', 'app', 'tool', 'bare']])
+    self.assertEqual(results, {'nginx:latest': None, 'postgres:13': None,
+                               'app:dev': None, 'tool (file1)': None})
+
+    # Each image once, and only what is missing
+    pulls = [call for call in self.just_calls if 'pull' in call]
+    self.assertEqual(pulls, [('--wrap', 'docker', 'pull', 'nginx:latest')])
+    builds = sorted(call[-1] for call in self.just_calls if 'build' in call)
+    self.assertEqual(builds, ['app', 'tool'])
+    self.assertIn(('--wrap', 'Just-docker-compose', '-f', 'file1', 'build',
+                   'tool'), self.just_calls)
+
+  def test_prepare_present(self):
+    self.images.update(['nginx:latest', 'app:dev'])
+    compute = docker.Compute()
+    compute.prepare([MockPrepareService('web'), MockPrepareService('app')])
+    self.assertEqual([call[2:4] for call in self.just_calls],
+                     [('image', 'inspect')] * 2)
+
+  def test_prepare_failed(self):
+    self.failing.add('postgres:13')
+    compute = docker.Compute()
+    with self.assertLogs(base.__name__, level='WARNING'):
+      results = compute.prepare([MockPrepareService('web'),
+                                 MockPrepareService('db')])
+    self.assertIsNone(results['nginx:latest'])
+    self.assertIsInstance(results['postgres:13'], base.ServiceRunFailed)
+    self.assertEqual(results['postgres:13'].returncode, 1)
+
 
 ###############################################################################
 
@@ -130,7 +352,8 @@ class TestDockerConfig(TestComputeDockerCase):
     # _self.assertEqual(args, _self.expected_args)
     # _self.assertEqual(kwargs, _self.expected_kwargs)
     return type('blah', (object,),
-                {'communicate': lambda self: ('out', None)})()
+                {'communicate': lambda self: ('out', None),
+                 'returncode': getattr(_self, 'returncode', 0)})()
 
   def test_config(self):
     compute = docker.Compute()
@@ -143,6 +366,15 @@ class TestDockerConfig(TestComputeDockerCase):
                       'env': {'BAR': 'FOO'}},
                      self.just_kwargs)
 
+  def test_config_failed(self):
+    compute = docker.Compute()
+    self.returncode = 1
+    with self.assertRaises(base.ServiceRunFailed):
+      compute.config(MockJustService())
+    # Not cached
+    self.returncode = 0
+    self.assertEqual(compute.config(MockJustService()), 'out')
+
   def test_config_with_multiple_compose_files(self):
     compute = docker.Compute()
     service = MockJustService()
@@ -0,0 +1,80 @@
+import sys
+import types
+from unittest import mock
+
+from terra import settings
+from terra.executor.utils import Executor
+from terra.compute import base
+from terra.compute import inprocess
+import terra.compute.utils
+
+from .utils import TestSettingsUnconfiguredCase
+
+
+class MockInProcessService(inprocess.Service):
+  def __init__(self, module='terra_test_runner'):
+    super().__init__()
+    self.command = ['python', '-m', module]
+
+
+class TestInProcess(TestSettingsUnconfiguredCase):
+  def setUp(self):
+    # self.run trigger Executor
+    self.patches.append(mock.patch.dict(Executor.__dict__))
+    self.patches.append(
+        mock.patch.object(
+            terra.compute.utils.ComputeHandler,
+            '_connection',
+            mock.PropertyMock(return_value=inprocess.Compute())))
+
+    self.runner = types.ModuleType('terra_test_runner')
+    self.runner.main = self.main
+    self.patches.append(mock.patch.dict(sys.modules,
+                                        terra_test_runner=self.runner))
+    self.calls = []
+    super().setUp()
+    settings.configure({'compute': {'arch': 'inprocess'},
+                        'processing_dir': self.temp_dir.name})
+
+  def main(self):
+    self.calls.append(settings.terra.zone)
+    settings.runner_value = 15
+
+  def test_run(self):
+    compute = inprocess.Compute()
+    compute.run(MockInProcessService())
+    self.assertEqual(self.calls, ['runner'])
+    # The runner's settings changes stay in its context
+    self.assertEqual(settings.terra.zone, 'controller')
+    self.assertNotIn('runner_value', settings)
+
+  def test_run_failed(self):
+    def main():
+      raise RuntimeError('boom')
+    self.runner.main = main
+
+    compute = inprocess.Compute()
+    with self.assertRaisesRegex(base.ServiceRunFailed, 'boom'):
+      compute.run(MockInProcessService())
+
+  def test_exit(self):
+    def main():
+      sys.exit(2)
+    self.runner.main = main
+
+    compute = inprocess.Compute()
+    with self.assertRaisesRegex(base.ServiceRunFailed, 'exited with 2'):
+      compute.run(MockInProcessService())
+
+    self.runner.main = lambda: sys.exit(0)
+    compute.run(MockInProcessService())
+
+  def test_runner_module(self):
+    self.assertEqual(inprocess.Compute.runner_module(
+        ['python', '-m', 'foo.bar', '--arg']), 'foo.bar')
+    with self.assertRaises(ValueError):
+      inprocess.Compute.runner_module(['python', 'foo.py'])
+
+  def test_arch(self):
+    self.assertIsInstance(terra.compute.utils.ComputeHandler('inprocess')
+                          ._connect_backend(), inprocess.Compute)
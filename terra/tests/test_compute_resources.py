@@ -0,0 +1,136 @@
+import os
+import sys
+from subprocess import Popen, PIPE
+import threading
+import time
+from unittest import mock, skipUnless
+
+from terra import settings
+from terra.compute import base
+from terra.compute import resources
+import terra.compute.utils
+from .utils import TestCase, TestSettingsUnconfiguredCase
+
+
+class TestParse(TestCase):
+  def test_memory(self):
+    self.assertEqual(resources.parse_memory(1000), 1000)
+    self.assertEqual(resources.parse_memory('1000'), 1000)
+    self.assertEqual(resources.parse_memory('4k'), 4096)
+    self.assertEqual(resources.parse_memory('1.5M'), 1572864)
+    self.assertEqual(resources.parse_memory('2gb'), 2 * 1024**3)
+    with self.assertRaises(ValueError):
+      resources.parse_memory('lots')
+
+  def test_cpuset(self):
+    self.assertEqual(resources.parse_cpuset('0-3,6'), [0, 1, 2, 3, 6])
+    self.assertEqual(resources.parse_cpuset([3, 1, 1]), [1, 3])
+    self.assertEqual(resources.parse_cpuset(2), [2])
+    self.assertEqual(resources.format_cpuset([0, 1, 5]), '0,1,5')
+    with self.assertRaises(ValueError):
+      resources.parse_cpuset('0-a')
+
+
+class TestServiceResources(TestSettingsUnconfiguredCase):
+  def setUp(self):
+    self.patches.append(mock.patch.object(settings, '_wrapped', None))
+    super().setUp()
+    settings.configure({'processing_dir': self.temp_dir.name,
+                        'compute': {'resources': {'cpus': 1,
+                                                  'memory': '1g'}}})
+
+  def test_defaults(self):
+    service = base.BaseService()
+    self.assertEqual(resources.service_resources(service),
+                     {'cpus': 1.0, 'memory': 1024**3})
+    service.resources = {'memory': 100, 'cpuset': '0'}
+    self.assertEqual(resources.service_resources(service),
+                     {'cpus': 1.0, 'memory': 100, 'cpuset': [0]})
+
+  def test_none(self):
+    settings.compute.resources = None
+    self.assertEqual(resources.service_resources(object()), {})
+
+  def test_admitted_on_run(self):
+    class Compute(base.BaseCompute):
+      def run_service(self, service_info):
+        return self.admission.used_cpus
+
+    class Service:
+      resources = {'cpus': 2}
+
+    compute = Compute()
+    with mock.patch.object(terra.compute.utils, 'load_service',
+                           lambda service: service()):
+      self.assertEqual(compute.run(Service), 2.0)
+    self.assertEqual(compute.admission.used_cpus, 0)
+    self.assertEqual(compute.admission.running, 0)
+
+
+class TestAdmissionController(TestCase):
+  def run_services(self, controller, requests, duration=0.05):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def service(request):
+      with controller.admit(request):
+        with lock:
+          running.append(request)
+          peak.append(sum(r.get('cpus', 0) for r in running))
+        time.sleep(duration)
+        with lock:
+          running.remove(request)
+
+    threads = [threading.Thread(target=service, args=(request,))
+               for request in requests]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return max(peak)
+
+  def test_cpus(self):
+    controller = resources.AdmissionController(cpus=4, memory=1000)
+    self.assertEqual(
+        self.run_services(controller, [{'cpus': 2}, {'cpus': 2},
+                                       {'cpus': 2}, {'cpus': 1}]), 4)
+    self.assertEqual(controller.used_cpus, 0)
+
+  def test_memory(self):
+    controller = resources.AdmissionController(cpus=100, memory=1000)
+    start = time.time()
+    self.run_services(controller, [{'memory': 600}, {'memory': 600}])
+    # One after the other
+    self.assertGreaterEqual(time.time() - start, 0.1)
+
+  def test_oversized(self):
+    # Admitted, once nothing else is running
+    controller = resources.AdmissionController(cpus=2)
+    self.assertEqual(
+        self.run_services(controller, [{'cpus': 1}, {'cpus': 8}]), 8)
+
+  def test_pinned(self):
+    controller = resources.AdmissionController(cpus=100)
+    controller.acquire({'cpuset': [0, 1]})
+    self.assertEqual(controller.used_cpus, 2)
+    # Not the same CPUs
+    self.assertTrue(controller._fits(1, 0, {2}))
+    self.assertFalse(controller._fits(1, 0, {1}))
+    controller.release({'cpuset': [0, 1]})
+    self.assertEqual(controller.pinned, set())
+
+
+@skipUnless(hasattr(os, 'sched_setaffinity'), 'Linux only')
+class TestLimitProcess(TestCase):
+  def test_limit(self):
+    cpu = sorted(os.sched_getaffinity(0))[0]
+    pid = Popen([sys.executable, '-c',
+                 'import os, resource, sys; sys.stdin.read(); '
+                 'print(os.sched_getaffinity(0), '
+                 'resource.getrlimit(resource.RLIMIT_AS)[0])'],
+                stdin=PIPE, stdout=PIPE)
+    resources.limit_process(pid.pid, {'cpuset': [cpu], 'memory': 2**34})
+    out = pid.communicate(b'')[0]
+    self.assertEqual(out.decode().split(), ['{' + str(cpu) + '}',
+                                            str(2**34)])
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from unittest import mock
 
@@ -6,7 +7,9 @@ from terra.compute import base
 from terra.compute import singularity
 import terra.compute.utils
 
-from .utils import TestSettingsUnconfiguredCase
+from .utils import (
+  TestSettingsUnconfiguredCase, TestThreadPoolExecutorCase
+)
 
 
 class TestComputeSingularityCase(TestSettingsUnconfiguredCase):
@@ -63,6 +66,16 @@ class TestSingular(TestComputeSingularityCase):
     with self.assertRaises(base.ServiceRunFailed):
       compute.run(MockJustService())
 
+  def test_run_env(self):
+    # Per-run variables of staged services
+    service = MockJustService()
+    service.run_env = {'TERRA_SETTINGS_FILE': '/tmp_settings/settings_1.json'}
+    _, kwargs = singularity.Compute().run_command(service)
+    self.assertEqual(kwargs['env'],
+                     {'BAR': 'FOO', 'SINGULARITYENV_TERRA_SETTINGS_FILE':
+                      '/tmp_settings/settings_1.json'})
+    self.assertEqual(service.env, {'BAR': 'FOO'})
+
   def test_run_multiple_compose_files(self):
     compute = singularity.Compute()
 
@@ -83,6 +96,191 @@ class TestSingular(TestComputeSingularityCase):
       compute.run(MockJustService())
 
 
+class TestSingularAsync(TestComputeSingularityCase):
+  async def mock_ajust(_self, *args, **kwargs):
+    _self.just_args = args
+    _self.just_kwargs = kwargs
+
+    async def wait():
+      return _self.return_value
+    return type('blah', (object,), {'wait': staticmethod(wait)})()
+
+  def setUp(self):
+    self.patches.append(mock.patch.object(singularity, 'ajust',
+                                          self.mock_ajust))
+    super().setUp()
+
+  def test_arun(self):
+    compute = singularity.Compute()
+    self.return_value = 0
+    asyncio.run(compute.arun(MockJustService()))
+    self.assertEqual(('singular-compose', '-f', 'file1', 'run', 'launch',
+                      'ls'),
+                     self.just_args)
+    self.assertEqual({'env': {'BAR': 'FOO'}}, self.just_kwargs)
+
+    self.return_value = 1
+    with self.assertRaises(base.ServiceRunFailed):
+      asyncio.run(compute.arun(MockJustService()))
+
+
+class MockPooledService(MockJustService):
+  pooled = True
+
+  def __init__(self, settings_file='config_1.json'):
+    super().__init__()
+    self.run_env = {'TERRA_SETTINGS_FILE': f'/tmp_settings/{settings_file}'}
+
+
+class TestSingularityPool(TestComputeSingularityCase):
+  def mock_just(_self, *args, **kwargs):
+    _self.just_calls.append((args, kwargs))
+    return type('blah', (object,),
+                {'wait': lambda self: _self.return_value,
+                 'communicate': lambda self: ('', None),
+                 'returncode': _self.return_value})()
+
+  def mock_config(_self, service_info):
+    _self.configs += 1
+    return {'image': ['launch.simg'],
+            'volumes': ['/foo:/bar', '/tmp/pool:/tmp_settings:rw'],
+            'singularity_flags': ['-c', '-e'],
+            'environment': {'FOO': 'BAR'}}
+
+  def setUp(self):
+    self.just_calls = []
+    self.configs = 0
+    self.return_value = 0
+    self.patches.append(mock.patch.object(singularity, 'just',
+                                          self.mock_just))
+    self.patches.append(mock.patch.object(singularity.Compute,
+                                          'config_service', self.mock_config))
+    self.patches.append(mock.patch.object(base, 'atexit'))
+    super().setUp()
+    settings.compute.pool = True
+
+  def test_pooled(self):
+    compute = singularity.Compute()
+    self.assertTrue(compute.pooled)
+    compute.run(MockPooledService('config_1.json'))
+    compute.run(MockPooledService('config_2.json'))
+
+    # One instance, started with the config-null image, volumes and flags
+    self.assertEqual(len(self.just_calls), 3)
+    start = self.just_calls[0][0]
+    instance = start[-1]
+    self.assertTrue(instance.endswith('_launch'))
+    self.assertEqual(start[:-1], ('--wrap', 'singularity', 'instance', 'start',
+                                  '-c', '-e', '-B', '/foo:/bar',
+                                  '-B', '/tmp/pool:/tmp_settings:rw',
+                                  'launch.simg'))
+
+    for (args, kwargs), settings_file in zip(self.just_calls[1:],
+                                             ['config_1.json',
+                                              'config_2.json']):
+      self.assertEqual(args, ('--wrap', 'singularity', 'exec',
+                              f'instance://{instance}', 'ls'))
+      self.assertEqual(kwargs['env'],
+                       {'BAR': 'FOO', 'SINGULARITYENV_FOO': 'BAR',
+                        'SINGULARITYENV_TERRA_SETTINGS_FILE':
+                            f'/tmp_settings/{settings_file}'})
+
+    compute.close()
+    self.assertEqual(self.just_calls[-1][0],
+                     ('--wrap', 'singularity', 'instance', 'stop', instance))
+
+  def test_instance_per_service(self):
+    compute = singularity.Compute()
+    service = MockPooledService()
+    compute.run(service)
+    service.compose_service_name = 'other'
+    compute.run(service)
+    compute.run(MockPooledService())
+
+    starts = [args for args, _ in self.just_calls if 'start' in args]
+    self.assertEqual(len(starts), 2)
+    compute.close()
+    stops = [args for args, _ in self.just_calls if 'stop' in args]
+    self.assertEqual(len(stops), 2)
+
+  def test_start_failed(self):
+    compute = singularity.Compute()
+    self.return_value = 1
+    with self.assertRaises(base.ServiceRunFailed):
+      compute.run(MockPooledService())
+    # Nothing was added to the pool
+    compute.close()
+    self.assertEqual(len(self.just_calls), 1)
+
+  def test_resources(self):
+    compute = singularity.Compute()
+    service = MockPooledService()
+    service.resources = {'cpus': 1.5, 'memory': 1000, 'cpuset': [2, 3]}
+    compute.run(service)
+    start = self.just_calls[0][0]
+    self.assertEqual(start[4:12], ('-c', '-e', '--cpus', '1.5',
+                                   '--memory', '1000',
+                                   '--cpuset-cpus', '2,3'))
+
+
+class TestSingularityResources(TestSingular):
+  def test_resources(self):
+    compute = singularity.Compute()
+    self.return_value = 0
+    service = MockJustService()
+    service.resources = {'memory': '2m'}
+    compute.run(service)
+
+    override = self.just_args[4]
+    self.assertEqual(self.just_args[:5],
+                     ('singular-compose', '-f', 'file1', '-f', override))
+    with open(override, 'r') as fid:
+      self.assertEqual(fid.read(),
+                       'launch_singularity_flags+=(--memory 2097152)\n')
+
+
+class TestSingularityPrepare(TestThreadPoolExecutorCase,
+                             TestComputeSingularityCase):
+  def mock_just(_self, *args, **kwargs):
+    _self.just_calls.append(args)
+    return type('blah', (object,),
+                {'communicate': lambda self: ('', None),
+                 'returncode': _self.return_value})()
+
+  def mock_config(_self, service_info):
+    return {'image': [service_info.image]}
+
+  def setUp(self):
+    self.just_calls = []
+    self.return_value = 0
+    self.patches.append(mock.patch.object(singularity, 'just',
+                                          self.mock_just))
+    self.patches.append(mock.patch.object(singularity.Compute,
+                                          'config_service', self.mock_config))
+    super().setUp()
+
+  def service(self, image):
+    service = MockJustService()
+    service.image = image
+    return service
+
+  def test_prepare(self):
+    compute = singularity.Compute()
+    results = compute.prepare([self.service('docker://alpine:3'),
+                               self.service('docker://alpine:3'),
+                               self.service('/images/local.sif')])
+    self.assertEqual(results, {'docker://alpine:3': None})
+    self.assertEqual(self.just_calls, [('--wrap', 'singularity', 'exec',
+                                        'docker://alpine:3', 'true')])
+
+  def test_prepare_failed(self):
+    self.return_value = 255
+    compute = singularity.Compute()
+    with self.assertLogs(base.__name__, level='WARNING'):
+      results = compute.prepare([self.service('library://lolcow')])
+    self.assertEqual(results['library://lolcow'].returncode, 255)
+
+
 class TestSingularityConfig(TestComputeSingularityCase):
   def setUp(self):
     # Mock the just call for recording
@@ -99,7 +297,8 @@ class TestSingularityConfig(TestComputeSingularityCase):
     return type('blah', (object,),
                 {'communicate':
                  lambda self: (b'environment\0^foo\0.bar\0^stuff\0^boo\0.far',
-                               None)})()
+                               None),
+                 'returncode': getattr(_self, 'returncode', 0)})()
 
   def test_config(self):
     compute = singularity.Compute()
@@ -113,6 +312,16 @@ class TestSingularityConfig(TestComputeSingularityCase):
                       'justfile': None},
                      self.just_kwargs)
 
+  def test_config_failed(self):
+    compute = singularity.Compute()
+    self.returncode = 255
+    with self.assertRaises(base.ServiceRunFailed):
+      compute.config(MockJustService())
+    # Not cached
+    self.returncode = 0
+    self.assertEqual(compute.config(MockJustService()),
+                     {'environment': {'foo': 'bar'}, 'stuff': ['boo', 'far']})
+
   def test_config_with_multiple_compose_files(self):
     compute = singularity.Compute()
     service = MockJustService()
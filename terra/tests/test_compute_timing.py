@@ -0,0 +1,105 @@
+import json
+import os
+from unittest import mock
+
+from terra import settings
+from terra.compute import base
+from terra.compute import timing
+import terra.compute.utils
+from .utils import TestCase, TestSettingsUnconfiguredCase
+
+
+class TestServiceTimings(TestCase):
+  def test_phases(self):
+    timings = timing.ServiceTimings()
+    with timings.time('run') as timer:
+      with timing.phase('pre_run'):
+        with timing.phase('configuration_map'):
+          pass
+        # Inner commands are phases of the outer one
+        with timings.time('configuration_map') as inner:
+          self.assertIsNone(inner)
+      with timing.phase('spawn'):
+        pass
+    self.assertEqual(set(timer.phases),
+                     {'pre_run', 'configuration_map', 'spawn'})
+    self.assertGreaterEqual(timer.duration, timer.phases['pre_run'])
+    self.assertEqual(timings.totals[('run', 'configuration_map')][0], 1)
+    self.assertEqual(timings.totals[('run', 'total')][0], 1)
+    # No timer, no phase
+    with timing.phase('spawn'):
+      pass
+
+  def test_failed(self):
+    timings = timing.ServiceTimings()
+    with self.assertRaises(ValueError):
+      with timings.time('run') as timer:
+        raise ValueError()
+    self.assertTrue(timer.failed)
+    self.assertIsNotNone(timer.duration)
+
+  def test_summary(self):
+    timings = timing.ServiceTimings()
+    for _ in range(2):
+      with timings.time('run'):
+        with timing.phase('spawn'):
+          pass
+    summary = timings.summary().split('\n')
+    self.assertEqual(len(summary), 3)
+    self.assertTrue(summary[1].startswith('run'))
+    self.assertIn(' spawn ', summary[1])
+    self.assertIn(' 2 ', summary[1])
+
+    with self.assertLogs(timing.__name__, level='INFO') as log:
+      timings.log_summary()
+    self.assertIn('Service timings', log.output[0])
+    self.assertEqual(timings.totals, {})
+
+
+class TimedService:
+  def pre_run(self):
+    with timing.phase('serialize_settings'):
+      pass
+
+
+class TimedCompute(base.BaseCompute):
+  def run_service(self, service_info):
+    with timing.phase('spawn'):
+      pass
+
+
+class TestComputeTimings(TestSettingsUnconfiguredCase):
+  def setUp(self):
+    self.patches.append(mock.patch.object(timing, 'service_timings',
+                                          timing.ServiceTimings()))
+    self.patches.append(mock.patch.object(base, 'service_timings',
+                                          timing.ServiceTimings()))
+    self.patches.append(mock.patch.object(terra.compute.utils,
+                                          'load_service',
+                                          lambda service: service()))
+    super().setUp()
+    settings.configure({'processing_dir': self.temp_dir.name})
+
+  def test_run(self):
+    settings.compute.service_timings = True
+    compute = TimedCompute()
+    compute.run(TimedService)
+    compute.run(TimedService)
+
+    with open(os.path.join(self.temp_dir.name,
+                           'service_timings.jsonl'), 'r') as fid:
+      records = [json.loads(line) for line in fid]
+    self.assertEqual(len(records), 2)
+    self.assertEqual(records[0]['service'], 'TimedService')
+    self.assertEqual(records[0]['command'], 'run')
+    self.assertFalse(records[0]['failed'])
+    self.assertEqual(set(records[0]['phases']),
+                     {'load_service', 'pre_run', 'serialize_settings',
+                      'run', 'spawn'})
+
+  def test_disabled(self):
+    # Only the summary, by default
+    TimedCompute().run(TimedService)
+    self.assertFalse(os.path.exists(os.path.join(self.temp_dir.name,
+                                                 'service_timings.jsonl')))
+    self.assertEqual(base.service_timings.totals[('run', 'total')][0], 1)
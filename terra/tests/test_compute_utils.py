@@ -1,9 +1,15 @@
+import ntpath
 import os
-from unittest import mock
+import pathlib
+from subprocess import Popen, PIPE
+import sys
+import threading
+import time
+from unittest import mock, skipIf, skipUnless
 import warnings
 
 from terra import settings
-from .utils import TestSettingsUnconfiguredCase
+from .utils import TestSettingsUnconfiguredCase, TestThreadPoolExecutorCase
 import terra.compute.utils as utils
 import terra.compute.dummy
 import terra.compute.docker
@@ -110,6 +116,97 @@ class TestUtils(TestComputeUtilsCase):
     self.assertIn(f'{__name__} is not registered', str(log.output))
 
 
+class TestRunInBackground(TestThreadPoolExecutorCase,
+                          TestSettingsUnconfiguredCase):
+  def setUp(self):
+    super().setUp()
+    settings.configure({'processing_dir': self.temp_dir.name,
+                        'name': 'main'})
+
+  def test_caller_settings(self):
+    from terra.executor.thread import ThreadPoolExecutor
+
+    def in_worker():
+      settings.name = 'worker'
+      return utils.run_in_background(getattr, settings, 'name').result()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      self.assertEqual(executor.submit(in_worker).result(), 'worker')
+    self.assertEqual(utils.run_in_background(getattr, settings,
+                                             'name').result(), 'main')
+
+
+class TestWriteHashedFile(TestSettingsUnconfiguredCase):
+  def test_write(self):
+    filename = utils.write_hashed_file(self.temp_dir.name, 'settings_',
+                                       '{}', '.json')
+    self.assertTrue(os.path.basename(filename).startswith('settings_'))
+    self.assertTrue(filename.endswith('.json'))
+    with open(filename, 'r') as fid:
+      self.assertEqual(fid.read(), '{}')
+
+    # The same content is the same file, and is not written again
+    with mock.patch('builtins.open') as mock_open:
+      self.assertEqual(utils.write_hashed_file(self.temp_dir.name,
+                                               'settings_', b'{}', '.json'),
+                       filename)
+    mock_open.assert_not_called()
+    self.assertNotEqual(utils.write_hashed_file(self.temp_dir.name,
+                                                'settings_', '[]', '.json'),
+                        filename)
+    self.assertEqual(len(os.listdir(self.temp_dir.name)), 2)
+
+
+class TestLoadServiceCache(TestComputeUtilsCase):
+  def setUp(self):
+    self.patches.append(mock.patch.dict(utils._service_classes, clear=True))
+    self.patches.append(mock.patch.dict(utils._service_prototypes,
+                                        clear=True))
+    self.patches.append(mock.patch.dict(utils.compute.__dict__,
+                                        _connection=Compute()))
+    super().setUp()
+
+  def test_cached(self):
+    name = Service.__module__ + '.Service2'
+    with self.assertLogs(utils.__name__, level='INFO'):
+      self.assertIsInstance(utils.load_service(name), Service)
+    # Not imported or logged again
+    with mock.patch.object(utils, 'import_module') as import_module, \
+        mock.patch.object(utils.logger, 'info') as info:
+      self.assertIsInstance(utils.load_service(name), Service)
+    import_module.assert_not_called()
+    info.assert_not_called()
+
+  def test_registration_changes(self):
+    self.assertIsInstance(utils.load_service(Service2), Service)
+    Compute.register(Service2)(Service2_test)
+    self.assertIsInstance(utils.load_service(Service2), Service2_test)
+
+    utils.clear_service_cache()
+    self.assertEqual(utils._service_classes, {})
+
+  def test_reuse(self):
+    class Counted(Service_test):
+      count = 0
+
+      def __init__(self):
+        Counted.count += 1
+        self.env = {'FOO': 'BAR'}
+
+    Compute.register(Service2)(Counted)
+    settings.compute.reuse_services = True
+    first = utils.load_service(Service2)
+    first.env['FOO'] = 'changed'
+    second = utils.load_service(Service2)
+    self.assertIsNot(first, second)
+    self.assertEqual(second.env, {'FOO': 'BAR'})
+    self.assertEqual(Counted.count, 1)
+
+    settings.compute.reuse_services = False
+    utils.load_service(Service2)
+    self.assertEqual(Counted.count, 2)
+
+
 class TestComputeHandler(TestComputeUtilsCase):
   @mock.patch.object(settings, '_wrapped', None)
   def test_compute_handler(self):
@@ -195,3 +292,523 @@ class TestBaseJust(TestComputeUtilsCase):
     # JUSTFILE was changed
     self.assertTrue(any(o.startswith('+ JUSTFILE:') for o in env_lines))
     self.assertTrue(any(o.startswith('- JUSTFILE:') for o in env_lines))
+
+
+class TestConfigCache(TestComputeUtilsCase):
+  class Service:
+    compose_service_name = 'launch'
+
+    def __init__(self, compose_file, env):
+      self.compose_files = [compose_file]
+      self.env = env
+
+  def setUp(self):
+    super().setUp()
+    self.compose_file = os.path.join(self.temp_dir.name, 'compose.yml')
+    with open(self.compose_file, 'w') as fid:
+      fid.write('volumes:\n  - ${DATA_DIR}:/data\n')
+    self.calls = 0
+
+  def config(self):
+    self.calls += 1
+    return {'calls': self.calls}
+
+  def test_hit(self):
+    cache = utils.ConfigCache()
+    service = self.Service(self.compose_file, {'DATA_DIR': '/foo'})
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 1})
+    # Different service, same compose files and variables
+    service = self.Service(self.compose_file, {'DATA_DIR': '/foo',
+                                               'UNRELATED': 'bar'})
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 1})
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+  def test_concurrent(self):
+    cache = utils.ConfigCache()
+    service = self.Service(self.compose_file, {'DATA_DIR': '/foo'})
+    started = threading.Event()
+
+    def slow_config():
+      started.set()
+      time.sleep(0.1)
+      return self.config()
+
+    # The same call, while the first one is still running, waits for it
+    first = utils.run_in_background(cache.get, ['config'], service,
+                                    slow_config)
+    started.wait()
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 1})
+    self.assertEqual(first.result(), {'calls': 1})
+    self.assertEqual(self.calls, 1)
+
+  def test_concurrent_failure(self):
+    cache = utils.ConfigCache()
+    service = self.Service(self.compose_file, {})
+    started = threading.Event()
+
+    def failed_config():
+      started.set()
+      time.sleep(0.1)
+      raise OSError('no docker')
+
+    first = utils.run_in_background(cache.get, ['config'], service,
+                                    failed_config)
+    started.wait()
+    with self.assertRaises(OSError):
+      cache.get(['config'], service, self.config)
+    with self.assertRaises(OSError):
+      first.result()
+    # Not cached
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 1})
+
+  def test_result_copied(self):
+    cache = utils.ConfigCache()
+    service = self.Service(self.compose_file, {})
+    cache.get(['config'], service, self.config)['calls'] = 15
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 1})
+
+  def test_miss(self):
+    cache = utils.ConfigCache()
+    service = self.Service(self.compose_file, {'DATA_DIR': '/foo'})
+    cache.get(['config'], service, self.config)
+
+    # Referenced variable
+    service.env = {'DATA_DIR': '/bar'}
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 2})
+    # Variable used by the wrappers
+    service.env = {'DATA_DIR': '/bar', 'JUST_PROJECT_PREFIX': 'TERRA',
+                   'TERRA_VOLUME_1': '/tmp:/tmp'}
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 3})
+    # Arguments, e.g. service name
+    self.assertEqual(cache.get(['config-null', 'foo'], service, self.config),
+                     {'calls': 4})
+    # Compose file modified
+    stat = os.stat(self.compose_file)
+    os.utime(self.compose_file, ns=(stat.st_atime_ns,
+                                    stat.st_mtime_ns + 1000000000))
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 5})
+
+  def test_env_files(self):
+    cache = utils.ConfigCache()
+    service = self.Service(self.compose_file, {})
+    service.justfile = os.path.join(self.temp_dir.name, 'Justfile')
+    local_env = os.path.join(self.temp_dir.name, 'local.env')
+    open(service.justfile, 'w').close()
+    cache.get(['config'], service, self.config)
+
+    # An env file just sources is added or modified
+    with open(local_env, 'w') as fid:
+      fid.write('TERRA_DATA_DIR=/foo\n')
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 2})
+    stat = os.stat(local_env)
+    os.utime(local_env, ns=(stat.st_atime_ns,
+                            stat.st_mtime_ns + 1000000000))
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 3})
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 3})
+
+  def test_persisted(self):
+    filename = os.path.join(self.temp_dir.name, 'cache', 'config.json')
+    service = self.Service(self.compose_file, {'DATA_DIR': '/foo'})
+    utils.ConfigCache(filename).get(['config'], service, self.config)
+
+    cache = utils.ConfigCache(filename)
+    self.assertEqual(cache.get(['config'], service, self.config),
+                     {'calls': 1})
+    self.assertEqual(cache.hits, 1)
+
+    cache.clear()
+    self.assertEqual(utils.ConfigCache(filename).get(['config'], service,
+                                                     self.config),
+                     {'calls': 2})
+
+  def test_from_settings(self):
+    self.assertIsNone(utils.ConfigCache.from_settings().filename)
+    settings.compute.config_cache = '/foo/bar.json'
+    self.assertEqual(utils.ConfigCache.from_settings().filename,
+                     '/foo/bar.json')
+
+
+fake_just = '''
+if [ "${1}" = "--wrap" ]; then
+  shift
+fi
+case "${1}" in
+  Fake-compose)
+    shift
+    export FAKE_COUNT=$((${FAKE_COUNT-0} + 1))
+    ${DRYRUN} fake-compose -f "${FAKE_COMPOSE_FILE}" "${@}"
+    ;;
+  Temp-compose)
+    shift
+    ${DRYRUN} fake-compose -f "${FAKE_COMPOSE_FILE}.tmp" "${@}"
+    ;;
+  No-dryrun)
+    shift
+    fake-compose "${@}"
+    ;;
+esac
+'''
+
+fake_compose = '''#!/usr/bin/env bash
+echo "${FAKE_COUNT-}:${FOO-}:${*}"
+'''
+
+
+@skipIf(os.name == 'nt', 'Requires bash')
+class TestJustResolver(TestComputeUtilsCase):
+  def setUp(self):
+    super().setUp()
+    for name, script in (('just', fake_just),
+                         ('fake-compose', fake_compose)):
+      with open(os.path.join(self.temp_dir.name, name), 'w') as fid:
+        fid.write(script)
+      os.chmod(os.path.join(self.temp_dir.name, name), 0o755)
+    self.compose_file = os.path.join(self.temp_dir.name, 'compose.yml')
+    open(self.compose_file, 'w').close()
+
+    self.env = os.environ.copy()
+    self.env['PATH'] = self.temp_dir.name + os.pathsep + self.env['PATH']
+    self.env['FAKE_COMPOSE_FILE'] = self.compose_file
+    self.env['JUST_PROJECT_PREFIX'] = 'TERRA'
+    self.resolver = utils.JustResolver()
+
+  def run_direct(self, *args, env=None):
+    pid = self.resolver.popen(args, env or self.env, stdout=PIPE)
+    if pid is None:
+      return None
+    return pid.communicate()[0].decode().strip()
+
+  def test_split(self):
+    self.assertEqual(utils.JustResolver.split(('--wrap', 'foo', 'bar')),
+                     (('--wrap', 'foo'), ('bar',)))
+    self.assertEqual(utils.JustResolver.split(('foo', 'bar', 'car')),
+                     (('foo',), ('bar', 'car')))
+
+  def test_resolve(self):
+    argv, resolved_env, _ = self.resolver.resolve(('--wrap', 'Fake-compose'),
+                                                  self.env)
+    self.assertEqual(argv, ['fake-compose', '-f', self.compose_file])
+    # The environment the wrapper made
+    self.assertEqual(resolved_env['FAKE_COUNT'], '1')
+    self.assertNotIn('DRYRUN', resolved_env)
+
+  def test_popen(self):
+    self.assertEqual(self.run_direct('--wrap', 'Fake-compose', 'run', 'foo'),
+                     f'1::-f {self.compose_file} run foo')
+    # Resolved once, the wrapper isn't run again
+    self.env['FOO'] = 'BAR'
+    self.assertEqual(self.run_direct('--wrap', 'Fake-compose', 'config'),
+                     f'1:BAR:-f {self.compose_file} config')
+    self.assertEqual(len(self.resolver._cache), 1)
+
+    # Compose environment variables are part of the key
+    self.env['TERRA_VOLUME_1'] = '/foo:/bar'
+    self.run_direct('--wrap', 'Fake-compose', 'config')
+    self.assertEqual(len(self.resolver._cache), 2)
+
+  def test_justfile_key(self):
+    justfiles = []
+    for name in ('a', 'b'):
+      os.mkdir(os.path.join(self.temp_dir.name, name))
+      justfiles.append(os.path.join(self.temp_dir.name, name, 'Justfile'))
+      open(justfiles[-1], 'w').close()
+
+    wrapper = ('--wrap', 'Fake-compose')
+    keys = [self.resolver.key(wrapper, dict(self.env, JUSTFILE=justfile))
+            for justfile in justfiles]
+    self.assertNotEqual(keys[0], keys[1])
+
+    # Editing the justfile changes the key too
+    stat = os.stat(justfiles[0])
+    os.utime(justfiles[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    self.assertNotEqual(
+        self.resolver.key(wrapper, dict(self.env, JUSTFILE=justfiles[0])),
+        keys[0])
+
+  def test_unresolvable(self):
+    self.assertIsNone(self.run_direct('No-dryrun', 'run', 'foo'))
+    self.assertIsNone(self.run_direct('--wrap', 'Temp-compose', 'run'))
+    self.assertEqual(len(self.resolver._cache), 2)
+
+  def test_just_fallback(self):
+    settings.compute.direct_compose = True
+    with mock.patch.object(utils, 'just_resolver', self.resolver), \
+        mock.patch.object(utils, 'Popen', wraps=utils.Popen) as popen:
+      pid = utils.just('No-dryrun', 'foo', env=self.env, stdout=PIPE)
+      self.assertEqual(pid.communicate()[0].decode().strip(), '::foo')
+      # The probe, then just
+      self.assertEqual(popen.call_count, 2)
+      self.assertEqual(popen.call_args[0][0], ('bash', 'just', 'No-dryrun',
+                                               'foo'))
+
+      pid = utils.just('--wrap', 'Fake-compose', 'foo', env=self.env,
+                       stdout=PIPE)
+      pid.communicate()
+      self.assertEqual(popen.call_args[0][0], ['fake-compose', '-f',
+                                               self.compose_file, 'foo'])
+
+
+class TestServiceOutput(TestComputeUtilsCase):
+  def run_python(self, output, code):
+    pid = Popen([sys.executable, '-c', code], **output.popen_kwargs)
+    output.wait(pid)
+
+  def test_disabled(self):
+    output = utils.ServiceOutput.from_settings(Service())
+    self.assertFalse(output.capture)
+    self.assertEqual(output.popen_kwargs, {})
+    with self.assertRaisesRegex(terra.compute.base.ServiceRunFailed,
+                                'Service exited with return code 3$'):
+      self.run_python(output, 'exit(3)')
+
+  def test_capture(self):
+    settings.compute.capture_output = True
+    output = utils.ServiceOutput.from_settings(Service())
+    with self.assertLogs(utils.__name__, level='INFO') as log:
+      self.run_python(output, 'import sys; print("out"); '
+                              'print("err", file=sys.stderr)')
+    self.assertIn('INFO:terra.compute.utils:Service stdout: out', log.output)
+    self.assertIn('INFO:terra.compute.utils:Service stderr: err', log.output)
+
+  def test_bounded(self):
+    output = utils.ServiceOutput('big', capture=True, tail=3)
+    output.max_line_length = 1000
+    code = ('import sys\n'
+            'for x in range(2000):\n'
+            '  print(x)\n'
+            '  print(x, file=sys.stderr)\n'
+            'sys.stdout.flush()\n'
+            'import time; time.sleep(0.1)\n'
+            'sys.stdout.write("x" * 2500)\n'
+            'exit(1)')
+    with self.assertLogs(utils.__name__, level='INFO') as log, \
+        self.assertRaises(terra.compute.base.ServiceRunFailed) as cm:
+      self.run_python(output, code)
+    # Nothing lost, and the line without a newline was split
+    self.assertEqual(len(log.output), 4003)
+    self.assertEqual(len(output.tail), 3)
+    self.assertIn('big exited with return code 1. Last output:\n'
+                  'stdout: ' + 'x' * 1000 + '\n', str(cm.exception))
+    self.assertTrue(str(cm.exception).endswith('stdout: ' + 'x' * 500))
+
+
+class TestVolumeTranslator(TestComputeUtilsCase):
+  volume_map = [('/data', '/mnt/data'),
+                ('/data/inputs', '/in'),
+                ('/opt/', '/software/')]
+
+  def test_component_match(self):
+    translator = utils.VolumeTranslator(self.volume_map)
+    self.assertEqual(translator.translate('/data/a.txt'), '/mnt/data/a.txt')
+    self.assertEqual(translator.translate('/data'), '/mnt/data')
+    # Not the same directory
+    self.assertEqual(translator.translate('/data2/a.txt'), '/data2/a.txt')
+    self.assertEqual(translator.translate('data/a.txt'), 'data/a.txt')
+    # Trailing slashes
+    self.assertEqual(translator.translate('/opt/bin'), '/software/bin')
+    self.assertEqual(translator.translate('/opt'), '/software/')
+
+  def test_longest_prefix(self):
+    # Regardless of the order of the volumes
+    for volume_map in (self.volume_map, self.volume_map[::-1]):
+      translator = utils.VolumeTranslator(volume_map)
+      self.assertEqual(translator.translate('/data/inputs/a'), '/in/a')
+      self.assertEqual(translator.translate('/data/inputs2'),
+                       '/mnt/data/inputs2')
+
+  def test_root(self):
+    translator = utils.VolumeTranslator([('/', '/host'), ('/data', '/')])
+    self.assertEqual(translator.translate('/foo/bar'), '/host/foo/bar')
+    self.assertEqual(translator.translate('/data/bar'), '/bar')
+    self.assertEqual(translator.translate('/data'), '/')
+
+  def test_translate_many(self):
+    translator = utils.VolumeTranslator(self.volume_map)
+    paths = ['/data/a', '/data/b', '/data/inputs', '/data/inputs/c',
+             '/data2/d', 'e', 15]
+    translated = ['/mnt/data/a', '/mnt/data/b', '/in', '/in/c', '/data2/d',
+                  'e', 15]
+    self.assertEqual(translator.translate_many(paths), translated)
+    self.assertEqual(translator.translate_many(tuple(paths)),
+                     tuple(translated))
+    self.assertEqual(translator.translate_many(paths),
+                     [translator.translate(path) if isinstance(path, str)
+                      else path for path in paths])
+
+  def test_inverse(self):
+    translator = utils.VolumeTranslator(self.volume_map).inverse()
+    self.assertEqual(translator.translate('/in/a'), '/data/inputs/a')
+    self.assertEqual(translator.translate('/mnt/data/a'), '/data/a')
+
+  def test_compiled_once(self):
+    self.assertIs(utils.volume_translator([['/a', '/b']]),
+                  utils.volume_translator((('/a', '/b'),)))
+
+  @skipIf(os.name == 'nt', 'Linux volume translation')
+  def test_translate_settings_paths(self):
+    config = {'input_file': '/data/inputs/a',
+              'other_files': ['/data/b', '/data2/c'],
+              'nested': {'data_dir': '/data'},
+              'name': '/data/not_a_path'}
+    self.assertEqual(
+        utils.translate_settings_paths(config, self.volume_map),
+        {'input_file': '/in/a',
+         'other_files': ['/mnt/data/b', '/data2/c'],
+         'nested': {'data_dir': '/mnt/data'},
+         'name': '/data/not_a_path'})
+
+  # Two digit project numbers, so no volume is a string prefix of another and
+  # the startswith loop translates the same
+  benchmark_map = [(f'/projects/{i:02d}', f'/mnt/{i:02d}') for i in range(50)]
+  benchmark_paths = [f'/projects/{i % 60:02d}/data/file{i}.tif'
+                     for i in range(100000)]
+
+  def test_many_volumes(self):
+    translator = utils.VolumeTranslator(self.benchmark_map)
+    paths = self.benchmark_paths[:1000]
+    translated = [startswith_translate(path, self.benchmark_map)
+                  for path in paths]
+    self.assertEqual(translator.translate_many(paths), translated)
+    self.assertEqual([translator.translate(path) for path in paths],
+                     translated)
+
+  # Wall clock timings are too noisy for a shared test machine
+  @skipUnless(os.environ.get('TERRA_BENCHMARK', None) == "1",
+              "Set TERRA_BENCHMARK=1 to run benchmarks")
+  def test_benchmark(self):
+    start = time.perf_counter()
+    for path in self.benchmark_paths:
+      startswith_translate(path, self.benchmark_map)
+    startswith_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    translator = utils.VolumeTranslator(self.benchmark_map)
+    for path in self.benchmark_paths:
+      translator.translate(path)
+    translate_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    translator = utils.VolumeTranslator(self.benchmark_map)
+    translator.translate_many(self.benchmark_paths)
+    translate_many_time = time.perf_counter() - start
+
+    self.assertLess(translate_time, startswith_time)
+    self.assertLess(translate_many_time, startswith_time)
+
+
+def startswith_translate(value, volume_map):
+  # Paths translated the way they were before VolumeTranslator, trying every
+  # volume in turn
+  for vol_from, vol_to in volume_map:
+    if value.startswith(vol_from):
+      return value.replace(vol_from, vol_to, 1)
+  return value
+
+
+def pathlib_translate(value, volume_map, container_platform):
+  # Windows paths translated the way they were before WindowsVolumeTranslator,
+  # with one pathlib object per value and volume, and the deepest volume
+  # winning
+  value_path = pathlib.PureWindowsPath(ntpath.normpath(value))
+  match = None
+  for vol_from, vol_to in reversed(volume_map):
+    vol_from = pathlib.PureWindowsPath(ntpath.normpath(vol_from))
+    try:
+      remainder = value_path.relative_to(vol_from)
+    except ValueError:
+      continue
+    if match is None or len(vol_from.parts) > len(match[0].parts):
+      match = (vol_from, vol_to, remainder)
+  if match is None:
+    return value
+  if container_platform == "windows":
+    value = pathlib.PureWindowsPath(match[1])
+  else:
+    value = pathlib.PurePosixPath(match[1])
+  value /= match[2]
+  return str(value)
+
+
+class TestWindowsVolumeTranslator(TestComputeUtilsCase):
+  volume_map = [('C:\\data\\deep\\er', '/deeper'),
+                ('C:\\data', '/mnt/data'),
+                ('c:/Data/Inputs/', '/in'),
+                ('D:\\', '/d/'),
+                ('\\\\server\\share', '/share'),
+                ('c:\\data\\other', 'e:\\other')]
+  paths = ['C:\\data\\a.txt', 'c:/DATA/b/c.txt', 'C:\\data',
+           'C:\\data\\inputs\\x', 'C:/data/inputs', 'C:\\data2\\a',
+           'D:\\foo\\bar', 'D:\\', 'd:foo', '\\\\server\\share\\f.txt',
+           'c:\\data\\other\\y', 'c:\\data\\.\\z\\..\\w', 'relative\\path',
+           'C:\\DATA\\\u0130\\file', 'c:\\data\\deep\\er\\f',
+           'c:\\data\\deep\\f']
+
+  def test_same_as_pathlib(self):
+    for platform in ('linux', 'windows'):
+      translator = utils.WindowsVolumeTranslator(self.volume_map, platform)
+      for path in self.paths:
+        self.assertEqual(translator.translate(path),
+                         pathlib_translate(path, self.volume_map, platform),
+                         f'{path} to {platform}')
+
+  def test_translate(self):
+    translator = utils.WindowsVolumeTranslator(self.volume_map)
+    self.assertEqual(translator.translate('c:/DATA/b/c.txt'),
+                     '/mnt/data/b/c.txt')
+    self.assertEqual(translator.translate('C:\\data\\other\\y'),
+                     'e:\\other/y')
+    # The deepest volume wins, not the last
+    self.assertEqual(translator.translate('C:\\data\\deep\\er\\f'),
+                     '/deeper/f')
+    self.assertEqual(translator.translate('C:\\data\\deep\\f'),
+                     '/mnt/data/deep/f')
+    self.assertEqual(translator.translate('C:\\data2\\a'), 'C:\\data2\\a')
+    self.assertEqual(translator.translate_many(('D:\\foo', 15)),
+                     ('/d/foo', 15))
+
+    translator = utils.WindowsVolumeTranslator(self.volume_map, 'windows')
+    self.assertEqual(translator.translate('C:\\data\\other\\y'),
+                     'e:\\other\\y')
+
+  def test_compiled_once(self):
+    self.assertIs(utils.windows_volume_translator([['c:\\a', '/b']]),
+                  utils.windows_volume_translator((('c:\\a', '/b'),)))
+
+  # Runs on any OS, ntpath and PureWindowsPath don't need Windows
+  benchmark_map = [(f'C:\\projects\\project{i}', f'/projects/{i}')
+                   for i in range(50)]
+  benchmark_paths = [f'c:/projects/project{i % 60}/data/file{i}.tif'
+                     for i in range(500)]
+
+  def test_many_volumes(self):
+    translator = utils.WindowsVolumeTranslator(self.benchmark_map)
+    self.assertEqual(translator.translate_many(self.benchmark_paths),
+                     [pathlib_translate(path, self.benchmark_map, 'linux')
+                      for path in self.benchmark_paths])
+
+  # Wall clock timings are too noisy for a shared test machine
+  @skipUnless(os.environ.get('TERRA_BENCHMARK', None) == "1",
+              "Set TERRA_BENCHMARK=1 to run benchmarks")
+  def test_benchmark(self):
+    start = time.perf_counter()
+    for path in self.benchmark_paths:
+      pathlib_translate(path, self.benchmark_map, 'linux')
+    pathlib_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    translator = utils.WindowsVolumeTranslator(self.benchmark_map)
+    translator.translate_many(self.benchmark_paths)
+    translator_time = time.perf_counter() - start
+
+    self.assertLess(translator_time, pathlib_time)
@@ -1,5 +1,8 @@
+import asyncio
 import os
-from unittest import mock
+import sys
+import time
+from unittest import mock, skipUnless
 
 from terra import settings
 from terra.executor.utils import Executor
@@ -74,6 +77,23 @@ class TestVirtualEnv(TestSettingsUnconfiguredCase):
     self.assertEqual(set(self.popen_kwargs.keys()), {'env', 'executable'})
     self.assertEqual(self.popen_kwargs['env']['BAR'], 'FOO')
 
+  def test_run_staged(self):
+    compute = virtualenv.Compute()
+    settings.compute.staging = self.temp_dir.name
+    # Evaluated once, like the logger does
+    settings.terra.uuid
+    self.return_value = 0
+    service = MockVirtualEnvService()
+    compute.run(service)
+    settings_file = self.popen_kwargs['env']['TERRA_SETTINGS_FILE']
+    self.assertEqual(os.path.dirname(os.path.dirname(settings_file)),
+                     self.temp_dir.name)
+    # Kept for the next service with the same settings
+    self.assertTrue(os.path.exists(settings_file))
+    compute.run(MockVirtualEnvService())
+    self.assertEqual(self.popen_kwargs['env']['TERRA_SETTINGS_FILE'],
+                     settings_file)
+
   def test_run_virtualenv(self):
     compute = virtualenv.Compute()
     service = MockVirtualEnvService()
@@ -119,3 +139,151 @@ class TestVirtualEnv(TestSettingsUnconfiguredCase):
     # Added by TestSettingsUnconfiguredCase
     self.assertTrue(any(o.startswith('- TERRA_SETTINGS_FILE:')
                         for o in env_lines))
+
+
+@skipUnless(hasattr(os, 'fork'), 'Requires fork')
+class TestWarmInterpreter(TestSettingsUnconfiguredCase):
+  def setUp(self):
+    super().setUp()
+    self.interpreter = virtualenv.WarmInterpreter(sys.executable, ['json'])
+    self.addCleanup(self.interpreter.close)
+
+  def test_run(self):
+    output = os.path.join(self.temp_dir.name, 'out')
+    env = {'FOO': 'BAR', 'PATH': os.environ.get('PATH', '')}
+    code = ('import os, sys\n'
+            'with open(sys.argv[1], "w") as fid:\n'
+            '  fid.write(os.environ["FOO"] + os.getcwd() + str(os.getpid()))\n'
+            'sys.exit(3)')
+    self.assertEqual(self.interpreter.run(['-c', code, output], env,
+                                          self.temp_dir.name), 3)
+    with open(output, 'r') as fid:
+      result = fid.read()
+    self.assertTrue(result.startswith('BAR' + self.temp_dir.name))
+    # A process of its own
+    self.assertNotEqual(result, 'BAR' + self.temp_dir.name
+                        + str(self.interpreter.process.pid))
+
+  @skipUnless(hasattr(os, 'sched_setaffinity'), 'Linux only')
+  def test_resources(self):
+    cpu = sorted(os.sched_getaffinity(0))[0]
+    code = ('import os, resource, sys\n'
+            'sys.exit(os.sched_getaffinity(0) != {%d} or '
+            'resource.getrlimit(resource.RLIMIT_AS)[0] != 2**34)' % cpu)
+    self.assertEqual(self.interpreter.run(['-c', code], {},
+                                          self.temp_dir.name,
+                                          {'cpuset': [cpu],
+                                           'memory': 2**34}), 0)
+
+  def test_script(self):
+    script = os.path.join(self.temp_dir.name, 'script.py')
+    with open(script, 'w') as fid:
+      fid.write('import sys\n'
+                'raise SystemExit(int(sys.argv[1]) '
+                'if __name__ == "__main__" else 1)\n')
+    self.assertEqual(self.interpreter.run([script, '0'], {}, '/'), 0)
+    self.assertEqual(self.interpreter.run([script, '5'], {}, '/'), 5)
+
+  def test_module(self):
+    self.assertEqual(self.interpreter.run(['-m', 'json.tool', '--help'],
+                                          {}, self.temp_dir.name), 0)
+    self.assertEqual(self.interpreter.run(['-m', 'no_such_module'], {},
+                                          self.temp_dir.name), 1)
+
+  def test_concurrent(self):
+    from concurrent.futures import ThreadPoolExecutor
+    code = 'import time, sys; time.sleep(0.2); sys.exit(int(sys.argv[1]))'
+    with ThreadPoolExecutor(4) as executor:
+      futures = [executor.submit(self.interpreter.run, ['-c', code, str(x)],
+                                 {}, '/') for x in range(4)]
+    self.assertEqual([future.result() for future in futures], [0, 1, 2, 3])
+
+
+@skipUnless(hasattr(os, 'fork'), 'Requires fork')
+class TestVirtualEnvPool(TestSettingsUnconfiguredCase):
+  def setUp(self):
+    self.patches.append(mock.patch.dict(Executor.__dict__))
+    self.patches.append(mock.patch.object(base, 'atexit'))
+    super().setUp()
+    settings.configure({
+        'compute': {'arch': 'virtualenv',
+                    'virtualenv_dir': None,
+                    'pool': True},
+        'processing_dir': self.temp_dir.name})
+
+  def test_warmable(self):
+    self.assertTrue(virtualenv.Compute.warmable(['python', '-m', 'foo']))
+    self.assertTrue(virtualenv.Compute.warmable(['python3', 'foo.py']))
+    self.assertFalse(virtualenv.Compute.warmable(['python', '-u', 'foo.py']))
+    self.assertFalse(virtualenv.Compute.warmable(['ls', '-l']))
+
+  def test_run(self):
+    compute = virtualenv.Compute()
+    self.addCleanup(compute.close)
+    self.assertTrue(compute.pooled)
+
+    output = os.path.join(self.temp_dir.name, 'out')
+    service = MockVirtualEnvService()
+    service.command = [sys.executable, '-c',
+                       'import os; open(os.environ["OUTPUT"], "a").write('
+                       'os.environ["TERRA_SETTINGS_FILE"] + "\\n")']
+    service.env['OUTPUT'] = output
+    compute.run(service)
+    compute.run(service)
+
+    # The same interpreter, with the settings file of each run
+    self.assertEqual(len(compute._pool), 1)
+    with open(output, 'r') as fid:
+      settings_files = fid.read().split()
+    self.assertEqual(len(settings_files), 2)
+    self.assertNotEqual(settings_files[0], settings_files[1])
+
+    service.command[1:] = ['-c', 'raise ValueError()']
+    with self.assertRaises(base.ServiceRunFailed):
+      compute.run(service)
+
+  def test_arun(self):
+    compute = virtualenv.Compute()
+    self.addCleanup(compute.close)
+    service = MockVirtualEnvService()
+    service.command = [sys.executable, '-c', 'import time; time.sleep(0.2)']
+
+    async def run_all():
+      await asyncio.gather(*[compute.arun(service) for _ in range(4)])
+
+    start = time.time()
+    asyncio.run(run_all())
+    self.assertLess(time.time() - start, 0.6)
+
+    service.command[1:] = ['-c', 'raise SystemExit(4)']
+    with self.assertRaisesRegex(base.ServiceRunFailed, 'return code 4'):
+      asyncio.run(compute.arun(service))
+
+
+class TestVirtualEnvAsync(TestSettingsUnconfiguredCase):
+  def setUp(self):
+    self.patches.append(mock.patch.dict(Executor.__dict__))
+    super().setUp()
+    settings.configure({
+        'compute': {'arch': 'virtualenv',
+                    'virtualenv_dir': None,
+                    'capture_output': True},
+        'processing_dir': self.temp_dir.name})
+
+  def test_arun(self):
+    compute = virtualenv.Compute()
+    service = MockVirtualEnvService()
+    service.command = [sys.executable, '-c',
+                       'import os; print(os.environ["BAR"])']
+    with self.assertLogs(terra.compute.utils.__name__, level='INFO') as log:
+      asyncio.run(compute.arun(service))
+    self.assertIn('INFO:terra.compute.utils:MockVirtualEnvService stdout: '
+                  'FOO', log.output)
+    # post_run cleaned up
+    self.assertFalse(os.path.exists(service.temp_dir.name))
+
+    service.command[1:] = ['-c', 'print("bad"); raise SystemExit(3)']
+    with self.assertLogs(terra.compute.utils.__name__, level='INFO'), \
+        self.assertRaisesRegex(base.ServiceRunFailed,
+                               'return code 3. Last output:\nstdout: bad'):
+      asyncio.run(compute.arun(service))
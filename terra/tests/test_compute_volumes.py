@@ -0,0 +1,82 @@
+import ntpath
+import os
+from unittest import skipIf
+
+from terra.compute.volumes import VolumeSet, VolumeSlots, missing_paths
+
+from .utils import TestCase
+
+
+@skipIf(os.name != "posix", "Requires Linux")
+class TestVolumeSet(TestCase):
+  def test_duplicates(self):
+    volumes = VolumeSet()
+    self.assertTrue(volumes.add('/data', '/data'))
+    self.assertFalse(volumes.add('/data/', '/data//'))
+    self.assertTrue(volumes.add('/data', '/data', 'ro'))
+    self.assertEqual(len(volumes), 2)
+    self.assertIn(('/data', '/data/', None), volumes)
+    self.assertEqual(list(volumes), [('/data', '/data', None),
+                                     ('/data', '/data', 'ro')])
+
+  def test_children(self):
+    volumes = VolumeSet([('/data/images/1.tif', '/in/images/1.tif'),
+                         ('/data', '/in'),
+                         ('/data/images/2.tif', '/in/images/2.tif', 'ro'),
+                         ('/other/3.tif', '/in/images/3.tif'),
+                         ('/data/x', '/out/x'),
+                         ('/', '/host')])
+    self.assertEqual(volumes.mounts(),
+                     [('/data', '/in', None),
+                      ('/data/images/2.tif', '/in/images/2.tif', 'ro'),
+                      ('/other/3.tif', '/in/images/3.tif', None),
+                      ('/data/x', '/out/x', None),
+                      ('/', '/host', None)])
+
+  def test_nearest_parent(self):
+    # /in/a is not /data/a in the container, so /in/a/b is still needed
+    volumes = VolumeSet([('/data', '/in'),
+                         ('/other', '/in/a'),
+                         ('/data/a/b', '/in/a/b'),
+                         ('/other/c', '/in/a/c')])
+    self.assertEqual([volume[0] for volume in volumes.mounts()],
+                     ['/data', '/other', '/data/a/b'])
+
+  def test_ambiguous_parent(self):
+    volumes = VolumeSet([('/data', '/in'), ('/more', '/in'),
+                         ('/data/a', '/in/a')])
+    self.assertEqual(len(volumes.mounts()), 3)
+
+  def test_windows_remote(self):
+    volumes = VolumeSet([('/data', 'c:\\in'), ('/data/a', 'c:\\in\\a')],
+                        remote_path=ntpath)
+    self.assertEqual(volumes.mounts(), [('/data', 'c:\\in', None)])
+
+  def test_many(self):
+    volumes = VolumeSet([('/data', '/data')]
+                        + [(f'/data/{i}', f'/data/{i}') for i in range(5000)]
+                        + [(f'/data/{i}', f'/data/{i}') for i in range(5000)])
+    self.assertEqual(len(volumes), 5001)
+    self.assertEqual(volumes.mounts(), [('/data', '/data', None)])
+
+
+class TestVolumeSlots(TestCase):
+  def test_assign(self):
+    env = {'TERRA_VOLUME_1': '/a:/a', 'TERRA_VOLUME_3': '/c:/c',
+           'TERRA_VOLUME_X': 'other'}
+    slots = VolumeSlots(env, 'TERRA')
+    self.assertEqual(slots.assign('/b:/b'), 'TERRA_VOLUME_2')
+    self.assertEqual(slots.assign('/d:/d'), 'TERRA_VOLUME_4')
+    self.assertEqual(env['TERRA_VOLUME_3'], '/c:/c')
+    self.assertEqual(env['TERRA_VOLUME_4'], '/d:/d')
+
+
+class TestMissingPaths(TestCase):
+  def test_missing(self):
+    filename = os.path.join(self.temp_dir.name, 'file')
+    open(filename, 'w').close()
+    paths = [filename, self.temp_dir.name]
+    self.assertEqual(missing_paths(paths), [])
+
+    missing = [f'{filename}_{i}' for i in range(20)]
+    self.assertEqual(missing_paths(paths + missing), missing)
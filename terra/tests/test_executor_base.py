@@ -0,0 +1,117 @@
+import time
+from concurrent.futures import CancelledError
+
+from terra import settings
+from terra.executor.base import BaseFuture, _find_futures
+from terra.executor.sync import SyncExecutor
+from terra.executor.thread import ThreadPoolExecutor
+from .utils import (
+  TestCase, TestThreadPoolExecutorCase, TestSettingsUnconfiguredCase
+)
+
+
+def square(x):
+  return x * x
+
+
+def slow_square(x):
+  time.sleep(0.01)
+  return x * x
+
+
+def add(x, y=0):
+  return x + y
+
+
+def fail():
+  raise TypeError('foobar')
+
+
+class TestFindFutures(TestCase):
+  def test_find(self):
+    futures = [BaseFuture() for _ in range(3)]
+    self.assertEqual(_find_futures((futures[1], [futures[0], futures[1], 1]),
+                                   {'x': {'a': futures[2], 'b': futures[0]}}),
+                     [futures[1], futures[0], futures[2]])
+
+  def test_many(self):
+    futures = [BaseFuture() for _ in range(20000)]
+    self.assertEqual(_find_futures((futures, futures), {}), futures)
+
+
+class TestDependentSync(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.executor = SyncExecutor()
+
+  def test_future_arg(self):
+    future = self.executor.submit(square, self.executor.submit(square, 3))
+    self.assertEqual(future.result(), 81)
+
+  def test_future_kwarg(self):
+    future = self.executor.submit(add, 1, y=self.executor.submit(square, 3))
+    self.assertEqual(future.result(), 10)
+
+  def test_future_list(self):
+    futures = [self.executor.submit(square, x) for x in range(4)]
+    self.assertEqual(self.executor.submit(sum, futures).result(), 14)
+
+  def test_future_dict(self):
+    future = self.executor.submit(
+        lambda d: d['a'] + d['b'],
+        {'a': self.executor.submit(square, 2), 'b': 1})
+    self.assertEqual(future.result(), 5)
+
+  def test_pending_input(self):
+    pending = BaseFuture()
+    future = self.executor.submit(square, pending)
+    self.assertFalse(future.done())
+    pending.set_result(5)
+    self.assertEqual(future.result(), 25)
+
+  def test_failed_input(self):
+    called = []
+    future = self.executor.submit(called.append,
+                                  self.executor.submit(fail))
+    with self.assertRaisesRegex(TypeError, 'foobar'):
+      future.result()
+    self.assertEqual(called, [])
+
+  def test_cancelled_input(self):
+    pending = BaseFuture()
+    future = self.executor.submit(square, pending)
+    pending.cancel()
+    with self.assertRaises(CancelledError):
+      future.result()
+
+  def test_shutdown(self):
+    pending = BaseFuture()
+    future = self.executor.submit(square, pending)
+    pending.set_result(4)
+    self.executor.shutdown()
+    self.assertEqual(future.result(), 16)
+    self.assertFalse(self.executor._dependent_futures)
+
+
+class TestDependentThread(TestThreadPoolExecutorCase,
+                          TestSettingsUnconfiguredCase):
+  def setUp(self):
+    super().setUp()
+    settings.configure({'processing_dir': self.temp_dir.name})
+
+  def test_map_reduce(self):
+    with ThreadPoolExecutor(max_workers=4) as executor:
+      mapped = [executor.submit(slow_square, x) for x in range(8)]
+      reduced = executor.submit(sum, mapped)
+      # Submitted before reduced is done, and dispatched during shutdown
+      final = executor.submit(add, reduced, y=1)
+    self.assertEqual(reduced.result(), 140)
+    self.assertEqual(final.result(), 141)
+
+  def test_diamond(self):
+    with ThreadPoolExecutor(max_workers=4) as executor:
+      top = executor.submit(slow_square, 2)
+      left = executor.submit(slow_square, top)
+      right = executor.submit(add, top, 1)
+      bottom = executor.submit(add, left, y=right)
+    self.assertEqual(bottom.result(), 21)
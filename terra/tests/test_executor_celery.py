@@ -199,6 +199,109 @@ class TestCeleryExecutor(TestCase):
     with self.assertRaisesRegex(RuntimeError, "cannot .* after shutdown"):
       self.executor.submit(test)
 
+
+class StateAsyncResult:
+  # An AsyncResult whose state the test sets, like the workers would
+  def __init__(self, index):
+    self.id = index
+    self.index = index
+    self.state = 'PENDING'
+    self.revoked = False
+
+  def ready(self):
+    return self.state in ('SUCCESS', 'FAILURE', 'REVOKED')
+
+  def revoke(self, terminate=False):
+    self.revoked = True
+
+  def get(self, *args, **kwargs):
+    return self.index
+
+  def forget(self):
+    pass
+
+
+class TestCeleryStateCase(TestCase):
+  executor_kwargs = {}
+
+  def setUp(self):
+    super().setUp()
+    from terra.executor.celery import CeleryExecutor
+    self.results = []
+
+    def task():
+      pass
+
+    def apply_async(args, kwargs):
+      self.results.append(StateAsyncResult(len(self.results)))
+      return self.results[-1]
+    task.apply_async = apply_async
+
+    self.task = task
+    self.executor = CeleryExecutor(update_delay=0.001,
+                                   **self.executor_kwargs)
+
+  def tearDown(self):
+    for result in self.results:
+      if not result.ready():
+        result.state = 'SUCCESS'
+    self.executor.shutdown()
+    super().tearDown()
+
+
+@skipUnless(celery, "Celery not installed")
+class TestCeleryMetrics(TestCeleryStateCase):
+  def test_start(self):
+    future = self.executor.submit(self.task)
+    time.sleep(0.05)
+    self.results[0].state = 'STARTED'
+    for x in range(100):
+      if future.running():
+        break
+      time.sleep(0.01)
+    time.sleep(0.05)
+    self.results[0].state = 'SUCCESS'
+    future.result(timeout=1)
+
+    # The start is when the worker reported STARTED
+    snapshot = self.executor.metrics.snapshot()
+    self.assertEqual(snapshot['started'], 1)
+    self.assertGreaterEqual(snapshot['queue_wait']['min'], 0.04)
+    self.assertGreaterEqual(snapshot['run_time']['min'], 0.04)
+
+
+@skipUnless(celery, "Celery not installed")
+class TestCelerySpeculative(TestCeleryStateCase):
+  executor_kwargs = {'speculative': {'fraction': 0.5, 'multiplier': 3,
+                                     'interval': 0.01}}
+
+  def test_track_started(self):
+    import terra.executor.celery
+    self.assertTrue(terra.executor.celery.app.conf.task_track_started)
+
+  def test_straggler(self):
+    futures = [self.executor.submit(self.task) for _ in range(4)]
+    # Celery reports STARTED, never RUNNING
+    for result in self.results:
+      result.state = 'STARTED'
+    time.sleep(0.02)
+    for result in self.results[:3]:
+      result.state = 'SUCCESS'
+    for future in futures[:3]:
+      future.result(timeout=1)
+
+    # The straggler keeps running, until it is speculated
+    for x in range(200):
+      time.sleep(0.01)
+      if len(self.results) > 4:
+        break
+    else:
+      raise TimeoutError('The straggler was never speculated')
+    self.results[4].state = 'SUCCESS'
+    self.assertEqual(futures[3].result(timeout=1), 4)
+    self.assertEqual(self.executor._speculator.speculative_wins, 1)
+
+
 #   def test_import(self):
 #     import terra.executor.celery
 #     from celery._state import _apps
@@ -0,0 +1,107 @@
+import time
+from concurrent.futures import ThreadPoolExecutor as PlainThreadPoolExecutor
+
+from terra import settings
+from terra.executor.chunked import AdaptiveChunker, adaptive_map
+from terra.executor.sync import SyncExecutor
+from terra.executor.thread import ThreadPoolExecutor
+from .utils import (
+  TestCase, TestThreadPoolExecutorCase, TestSettingsUnconfiguredCase
+)
+
+
+def square(x):
+  return x * x
+
+
+def fail_on_five(x):
+  if x == 5:
+    raise TypeError('foobar')
+  return x
+
+
+def sleep_reverse(x):
+  time.sleep(0.01 * (4 - x))
+  return x
+
+
+class TestAdaptiveChunker(TestCase):
+  def test_slow_start(self):
+    chunker = AdaptiveChunker(2, target_duration=1)
+    self.assertEqual(chunker.next_size(1000), 1)
+    chunker.record(1, 0.001)
+    self.assertEqual(chunker.next_size(1000), 2)
+    self.assertEqual(chunker.next_size(1000), 4)
+    chunker.record(4, 0.004)
+    sizes = [chunker.next_size(100000) for _ in range(20)]
+    # Doubles until the target duration
+    self.assertEqual(sizes[:3], [8, 16, 32])
+    self.assertEqual(sizes[-1], 1000)
+
+  def test_expensive(self):
+    chunker = AdaptiveChunker(2, target_duration=1)
+    chunker.record(1, 5)
+    self.assertEqual(chunker.next_size(1000), 1)
+
+  def test_tail(self):
+    chunker = AdaptiveChunker(4, target_duration=1)
+    chunker.size = 1000
+    chunker.record(1, 0.0001)
+    self.assertEqual(chunker.next_size(80), 10)
+    self.assertEqual(chunker.next_size(3), 1)
+
+  def test_fixed(self):
+    chunker = AdaptiveChunker(4, chunksize=7)
+    chunker.record(1, 0.0001)
+    self.assertEqual(chunker.next_size(100), 7)
+    self.assertEqual(chunker.next_size(3), 3)
+
+  def test_max_chunksize(self):
+    chunker = AdaptiveChunker(1, max_chunksize=3)
+    chunker.record(1, 0)
+    for _ in range(5):
+      size = chunker.next_size(1000)
+    self.assertEqual(size, 3)
+
+
+class TestAdaptiveMap(TestCase):
+  def test_sync(self):
+    executor = SyncExecutor()
+    self.assertEqual(list(adaptive_map(executor, square, range(100))),
+                     [x * x for x in range(100)])
+    self.assertEqual(list(adaptive_map(executor, pow, range(5), range(5))),
+                     [x ** x for x in range(5)])
+    self.assertEqual(list(adaptive_map(executor, square, [])), [])
+
+  def test_exception(self):
+    with PlainThreadPoolExecutor(2) as executor:
+      results = adaptive_map(executor, fail_on_five, range(20))
+      self.assertEqual([next(results) for _ in range(5)], list(range(5)))
+      with self.assertRaisesRegex(TypeError, 'foobar'):
+        next(results)
+
+  def test_unordered(self):
+    with PlainThreadPoolExecutor(4) as executor:
+      results = list(adaptive_map(executor, sleep_reverse, range(4),
+                                  ordered=False))
+    self.assertEqual(sorted(results), list(range(4)))
+    self.assertEqual(results[0], 3)
+
+  def test_ordered(self):
+    with PlainThreadPoolExecutor(4) as executor:
+      results = list(adaptive_map(executor, sleep_reverse, range(4)))
+    self.assertEqual(results, list(range(4)))
+
+
+class TestThreadMap(TestThreadPoolExecutorCase, TestSettingsUnconfiguredCase):
+  def setUp(self):
+    super().setUp()
+    settings.configure({'processing_dir': self.temp_dir.name})
+
+  def test_map(self):
+    with ThreadPoolExecutor(max_workers=4) as executor:
+      results = executor.map(square, range(1000))
+    # Shutting down waits for the whole map, like a normal map
+    self.assertEqual(list(results), [x * x for x in range(1000)])
+    # Fewer tasks than items were run
+    self.assertLess(executor.metrics.finished, 1000)
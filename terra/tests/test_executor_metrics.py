@@ -0,0 +1,128 @@
+import os
+import csv
+import json
+
+from terra.executor import metrics
+from terra.executor.base import BaseFuture
+from terra.executor.sync import SyncExecutor
+from .utils import TestCase
+
+
+def _task1(x):
+  return 11 + x
+
+
+def _task2(x):
+  raise TypeError('foobar')
+
+
+class TestHistogram(TestCase):
+  def test_empty(self):
+    histogram = metrics.Histogram()
+    self.assertIsNone(histogram.percentile(50))
+    self.assertIsNone(histogram.mean)
+    self.assertEqual(histogram.to_dict()['count'], 0)
+
+  def test_percentiles(self):
+    histogram = metrics.Histogram()
+    for x in range(1, 1001):
+      histogram.record(x / 1000)
+
+    self.assertEqual(histogram.count, 1000)
+    self.assertAlmostEqual(histogram.mean, 0.5005)
+    self.assertEqual(histogram.min, 0.001)
+    self.assertEqual(histogram.max, 1)
+    # Within the 2**-7 relative precision
+    for percent in (10, 50, 90, 99):
+      self.assertAlmostEqual(histogram.percentile(percent), percent / 100,
+                             delta=percent / 100 / 2**7 + 0.001)
+    self.assertEqual(histogram.percentile(100), 1)
+
+  def test_bounded_buckets(self):
+    histogram = metrics.Histogram()
+    for x in range(100000):
+      histogram.record(x / 1000)
+    # Log-linear, not one bucket per value
+    self.assertLess(len(histogram.buckets), 2**7 * 27)
+
+
+class TestExecutorMetrics(TestCase):
+  def test_track(self):
+    executor_metrics = metrics.ExecutorMetrics('test')
+    futures = [executor_metrics.track(BaseFuture(), _task1) for _ in range(4)]
+    self.assertEqual(executor_metrics.in_flight, 4)
+    self.assertEqual(executor_metrics.queued, 4)
+
+    futures[0].set_running_or_notify_cancel()
+    futures[1].set_running_or_notify_cancel()
+    self.assertEqual(executor_metrics.running, 2)
+    self.assertEqual(executor_metrics.queued, 2)
+
+    futures[0].set_result(1)
+    futures[1].set_exception(TypeError())
+    futures[2].cancel()
+    snapshot = executor_metrics.snapshot()
+    self.assertEqual(snapshot['finished'], 1)
+    self.assertEqual(snapshot['failed'], 1)
+    self.assertEqual(snapshot['cancelled'], 1)
+    self.assertEqual(snapshot['in_flight'], 1)
+    self.assertEqual(snapshot['running'], 0)
+    self.assertEqual(snapshot['run_time']['count'], 2)
+    self.assertGreater(snapshot['throughput'], 0)
+    self.assertIn('4 submitted, 1 in flight', executor_metrics.summary())
+    self.assertIn('tasks/s', executor_metrics.summary())
+
+  def test_throughput(self):
+    executor_metrics = metrics.ExecutorMetrics('test')
+    self.assertIsNone(executor_metrics.throughput)
+    futures = [executor_metrics.track(BaseFuture(), _task1) for _ in range(3)]
+    executor_metrics._first_submit -= 2
+    for future in futures[:2]:
+      future.set_result(None)
+    futures[2].cancel()
+    # Cancelled tasks did no work
+    self.assertAlmostEqual(executor_metrics.throughput, 1, delta=0.05)
+
+  def test_jsonl(self):
+    executor_metrics = metrics.ExecutorMetrics(
+        'test', file_format='jsonl', processing_dir=self.temp_dir.name)
+    future = executor_metrics.track(BaseFuture(), _task1)
+    future.set_running_or_notify_cancel()
+    future.set_result(None)
+    executor_metrics.shutdown()
+
+    with open(os.path.join(self.temp_dir.name,
+                           'executor_metrics.jsonl'), 'r') as fid:
+      records = [json.loads(line) for line in fid]
+    self.assertEqual(len(records), 1)
+    self.assertEqual(records[0]['name'], '_task1')
+    self.assertEqual(records[0]['status'], 'done')
+    self.assertLessEqual(records[0]['submit'], records[0]['start'])
+
+  def test_csv(self):
+    executor_metrics = metrics.ExecutorMetrics(
+        'test', file_format='csv', processing_dir=self.temp_dir.name)
+    for _ in range(2):
+      executor_metrics.track(BaseFuture(), _task1).cancel()
+    executor_metrics.shutdown()
+
+    with open(os.path.join(self.temp_dir.name,
+                           'executor_metrics.csv'), 'r') as fid:
+      records = list(csv.DictReader(fid))
+    self.assertEqual([r['status'] for r in records],
+                     ['cancelled', 'cancelled'])
+
+
+class TestSyncExecutorMetrics(TestCase):
+  def test_sync(self):
+    executor = SyncExecutor()
+    executor.submit(_task1, 1)
+    executor.submit(_task2, 1)
+    self.assertEqual(executor.metrics.finished, 1)
+    self.assertEqual(executor.metrics.failed, 1)
+    self.assertEqual(executor.metrics.started, 2)
+    self.assertEqual(executor.metrics.in_flight, 0)
+
+    with self.assertLogs(metrics.__name__, level='INFO') as cm:
+      executor.shutdown()
+    self.assertIn('SyncExecutor: 2 submitted', str(cm.output))
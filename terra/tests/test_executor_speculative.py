@@ -0,0 +1,142 @@
+from unittest import mock
+
+from terra.executor import speculative
+from terra.executor.base import BaseFuture
+from .utils import TestCase
+
+
+class TestSpeculator(TestCase):
+  def setUp(self):
+    self.now = 0
+    self.patches.append(mock.patch.object(
+        speculative, 'time', mock.Mock(monotonic=lambda: self.now)))
+    super().setUp()
+    self.attempts = []
+    self.revoked = []
+    # A large interval, so that only the manual checks run
+    self.speculator = speculative.Speculator(
+        self.submit, self.revoked.append, fraction=0.5, multiplier=2,
+        interval=1000)
+
+  def tearDown(self):
+    self.speculator.shutdown()
+    super().tearDown()
+
+  def submit(self, fn, *args, **kwargs):
+    future = BaseFuture()
+    future.set_running_or_notify_cancel()
+    self.attempts.append((future, args))
+    return future
+
+  def submit_batch(self, count):
+    futures = [self.speculator.submit(str, x) for x in range(count)]
+    # Let the check see every attempt as running
+    self.speculator.check()
+    return futures
+
+  def test_no_speculation_before_fraction(self):
+    self.submit_batch(4)
+    self.now = 1
+    self.attempts[0][0].set_result('0')
+    self.now = 100
+    self.assertEqual(self.speculator.check(), 0)
+    self.assertEqual(len(self.attempts), 4)
+
+  def test_speculate_straggler(self):
+    futures = self.submit_batch(4)
+    self.now = 1
+    for attempt, _ in self.attempts[:3]:
+      attempt.set_result('x')
+
+    # Not slow enough yet
+    self.now = 2
+    self.assertEqual(self.speculator.check(), 0)
+
+    self.now = 3.5
+    self.assertEqual(self.speculator.check(), 1)
+    self.assertEqual(len(self.attempts), 5)
+    self.assertEqual(self.attempts[4][1], (3,))
+    # Never speculate twice
+    self.now = 100
+    self.assertEqual(self.speculator.check(), 0)
+
+    # The copy wins, the original is revoked
+    self.attempts[4][0].set_result('copy')
+    self.assertEqual(futures[3].result(), 'copy')
+    self.assertEqual(self.revoked, [self.attempts[3][0]])
+    self.assertEqual(self.speculator.speculated, 1)
+    self.assertEqual(self.speculator.speculative_wins, 1)
+
+  def test_new_batch(self):
+    self.submit_batch(4)
+    self.now = 1
+    for attempt, _ in self.attempts:
+      attempt.set_result('x')
+
+    # Idle, so the fraction is of the new batch only
+    self.submit_batch(4)
+    self.now = 100
+    self.assertEqual(self.speculator.check(), 0)
+    self.attempts[4][0].set_result('x')
+    self.attempts[5][0].set_result('x')
+    self.assertEqual(self.speculator.check(), 2)
+
+  def test_window(self):
+    speculator = speculative.Speculator(self.submit, window=3, interval=1000)
+    self.addCleanup(speculator.shutdown)
+    for x in range(10):
+      speculator.submit(str, x)
+    for attempt, _ in self.attempts:
+      attempt.set_result('x')
+    self.assertEqual(len(speculator._durations), 3)
+
+  def test_original_wins(self):
+    futures = self.submit_batch(2)
+    self.now = 1
+    self.attempts[0][0].set_result('x')
+    self.now = 10
+    self.assertEqual(self.speculator.check(), 1)
+
+    self.attempts[1][0].set_result('original')
+    self.assertEqual(futures[1].result(), 'original')
+    self.assertEqual(self.revoked, [self.attempts[2][0]])
+    self.assertEqual(self.speculator.speculative_wins, 0)
+
+  def test_failure_waits_for_copy(self):
+    futures = self.submit_batch(2)
+    self.now = 1
+    self.attempts[0][0].set_result('x')
+    self.now = 10
+    self.speculator.check()
+
+    self.attempts[1][0].set_exception(TypeError('foobar'))
+    self.assertFalse(futures[1].done())
+    self.attempts[2][0].set_exception(TypeError('foobar'))
+    with self.assertRaisesRegex(TypeError, 'foobar'):
+      futures[1].result()
+
+  def test_cancel(self):
+    futures = self.submit_batch(1)
+    self.assertTrue(futures[0].cancel())
+    self.assertEqual(self.revoked, [self.attempts[0][0]])
+
+  def test_report(self):
+    self.submit_batch(1)
+    self.attempts[0][0].set_result('0')
+    with self.assertLogs(speculative.__name__, level='INFO') as cm:
+      self.speculator.shutdown()
+    self.assertIn('fired for 0 of 1 tasks', str(cm.output))
+
+
+class TestSpeculatorOptions(TestCase):
+  def test_disabled(self):
+    self.assertIsNone(speculative.Speculator.from_options(False, None))
+    self.assertIsNone(speculative.Speculator.from_options(
+        {'enabled': False}, None))
+
+  def test_enabled(self):
+    speculator = speculative.Speculator.from_options(True, None)
+    self.assertEqual(speculator.multiplier, 3)
+    speculator = speculative.Speculator.from_options(
+        {'enabled': True, 'multiplier': 5}, None)
+    self.assertEqual(speculator.multiplier, 5)
@@ -0,0 +1,184 @@
+import os
+import sys
+import socket
+import subprocess
+import threading
+from multiprocessing import AuthenticationError
+from unittest import mock
+
+from terra import settings
+from terra.executor.tcp.executor import (
+  TCPExecutor, send_message, recv_message, authenticate
+)
+from .utils import TestCase, TestSettingsUnconfiguredCase
+
+
+def square(x):
+  return x * x
+
+
+def fail():
+  raise TypeError('foobar')
+
+
+def where(input_file):
+  return {'seen': input_file, 'output_file': input_file}
+
+
+class TestFraming(TestCase):
+  def test_round_trip(self):
+    a, b = socket.socketpair()
+    with a, b:
+      send_message(a, {'type': 'hello', 'data': b'\0' * 100000})
+      send_message(a, [1, 2, 3])
+      self.assertEqual(recv_message(b),
+                       {'type': 'hello', 'data': b'\0' * 100000})
+      self.assertEqual(recv_message(b), [1, 2, 3])
+
+  def test_closed(self):
+    a, b = socket.socketpair()
+    with b:
+      a.close()
+      self.assertIsNone(recv_message(b))
+
+
+class TestAuthenticate(TestCase):
+  def handshake(self, executor_key, worker_key):
+    a, b = socket.socketpair()
+    errors = {}
+
+    def worker():
+      try:
+        authenticate(b, worker_key, server_side=False)
+      except (AuthenticationError, OSError) as e:
+        errors['worker'] = e
+      finally:
+        b.close()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    with a:
+      try:
+        authenticate(a, executor_key, server_side=True)
+      except AuthenticationError as e:
+        errors['executor'] = e
+    thread.join()
+    return errors
+
+  def test_same_key(self):
+    self.assertEqual(self.handshake(b'secret', b'secret'), {})
+
+  def test_wrong_key(self):
+    errors = self.handshake(b'secret', b'guess')
+    self.assertIsInstance(errors['executor'], AuthenticationError)
+    self.assertIsInstance(errors['worker'], AuthenticationError)
+
+  def test_no_key(self):
+    with self.assertRaisesRegex(ValueError, 'authkey'):
+      TCPExecutor(hostname='localhost', port=0)
+
+
+class TestScheduling(TestSettingsUnconfiguredCase):
+  def setUp(self):
+    super().setUp()
+    self.executor = TCPExecutor(hostname='localhost', port=0,
+                                authkey='secret')
+
+  def tearDown(self):
+    self.executor.shutdown(wait=False)
+    super().tearDown()
+
+  def test_central_queue(self):
+    self.executor._add_worker()
+    self.executor._add_worker()
+    futures = [self.executor.submit(square, x) for x in range(3)]
+
+    # Every connection pulls the oldest task
+    first = self.executor._next_task()
+    second = self.executor._next_task()
+    self.assertEqual([first.id, second.id], [0, 1])
+    self.assertTrue(futures[0].running())
+    self.assertTrue(futures[1].running())
+    self.assertFalse(futures[2].running())
+
+  def test_lost_worker(self):
+    self.executor._add_worker()
+    self.executor.submit(square, 1)
+    self.executor.submit(square, 2)
+    running = self.executor._next_task()
+    self.executor._remove_worker(running)
+    self.assertEqual(self.executor.workers, 0)
+
+    # The running task is next, before the queued one
+    self.executor._add_worker()
+    self.assertIs(self.executor._next_task(), running)
+    self.assertEqual(self.executor._next_task().id, 1)
+
+  def test_cancelled(self):
+    self.executor._add_worker()
+    future = self.executor.submit(square, 1)
+    self.executor.submit(square, 2)
+    self.assertTrue(future.cancel())
+    self.assertEqual(self.executor._next_task().id, 1)
+
+  def test_rejected(self):
+    with mock.patch('pickle.loads') as loads, \
+         socket.create_connection(self.executor.address) as sock:
+      # A hello without the handshake is never unpickled
+      send_message(sock, {'type': 'hello'})
+      sock.settimeout(10)
+      while sock.recv(1024):
+        pass
+    loads.assert_not_called()
+    self.assertEqual(self.executor.workers, 0)
+
+
+class TestTCPExecutor(TestSettingsUnconfiguredCase):
+  def start_workers(self, address, processes=1):
+    env = os.environ.copy()
+    env.pop('TERRA_SETTINGS_FILE', None)
+    env['TERRA_TCP_AUTHKEY'] = 'secret'
+    # The worker is a real process, with a real logger
+    env.pop('TERRA_UNITTEST', None)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.dirname(__file__)))]
+        + sys.path)
+    worker = subprocess.Popen(
+        [sys.executable, '-m', 'terra.executor.tcp', '--once',
+         '--hostname', address[0], '--port', str(address[1]),
+         '--processes', str(processes)],
+        cwd=self.temp_dir.name, env=env)
+    self.addCleanup(worker.kill)
+    return worker
+
+  def test_workers(self):
+    executor = TCPExecutor(hostname='localhost', port=0, authkey='secret')
+    # Submitted before any worker is connected
+    futures = [executor.submit(square, x) for x in range(20)]
+    workers = [self.start_workers(executor.address, 2),
+               self.start_workers(executor.address)]
+    error = executor.submit(fail)
+    self.assertEqual([future.result(timeout=60) for future in futures],
+                     [x * x for x in range(20)])
+    with self.assertRaisesRegex(TypeError, 'foobar'):
+      error.result(timeout=60)
+    executor.shutdown()
+
+    for worker in workers:
+      self.assertEqual(worker.wait(timeout=60), 0)
+    self.assertEqual(executor.metrics.finished, 20)
+    self.assertEqual(executor.metrics.failed, 1)
+
+  def test_settings(self):
+    settings.configure({'processing_dir': self.temp_dir.name,
+                        'executor': {'volume_map': [['/foo', '/bar']],
+                                     'tcp': {'authkey': 'secret'}}})
+    executor = TCPExecutor(hostname='localhost', port=0)
+    worker = self.start_workers(executor.address)
+    result = executor.submit(where, input_file='/foo/data').result(timeout=60)
+    executor.shutdown()
+    self.assertEqual(worker.wait(timeout=60), 0)
+
+    # Translated for the worker, and back for the runner
+    self.assertEqual(result['seen'], '/bar/data')
+    self.assertEqual(result['output_file'], '/foo/data')
@@ -57,6 +57,11 @@ class TestExecutorHandler(TestExecutorCase, TestSettingsUnconfiguredCase):
     self.assertIsInstance(Executor._connection(),
                           terra.executor.celery.CeleryExecutor)
 
+  def test_executor_name_tcp(self):
+    import terra.executor.tcp
+    settings.configure({'executor': {'type': 'TCPExecutor'}})
+    self.assertIs(Executor._connection, terra.executor.tcp.TCPExecutor)
+
   def test_executor_name_by_name(self):
     settings.configure(
         {'executor': {'type': 'concurrent.futures.ProcessPoolExecutor'}})
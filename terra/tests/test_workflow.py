@@ -0,0 +1,190 @@
+import time
+import threading
+from unittest import mock
+
+from terra import settings
+from terra.compute import base
+from terra.workflow import PipelineWorkflow, DagWorkflow, depends_on
+import terra.compute.utils
+from .utils import TestThreadPoolExecutorCase, TestSettingsUnconfiguredCase
+
+
+class TestWorkflowCase(TestThreadPoolExecutorCase,
+                       TestSettingsUnconfiguredCase):
+  def setUp(self):
+    super().setUp()
+    settings.configure({'processing_dir': self.temp_dir.name,
+                        'service_start': None,
+                        'service_end': None})
+    self.ran = []
+    self.lock = threading.Lock()
+
+  def make_service(self, name, duration=0, fail=False):
+    def service():
+      with self.lock:
+        self.ran.append(name + '_start')
+      time.sleep(duration)
+      if fail:
+        raise RuntimeError(name)
+      with self.lock:
+        self.ran.append(name)
+    service.__name__ = name
+    return service
+
+
+class TestPipelineWorkflow(TestWorkflowCase):
+  def test_slice(self):
+    workflow = PipelineWorkflow()
+    workflow.pipeline = [self.make_service(name) for name in 'abcd']
+    settings.service_start = 'B'
+    settings.service_end = 'c'
+    workflow.run()
+    self.assertEqual(self.ran, ['b_start', 'b', 'c_start', 'c'])
+
+  def test_prepare(self):
+    workflow = PipelineWorkflow()
+    workflow.pipeline = [self.make_service('a')]
+    with mock.patch.object(terra.compute.utils.ComputeHandler,
+                           '_connection', mock.PropertyMock(
+                               return_value=base.BaseCompute())), \
+        mock.patch.object(base.BaseCompute, 'prepare') as prepare:
+      workflow.run()
+      prepare.assert_not_called()
+
+      workflow.services = ['my.Service']
+      workflow.run()
+      prepare.assert_called_once_with(['my.Service'])
+
+  def test_close(self):
+    workflow = PipelineWorkflow()
+    workflow.pipeline = [self.make_service('a', fail=True)]
+    with mock.patch.object(terra.compute.utils.ComputeHandler,
+                           '_connection', mock.PropertyMock(
+                               return_value=base.BaseCompute())), \
+        mock.patch.object(base.BaseCompute, 'close') as close:
+      with self.assertRaises(RuntimeError):
+        workflow.run()
+      # The pooled containers are stopped, even when a service fails
+      close.assert_called_once_with()
+
+
+class TestDagWorkflow(TestWorkflowCase):
+  def test_serial_default(self):
+    workflow = DagWorkflow()
+    workflow.pipeline = [self.make_service(name, 0.01) for name in 'abc']
+    workflow.run()
+    self.assertEqual(self.ran, ['a_start', 'a', 'b_start', 'b', 'c_start',
+                                'c'])
+
+  def test_diamond(self):
+    a = depends_on()(self.make_service('a'))
+    b = depends_on(a)(self.make_service('b', 0.1))
+    c = depends_on(a)(self.make_service('c', 0.1))
+    d = depends_on(b, c)(self.make_service('d'))
+    workflow = DagWorkflow()
+    workflow.pipeline = [a, b, c, d]
+    workflow.run()
+
+    self.assertEqual(self.ran[:2], ['a_start', 'a'])
+    # b and c ran at the same time
+    self.assertEqual(sorted(self.ran[2:4]), ['b_start', 'c_start'])
+    self.assertEqual(self.ran[-2:], ['d_start', 'd'])
+
+  def test_slice(self):
+    a = depends_on()(self.make_service('a'))
+    b = depends_on(a)(self.make_service('b'))
+    c = depends_on(b)(self.make_service('c'))
+    workflow = DagWorkflow()
+    workflow.pipeline = [a, b, c]
+    settings.service_start = 'b'
+    settings.service_end = 'b'
+    workflow.run()
+    self.assertEqual(self.ran, ['b_start', 'b'])
+
+  def test_failure(self):
+    a = depends_on()(self.make_service('a', fail=True))
+    b = depends_on(a)(self.make_service('b'))
+    c = depends_on()(self.make_service('c', 0.01))
+    workflow = DagWorkflow()
+    workflow.pipeline = [a, b, c]
+    with self.assertRaisesRegex(RuntimeError, '^a$'), self.assertLogs():
+      workflow.run()
+    # Downstream never ran, independent service finished
+    self.assertNotIn('b_start', self.ran)
+    self.assertIn('c', self.ran)
+
+  def test_close(self):
+    a = depends_on()(self.make_service('a', fail=True))
+    workflow = DagWorkflow()
+    workflow.pipeline = [a]
+    with mock.patch.object(terra.compute.utils.ComputeHandler,
+                           '_connection', mock.PropertyMock(
+                               return_value=base.BaseCompute())), \
+        mock.patch.object(base.BaseCompute, 'close') as close:
+      with self.assertRaises(RuntimeError), self.assertLogs():
+        workflow.run()
+      close.assert_called_once_with()
+
+  def test_settings_context(self):
+    seen = []
+
+    def a():
+      settings.upstream_value = 1
+
+    def b():
+      seen.append('upstream_value' in settings)
+
+    workflow = DagWorkflow()
+    workflow.pipeline = [a, b]
+    workflow.run()
+    # Settings changes stay in the service's own settings context
+    self.assertEqual(seen, [False])
+    self.assertNotIn('upstream_value', settings)
+
+  def test_prepare_failed(self):
+    workflow = DagWorkflow()
+    workflow.pipeline = [self.make_service('a')]
+    with mock.patch.object(DagWorkflow, 'prepare',
+                           side_effect=RuntimeError('prepare')), \
+        mock.patch('terra.workflow.service_timings') as timings:
+      with self.assertRaisesRegex(RuntimeError, 'prepare'):
+        workflow.run()
+      timings.log_summary.assert_called_once_with()
+    self.assertEqual(self.ran, [])
+
+  def test_bad_order(self):
+    a = self.make_service('a')
+    b = depends_on()(self.make_service('b'))
+    a = depends_on(b)(a)
+    workflow = DagWorkflow()
+    workflow.pipeline = [a, b]
+    with self.assertRaisesRegex(ValueError, 'must precede'):
+      workflow.run()
+    self.assertEqual(self.ran, [])
+
+
+class RunAsyncService(base.BaseService):
+  def pre_run(self):
+    super().pre_run()
+    settings.some_value = type(self).__name__
+
+
+class RunAsyncCompute(base.BaseCompute):
+  def run_service(self, service_info):
+    time.sleep(0.05)
+    return settings.some_value
+
+
+class TestRunAsync(TestWorkflowCase):
+  def test_run_async(self):
+    compute = RunAsyncCompute()
+    with mock.patch.object(terra.compute.utils, 'load_service',
+                           lambda service: service()):
+      start = time.time()
+      futures = [compute.run_async(RunAsyncService) for _ in range(4)]
+      self.addCleanup(compute._service_executor.shutdown)
+      results = [future.result() for future in futures]
+    self.assertLess(time.time() - start, 0.2)
+    self.assertEqual(results, ['RunAsyncService'] * 4)
+    # Changes to the settings stay in the service's settings context
+    self.assertNotIn('some_value', settings)
@@ -1,8 +1,32 @@
+from concurrent.futures import wait
+
 from terra import settings
+from terra.compute.timing import service_timings
 from terra.logger import getLogger
 logger = getLogger(__name__)
 
 
+def depends_on(*upstream):
+  '''
+  Decorator to declare the upstream services of a service call in a
+  :class:`DagWorkflow`
+
+  Example::
+
+      @depends_on(preprocess_left, preprocess_right)
+      def stereo():
+        compute.run(StereoService)
+
+  ``@depends_on()``, with no arguments, declares a service with no upstream
+  services
+  '''
+
+  def wrapper(service):
+    service.upstream = list(upstream)
+    return service
+  return wrapper
+
+
 class BaseWorkflow:
   '''
   The base class for all Terra Workflows
@@ -16,13 +40,26 @@ class PipelineWorkflow:
   '''
   A simple workflow that runs a set of services, serially.
 
-  self.pipeline need to be set to a list of services calls.
+  self.pipeline need to be set to a list of services calls. The service
+  classes listed in self.services are prepared before the pipeline runs, see
+  :meth:`terra.compute.base.BaseCompute.prepare`
   '''
 
   def __init__(self):
     self.pipeline = list()
+    self.services = list()
     super().__init__()
 
+  def prepare(self):
+    '''
+    Get the services in ``self.services`` ready to run, e.g. pull their
+    images, all at once before the pipeline runs
+    '''
+
+    if self.services:
+      from terra.compute import compute
+      compute.prepare(self.services)
+
   # locate index of service name in workflow pipeline
   def service_index(self, service_name=None, default_index=0):
 
@@ -42,8 +79,11 @@ class PipelineWorkflow:
                           f" in {pipeline_names}")
       raise newerr from err
 
-  # run main workflow
-  def run(self):
+  def sliced_pipeline(self):
+    '''
+    The services of the pipeline between :option:`service_start` and
+    :option:`service_end`
+    '''
 
     # pipeline start/end
     start_index = self.service_index(settings.service_start, 0)
@@ -57,9 +97,117 @@ class PipelineWorkflow:
       )
 
     # slice pipeline to requested services
-    pipeline = self.pipeline[start_index:end_index + 1]
+    return self.pipeline[start_index:end_index + 1]
+
+  # run main workflow
+  def run(self):
+    from terra.compute import compute
+
+    pipeline = self.sliced_pipeline()
     logger.info(f'PIPELINE - {[s.__name__ for s in pipeline]}')
 
     # Run the pipeline
+    try:
+      self.prepare()
+      for service in pipeline:
+        service()
+    finally:
+      service_timings.log_summary()
+      # Stop the pooled containers
+      compute.close()
+
+
+class DagWorkflow(PipelineWorkflow):
+  '''
+  A workflow that runs the services of a pipeline concurrently, as soon as
+  their upstream services are done
+
+  ``self.pipeline`` is a list of service calls, like in a
+  :class:`PipelineWorkflow`, in an order where every service comes after its
+  upstream services. The upstream services of a service call are declared
+  using :func:`depends_on` (or by setting its ``upstream`` attribute).
+  A service call without a declaration depends on the service before it in
+  the pipeline, so a pipeline without any declarations runs one service at a
+  time, in order.
+
+  Unlike in a :class:`PipelineWorkflow`, each service call runs in a thread,
+  in a settings context of its own (like
+  :meth:`terra.compute.base.BaseCompute.run_async`), so changes a service
+  makes to the settings, e.g. in its ``post_run``, are not seen by its
+  downstream services, or the rest of the workflow. Services pass results on
+  through files, e.g. in the :option:`processing_dir`, instead.
+
+  :option:`service_start` and :option:`service_end` slice the pipeline the
+  same way as in a :class:`PipelineWorkflow`. Upstream services that are
+  sliced off are considered done.
+
+  If a service fails, its downstream services are not run, independent
+  services still run to completion, and then the first failure is raised.
+  '''
+
+  def upstream(self, service):
+    '''
+    Get the upstream services of a service call
+    '''
+
+    upstream = getattr(service, 'upstream', None)
+    if upstream is not None:
+      return list(upstream)
+    index = self.pipeline.index(service)
+    return self.pipeline[index - 1:index] if index else []
+
+  def run(self):
+    pipeline = self.sliced_pipeline()
+    logger.info(f'PIPELINE - {[s.__name__ for s in pipeline]}')
+
+    from terra.compute import compute
+    from terra.executor.thread import ThreadPoolExecutor
+
+    max_workers = None
+    if settings.configured:
+      max_workers = settings.compute.get('max_concurrent', None)
+
+    # Check the whole graph before running anything. Requiring upstream
+    # services to come first also rules out cycles
+    dependencies = {}
     for service in pipeline:
-      service()
+      dependencies[service] = self.upstream(service)
+      for dependency in dependencies[service]:
+        if dependency not in self.pipeline:
+          raise ValueError(f'Upstream service {dependency.__name__} of '
+                           f'{service.__name__} is not in the pipeline')
+        if self.pipeline.index(dependency) >= self.pipeline.index(service):
+          raise ValueError(f'Upstream service {dependency.__name__} must '
+                           f'precede {service.__name__} in the pipeline')
+
+    futures = {}
+    try:
+      self.prepare()
+      with ThreadPoolExecutor(max_workers=max_workers,
+                              thread_name_prefix='terra_workflow') as executor:
+        for service in pipeline:
+          # Upstream services sliced off the pipeline are considered done
+          upstream = [futures[dependency]
+                      for dependency in dependencies[service]
+                      if dependency in futures]
+          # The executor holds the call until the upstream futures are done
+          futures[service] = executor.submit(_run_service, service, upstream)
+
+      wait(futures.values())
+    finally:
+      service_timings.log_summary()
+      # Stop the pooled containers
+      compute.close()
+
+    for service, future in futures.items():
+      # The first failure in pipeline order is the root cause, its downstream
+      # services fail with the same exception
+      if future.exception() is not None:
+        logger.error(f'Service {service.__name__} failed')
+        raise future.exception()
+
+
+def _run_service(service, upstream_results):
+  # Each call runs in its own settings context, like compute.run_async
+  with settings:
+    return service()